@@ -1,12 +1,15 @@
-"""CLI for the deliver subcommand"""
+"""CLI for the deliver subcommand
+
+The plugin is loaded by the taca CLI on every invocation, so the modules
+doing the actual work, which pull in the database clients, requests, yaml and
+more, are only imported inside the commands that need them.
+"""
 
 import click
 import logging
+import time
 
-from taca.utils.misc import send_mail
-from taca.utils.config import load_yaml_config
-from taca_ngi_pipeline.deliver import deliver as _deliver
-from taca_ngi_pipeline.deliver import deliver_dds as _deliver_dds
+from taca_ngi_pipeline.utils import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +67,19 @@ logger = logging.getLogger(__name__)
     default=False,
     help="Explicitly generate ENA TSV files for submission on a staged project",
 )
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Do not stage or deliver anything, but print a JSON report of the files that "
+    "would be delivered and an estimate of the time needed",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Profile the delivery with cProfile and write the stats next to the transfer logs",
+)
 def deliver(
     ctx,
     deliverypath,
@@ -75,6 +91,8 @@ def deliver(
     cluster,
     ignore_analysis_status,
     generate_ena_tsv_only,
+    plan,
+    profile,
 ):
     """Deliver methods entry point"""
     if deliverypath is None:
@@ -142,6 +160,13 @@ def deliver(
     default=False,
     help="Do not fetch member information from the order portal",
 )
+@click.option(
+    "--jobs",
+    default=1,
+    type=click.IntRange(1, None),
+    help="Number of projects to deliver concurrently, each in a separate process "
+    "(soft-stage deliveries only)",
+)
 def project(
     ctx,
     projectid,
@@ -153,28 +178,81 @@ def project(
     fc_delivery=False,
     project_desc=None,
     ignore_orderportal_members=False,
+    jobs=1,
 ):
     """Deliver the specified projects to the specified destination"""
-    for pid in projectid:
-        if ctx.parent.params["cluster"]:
-            if statusdb_config is None:
-                logger.error(
-                    "--statusdb-config or env variable $STATUS_DB_CONFIG"
-                    " need to be set to perform {} delivery".format(
-                        ctx.parent.params["cluster"]
-                    )
+    from taca.utils.config import load_yaml_config
+    from taca_ngi_pipeline.deliver import deliver as _deliver
+    from taca_ngi_pipeline.deliver import deliver_dds as _deliver_dds
+
+    if ctx.parent.params["plan"] and (ctx.parent.params["cluster"] or fc_delivery):
+        logger.error("--plan is only available for soft-stage project deliveries")
+        return 1
+    if ctx.parent.params["cluster"]:
+        if statusdb_config is None:
+            logger.error(
+                "--statusdb-config or env variable $STATUS_DB_CONFIG"
+                " need to be set to perform {} delivery".format(
+                    ctx.parent.params["cluster"]
                 )
-                return 1
-            load_yaml_config(statusdb_config.name)
-            if order_portal is None:
+            )
+            return 1
+        load_yaml_config(statusdb_config.name)
+        if order_portal is None:
+            logger.error(
+                "--order-portal or env variable $ORDER_PORTAL"
+                " need to be set to perform {} delivery".format(
+                    ctx.parent.params["cluster"]
+                )
+            )
+            return 1
+        load_yaml_config(order_portal.name)
+        if jobs > 1:
+            logger.warning(
+                "--jobs only applies to soft-stage deliveries, the projects "
+                "will be delivered one at a time"
+            )
+            jobs = 1
+    if jobs > 1 and fc_delivery:
+        raise click.UsageError("--jobs cannot be combined with --fc-delivery")
+    if (
+        ctx.parent.params["generate_ena_tsv_only"]
+        and not ctx.parent.params["cluster"]
+        and len(projectid) > 1
+    ):
+        import io
+        from taca_ngi_pipeline.utils.ena_tsv_generator import write_summary
+
+        summaries = _deliver.generate_ena_tsv_files(
+            [_deliver.ProjectDeliverer(pid, **ctx.parent.params) for pid in projectid]
+        )
+        summary = io.StringIO()
+        write_summary(summaries, summary)
+        click.echo(summary.getvalue().rstrip("\n"), err=True)
+        return 0 if not any(s["error"] for s in summaries) else 1
+    if ctx.parent.params["plan"]:
+        import json
+
+        status = True
+        for pid in projectid:
+            d = _deliver.ProjectDeliverer(pid, **ctx.parent.params)
+            try:
+                click.echo(json.dumps(d.plan_delivery(), indent=2))
+            except Exception as e:
                 logger.error(
-                    "--order-portal or env variable $ORDER_PORTAL"
-                    " need to be set to perform {} delivery".format(
-                        ctx.parent.params["cluster"]
-                    )
+                    "planning the delivery of {} failed - reason: {}".format(pid, e)
                 )
-                return 1
-            load_yaml_config(order_portal.name)
+                status = False
+        return 0 if status else 1
+    if jobs > 1 and len(projectid) > 1:
+        results = _deliver_projects_concurrently(
+            projectid, ctx.parent.params, min(jobs, len(projectid))
+        )
+        click.echo(_summary_table(results), err=True)
+        return 0 if all(status for _, status, _ in results) else 1
+    results = []
+    for pid in projectid:
+        start = time.time()
         if not ctx.parent.params["cluster"]:  # Soft stage case
             d = _deliver.ProjectDeliverer(pid, **ctx.parent.params)
         elif ctx.parent.params["cluster"] == "dds":  # Hard stage and deliver using DDS
@@ -190,9 +268,109 @@ def project(
             )
 
         if fc_delivery:
-            _exec_fn(d, d.deliver_run_folder)
+            status = _exec_fn(d, d.deliver_run_folder)
         else:
-            _exec_fn(d, d.deliver_project)
+            status = _exec_fn(d, d.deliver_project)
+        results.append((pid, status, time.time() - start))
+    if len(results) > 1:
+        click.echo(_summary_table(results), err=True)
+
+
+# helpers for delivering several projects in worker processes
+def _init_project_worker(config, pid):
+    from taca.utils.config import CONFIG
+
+    # the worker may not have inherited the configuration of the parent
+    CONFIG.clear()
+    CONFIG.update(config)
+    # tell the projects apart in the log output
+    factory = logging.getLogRecordFactory()
+
+    def _record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.msg = "[{}] {}".format(pid, record.msg)
+        return record
+
+    logging.setLogRecordFactory(_record)
+
+
+def _deliver_project_worker(config, pid, params):
+    """Deliver a soft-stage project in a worker process
+    :returns: a tuple with the status returned by _exec_fn, the duration of
+        the delivery and a snapshot of the metrics of the worker
+    """
+    from taca_ngi_pipeline.deliver import deliver as _deliver
+
+    _init_project_worker(config, pid)
+    metrics.REGISTRY.reset()
+    start = time.time()
+    d = _deliver.ProjectDeliverer(pid, **params)
+    status = _exec_fn(d, d.deliver_project, export_metrics=False)
+    return status, time.time() - start, metrics.REGISTRY.snapshot()
+
+
+def _deliver_projects_concurrently(projectids, params, jobs):
+    """Deliver soft-stage projects in up to `jobs` worker processes at a time.
+    The configuration is loaded once by the parent and passed on to the
+    workers, and the metrics of the workers are merged and exported once all
+    projects are done.
+
+    :returns: a list of tuples with the project id, the status returned by
+        _exec_fn and the duration of each delivery
+    """
+    import concurrent.futures
+    from taca.utils.config import CONFIG
+
+    config = dict(CONFIG)
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            (
+                pid,
+                time.time(),
+                executor.submit(_deliver_project_worker, config, pid, params),
+            )
+            for pid in projectids
+        ]
+        for pid, submitted, future in futures:
+            try:
+                status, seconds, snapshot = future.result()
+                metrics.REGISTRY.merge(snapshot)
+            except Exception as e:
+                # _exec_fn notifies the operator of delivery errors, this is
+                # for a worker that could not deliver at all
+                logger.error("processing {} failed - reason: {}".format(pid, e))
+                status, seconds = None, time.time() - submitted
+            results.append((pid, status, seconds))
+    metrics.export(
+        CONFIG.get("deliver", {}).get("metrics_textfile_dir"),
+        success=all(status for _, status, _ in results),
+    )
+    return results
+
+
+def _summary_table(results):
+    """
+    :param results: a list of tuples with a project id, the status returned
+        by _exec_fn and the duration in seconds
+    :returns: a table with the outcome of each delivery, as a string
+    """
+    outcomes = {True: "ok", False: "with errors", None: "failed"}
+    rows = [("project", "status", "duration")] + [
+        (
+            pid,
+            outcomes[status if status is None else bool(status)],
+            "{:d}:{:02d}:{:02d}".format(
+                int(seconds) // 3600, int(seconds) % 3600 // 60, int(seconds) % 60
+            ),
+        )
+        for pid, status, seconds in results
+    ]
+    widths = [max(len(row[n]) for row in rows) for n in range(3)]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
 
 
 # sample delivery
@@ -203,6 +381,8 @@ def project(
 @click.argument("sampleid", type=click.STRING, nargs=-1)
 def sample(ctx, projectid, sampleid):
     """Deliver the specified sample to the specified destination"""
+    from taca_ngi_pipeline.deliver import deliver as _deliver
+
     for sid in sampleid:
         if not ctx.parent.params["cluster"]:  # Soft stage case
             d = _deliver.SampleDeliverer(projectid, sid, **ctx.parent.params)
@@ -214,16 +394,44 @@ def sample(ctx, projectid, sampleid):
         _exec_fn(d, d.deliver_sample)
 
 
+# helper function to run a delivery under cProfile if requested
+def _profiled(obj, fn):
+    if not getattr(obj, "profile", False):
+        return fn()
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn)
+    finally:
+        statsfile = obj.log_file("prof")
+        if statsfile is None:
+            logger.warning(
+                "no logpath is configured, the profile of {} is not saved".format(
+                    str(obj)
+                )
+            )
+        else:
+            profiler.dump_stats(statsfile)
+            logger.info("profile of {} written to {}".format(str(obj), statsfile))
+
+
 # helper function to handle error reporting
-def _exec_fn(obj, fn):
+# returns True or False for deliveries with or without errors, and None if
+# the delivery failed
+def _exec_fn(obj, fn, export_metrics=True):
+    success = None
     try:
-        if fn():
+        success = bool(_profiled(obj, fn))
+        if success:
             logger.info("{} processed successfully".format(str(obj)))
         else:
             logger.info("{} processed with some errors, check log".format(str(obj)))
     except Exception as e:
         logger.exception(e)
         try:
+            from taca.utils.misc import send_mail
+
             send_mail(
                 subject="[ERROR] processing failed: {}".format(str(obj)),
                 content="Project: {}\nSample: {}\nCommand: {}\n\nAdditional information:{}\n".format(
@@ -243,6 +451,12 @@ def _exec_fn(obj, fn):
                     str(obj), str(e), obj.config.get("operator")
                 )
             )
+    finally:
+        if export_metrics:
+            metrics.export(
+                obj.config.get("metrics_textfile_dir"), success=bool(success)
+            )
+    return success
 
 
 @deliver.command()
@@ -265,10 +479,22 @@ def _exec_fn(obj, fn):
 )
 def release_dds_project(ctx, projectid, dds_project, dds_deadline, no_dds_mail):
     """Updates DDS delivery status in Charon and releases DDS project to user."""
+    from taca_ngi_pipeline.deliver import deliver_dds as _deliver_dds
+
     if not dds_project:
         logger.error("Please specify the DDS project ID to release with --dds_project")
         return 1
     d = _deliver_dds.DDSProjectDeliverer(
         projectid, do_release=True, **ctx.parent.params
     )
-    d.release_DDS_delivery_project(dds_project, no_dds_mail, dds_deadline)
+    success = False
+    try:
+        _profiled(
+            d,
+            lambda: d.release_DDS_delivery_project(
+                dds_project, no_dds_mail, dds_deadline
+            ),
+        )
+        success = True
+    finally:
+        metrics.export(d.config.get("metrics_textfile_dir"), success=success)
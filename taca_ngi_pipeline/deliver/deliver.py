@@ -3,6 +3,7 @@ Module for controlling deliveries of samples and projects
 """
 
 import datetime
+import functools
 import glob
 import json
 import logging
@@ -10,11 +11,14 @@ import os
 import re
 import signal
 import shutil
+import subprocess
+import threading
+import time
 import yaml
 
+from concurrent.futures import Future
 from taca.utils.config import CONFIG
-from taca.utils.filesystem import create_folder, chdir
-from taca.utils.misc import call_external_command
+from taca.utils.filesystem import create_folder
 from taca.utils.statusdb import (
     ProjectSummaryConnection,
     FlowcellRunMetricsConnection,
@@ -23,12 +27,18 @@ from taca.utils.statusdb import (
 from taca.utils import transfer
 from ..utils import database as db
 from ..utils import filesystem as fs
-from ..utils.ena_tsv_generator import tsv_generator
+from ..utils import metrics
+from ..utils import staged_files as sf
+from ..utils.ena_tsv_generator import generate_tsv_files, tsv_generator
+from . import timing
 from io import open
-from six.moves import map
 
 logger = logging.getLogger(__name__)
 
+# the reasons from SampleDeliverer.check_deliverable that do not fail a delivery
+SAMPLE_DELIVERED = "already delivered"
+SAMPLE_ABORTED = "marked as ABORTED"
+
 
 class DelivererError(Exception):
     pass
@@ -64,6 +74,66 @@ def _timestamp(days=None):
     return instant[:-9] + "%06.3f" % float(instant[-9:]) + "Z"
 
 
+def _read_digestfile(digestpath):
+    """
+    :returns: a dict with the checksums in a digest file by path, empty if
+        the file does not exist
+    """
+    digests = {}
+    if os.path.exists(digestpath):
+        with open(digestpath, "r") as fh:
+            for line in fh:
+                digest, fpath = line.rstrip("\n").split("  ", 1)
+                digests[fpath] = digest
+    return digests
+
+
+def _rsync_transferred_bytes(logpath):
+    """
+    :returns: the size in bytes of the files transferred by rsync, as listed
+        by the last `--stats` in its log, or None if there is none
+    """
+    nbytes = None
+    with open(logpath, "r") as fh:
+        for line in fh:
+            if line.startswith("Total transferred file size:"):
+                try:
+                    nbytes = int(line.split(":", 1)[1].split()[0].replace(",", ""))
+                except (IndexError, ValueError):
+                    nbytes = None
+    return nbytes
+
+
+def _run_report_command(cl, cwd, logprefix=None):
+    """Run a report command in the given working directory, like
+    `taca.utils.misc.call_external_command` but without changing the working
+    directory of the process, so that reports can be generated in a
+    background thread
+
+    :param list cl: the command line to run
+    :param string cwd: the working directory of the command
+    :param string logprefix: if given, stdout and stderr are appended to
+        log files with this prefix
+    :raises subprocess.CalledProcessError: if the command failed
+    """
+    stdout = stderr = None
+    if logprefix is not None:
+        logfile = "{}_{}".format(logprefix, os.path.basename(cl[0]))
+        stdout = open("{}.out".format(logfile), "a")
+        stderr = open("{}.err".format(logfile), "a")
+        started = "Started command {} on {}".format(
+            " ".join(cl), datetime.datetime.now()
+        )
+        stdout.write("{}\n{}\n".format(started, "=" * len(started)))
+        stdout.flush()
+    try:
+        subprocess.check_call(cl, cwd=cwd, stdout=stdout, stderr=stderr)
+    finally:
+        if logprefix is not None:
+            stdout.close()
+            stderr.close()
+
+
 class Deliverer(object):
     """
     A (abstract) superclass with functionality for handling deliveries
@@ -76,7 +146,35 @@ class Deliverer(object):
         :param bool no_checksum: if True, skip the checksum computation
         :param string hash_algorithm: algorithm to use for calculating
             file checksums, defaults to sha1
+        :param int hash_workers: number of threads computing checksums
+            while staging, defaults to 1
+        :param int hash_blocksize: number of bytes read at a time when
+            computing checksums
+        :param int tree_digest_workers: if given, a tree digest is cached
+            with each checksum and files are verified against it on this many
+            threads, see `fs.TreeHasher`
+        :param string integrity_algorithm: algorithm of the tree digests,
+            defaults to blake2b, see `fs.integrity_hasher`
+        :param bool check_gzip: if True, the gzip compressed files are
+            checked for corruption while they are hashed or streamed
+        :param string transfer_mode: how the staged files are delivered,
+            'rsync' (default) or 'stream', see `do_delivery`
+        :param int staging_queue_size: maximum number of files in flight
+            between the stages of the staging pipeline
+        :param DirectoryListingCache listing_cache: cache of directory
+            listings to share with other deliverers in the same project
+        :param tuple patterns: the 'files_to_deliver' entries and the patterns
+            compiled from them by another deliverer in the same project, see
+            `compile_patterns`
+        :param PhaseTimer parent_timer: timer of an enclosing delivery that
+            the timing of this delivery should be included in
         """
+        # the listing cache, patterns and timer are shared between instances
+        # and not configuration
+        self.listing_cache = kwargs.pop("listing_cache", None)
+        self.patterns = kwargs.pop("patterns", None)
+        parent_timer = kwargs.pop("parent_timer", None)
+        self.pending_reports = []
         # override configuration options with options given on the command line
         self.config = CONFIG.get("deliver", {})
         self.config.update(kwargs)
@@ -85,8 +183,27 @@ class Deliverer(object):
             setattr(self, k, v)
         self.projectid = projectid
         self.sampleid = sampleid
+        self.timer = timing.PhaseTimer(str(self), parent=parent_timer)
         self.hash_algorithm = getattr(self, "hash_algorithm", "sha1")
         self.no_checksum = getattr(self, "no_checksum", False)
+        self.hash_workers = getattr(self, "hash_workers", 1)
+        self.hash_blocksize = int(
+            getattr(self, "hash_blocksize", fs.DEFAULT_HASH_BLOCKSIZE)
+        )
+        self.staging_queue_size = getattr(
+            self, "staging_queue_size", fs.DEFAULT_QUEUE_SIZE
+        )
+        self.transfer_mode = getattr(self, "transfer_mode", "rsync")
+        self.tree_digest_workers = int(getattr(self, "tree_digest_workers", 0))
+        self.check_gzip = getattr(self, "check_gzip", False)
+        self.integrity_algorithm = getattr(
+            self, "integrity_algorithm", fs.DEFAULT_INTEGRITY_ALGORITHM
+        )
+        if self.tree_digest_workers > 0:
+            try:
+                fs.integrity_hasher(self.integrity_algorithm)
+            except ValueError as e:
+                raise DelivererError("invalid integrity_algorithm: {}".format(e)) from e
         self.files_to_deliver = getattr(self, "files_to_deliver", None)
         self.deliverystatuspath = getattr(self, "deliverystatuspath", None)
         self.stagingpath = getattr(self, "stagingpath", None)
@@ -96,19 +213,20 @@ class Deliverer(object):
         self.force = getattr(self, "force", False)
         self.stage_only = getattr(self, "stage_only", False)
         self.ignore_analysis_status = getattr(self, "ignore_analysis_status", False)
-        # Fetches a project name, should always be availble; but is not a requirement
-        try:
-            self.projectname = db.project_entry(db.dbcon(), projectid)["name"]
-        except KeyError:
-            pass
-        # only set an attribute for uppnexid if it's actually given or in the db
-        try:
-            getattr(self, "uppnexid")
-        except AttributeError:
+        with self.timer.phase("charon"):
+            # Fetches a project name, should always be availble; but is not a requirement
             try:
-                self.uppnexid = db.project_entry(db.dbcon(), projectid)["uppnex_id"]
+                self.projectname = db.project_entry(db.dbcon(), projectid)["name"]
             except KeyError:
                 pass
+            # only set an attribute for uppnexid if it's actually given or in the db
+            try:
+                getattr(self, "uppnexid")
+            except AttributeError:
+                try:
+                    self.uppnexid = db.project_entry(db.dbcon(), projectid)["uppnex_id"]
+                except KeyError:
+                    pass
         # set a custom signal handler to intercept interruptions
         signal.signal(signal.SIGINT, _signal_handler)
         signal.signal(signal.SIGTERM, _signal_handler)
@@ -192,57 +310,227 @@ class Deliverer(object):
             destination path and the checksum of the source file
             (or None if source is a folder)
         """
+        patterns = self.compile_patterns()
+        # unless the config marks the files created by the reports, any
+        # pattern could match them, so the reports are waited for up front
+        if self.pending_reports and not any(pattern.report for pattern in patterns):
+            self.wait_for_reports()
         return fs.gather_files(
-            [
-                list(map(self.expand_path, file_pattern))
-                for file_pattern in self.files_to_deliver
-            ],
+            [pattern.expand(self.expand_path) for pattern in patterns],
             no_checksum=self.no_checksum,
             hash_algorithm=self.hash_algorithm,
+            hash_workers=self.hash_workers,
+            hash_blocksize=self.hash_blocksize,
+            queue_size=self.staging_queue_size,
+            listing_cache=self.listing_cache,
+            timer=self.timer,
+            wait_for_reports=self.wait_for_reports if self.pending_reports else None,
+            defer_digest=self.defers_digests(),
+            tree_digest=self.tree_digest_workers > 0,
+            integrity_algorithm=self.integrity_algorithm,
+            check_gzip=self.check_gzip,
         )
 
+    def compile_patterns(self):
+        """Compile the 'files_to_deliver' entries, unless the same entries
+        have already been compiled by this deliverer or by the project
+        deliverer
+
+        :returns: a list of DeliveryPattern instances
+        :raises fs.InvalidPatternException: if any of the entries is malformed
+        """
+        if self.patterns is None or self.patterns[0] is not self.files_to_deliver:
+            self.patterns = (
+                self.files_to_deliver,
+                fs.compile_patterns(self.files_to_deliver),
+            )
+        return self.patterns[1]
+
+    def defers_digests(self):
+        """
+        :returns: True if the checksums that are not cached are computed
+            while the staged files are transferred, instead of while they are
+            staged
+        """
+        return (
+            self.transfer_mode == "stream"
+            and not self.stage_only
+            and not self.no_checksum
+        )
+
+    def start_report(self, *args, **kwargs):
+        """Run `create_report` with the given arguments in a background
+        thread, so that the reports are generated while the delivery is
+        staged. If the files created by the reports are matched by patterns
+        with the 'report' option, the staging only waits for the reports
+        before looking for them, otherwise it waits before looking for any
+        file.
+
+        :returns: a Future with the outcome of `create_report`
+        """
+        future = Future()
+
+        def _report():
+            try:
+                future.set_result(self.create_report(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=_report, name="report {}".format(self))
+        thread.daemon = True
+        thread.start()
+        self.pending_reports.append(future)
+        return future
+
+    def wait_for_reports(self):
+        """Wait for the reports started with `start_report` to finish. A
+        failed report is logged but does not fail the delivery.
+
+        :returns: True if all reports were created, False otherwise
+        """
+        created = True
+        with self.timer.phase("report_wait"):
+            while self.pending_reports:
+                try:
+                    self.pending_reports.pop(0).result()
+                except Exception as e:
+                    logger.warning(
+                        "failed to create reports for {}, reason: {}".format(self, e)
+                    )
+                    created = False
+        return created
+
+    def report_logprefix(self, name):
+        """
+        :returns: the prefix of the log files for the report commands, or None
+            if no logpath is configured
+        """
+        if self.logpath is None:
+            return None
+        logprefix = os.path.abspath(self.expand_path(os.path.join(self.logpath, name)))
+        if not create_folder(os.path.dirname(logprefix)):
+            return None
+        return logprefix
+
+    def aggregate_report_command(self, sampleids=None):
+        """
+        :param list sampleids: samples to report as expected to be delivered
+            half a day from now
+        :returns: the command line creating the aggregate report
+        """
+        cl = self.report_aggregate.split(" ")
+        if sampleids:
+            # estimate the delivery date for the samples to 0.5 days ahead
+            expected = "{}(expected)".format(_timestamp(days=0.5))
+            cl.extend(
+                [
+                    "--samples_extra",
+                    json.dumps({sid: {"delivered": expected} for sid in sampleids}),
+                ]
+            )
+        return cl
+
+    def plan_files(self):
+        """Summarize the files that gather_files would locate, without
+        computing any checksums
+
+        :returns: a dict with the number of files, their total size in bytes,
+            the bytes that would need a checksum computed, and the path and
+            size of the largest file needing a checksum
+        """
+        summary = {"files": 0, "bytes": 0, "bytes_to_hash": 0}
+        largest_to_hash = None
+        for src, _, size, needs_digest in fs.plan_files(
+            [pattern.expand(self.expand_path) for pattern in self.compile_patterns()],
+            no_checksum=self.no_checksum,
+            hash_algorithm=self.hash_algorithm,
+            listing_cache=self.listing_cache,
+            tree_digest=self.tree_digest_workers > 0,
+        ):
+            summary["files"] += 1
+            summary["bytes"] += size
+            if needs_digest:
+                summary["bytes_to_hash"] += size
+                if largest_to_hash is None or size > largest_to_hash["bytes"]:
+                    largest_to_hash = {"path": src, "bytes": size}
+        summary["largest_file_to_hash"] = largest_to_hash
+        return summary
+
+    @timing.timed("staging")
     def stage_delivery(self):
         """Stage a delivery by symlinking source paths to destination paths
         according to the returned tuples from the gather_files function.
+        The symlinking and writing of the file lists run as a stage of their
+        own after the gather_files pipeline, so files are linked while the
+        following ones are still being located and hashed.
         Checksums will be written to a digest file in the staging path.
         Failure to stage individual files will be logged as warnings but will
         not terminate the staging.
 
-        :raises DelivererError: if an unexpected error occurred
+        :raises DelivererError: if an unexpected error occurred or, with the
+            check_gzip option, a gzip compressed file is corrupt
         """
         digestpath = self.staging_digestfile()
         filelistpath = self.staging_filelist()
         create_folder(os.path.dirname(digestpath))
+        # the staged files whose checksums are computed when transferred
+        self.deferred_digests = set()
+        stagingpath = self.expand_path(self.stagingpath)
+        agent = transfer.SymlinkAgent(None, None, relative=True)
+
+        def _stage(gathered):
+            # a single worker runs this stage, so the files are linked and
+            # listed one at a time and in the order they were gathered
+            src, dst, digest = gathered
+            agent.src_path = src
+            agent.dest_path = dst
+            try:
+                with self.timer.phase("symlink"):
+                    agent.transfer()
+                metrics.SYMLINKED_FILES.inc()
+            except (transfer.TransferError, transfer.SymlinkError) as e:
+                logger.warning(
+                    "failed to stage file '{}' when delivering {} - reason: {}".format(
+                        src, str(self), e
+                    )
+                )
+
+            fpath = os.path.relpath(dst, stagingpath)
+            fh.write("{}\n".format(fpath))
+            if digest is fs.DEFERRED_DIGEST:
+                self.deferred_digests.add(fpath)
+            elif digest is not None:
+                dh.write("{}  {}\n".format(digest, fpath))
+
         try:
             with open(digestpath, "w") as dh, open(filelistpath, "w") as fh:
-                agent = transfer.SymlinkAgent(None, None, relative=True)
-                for src, dst, digest in self.gather_files():
-                    agent.src_path = src
-                    agent.dest_path = dst
-                    try:
-                        agent.transfer()
-                    except (transfer.TransferError, transfer.SymlinkError) as e:
-                        logger.warning(
-                            "failed to stage file '{}' when "
-                            "delivering {} - reason: {}".format(src, str(self), e)
-                        )
-
-                    fpath = os.path.relpath(dst, self.expand_path(self.stagingpath))
-                    fh.write("{}\n".format(fpath))
-                    if digest is not None:
-                        dh.write("{}  {}\n".format(digest, fpath))
+                for _ in fs.run_stage(self.gather_files(), _stage):
+                    pass
                 # finally, include the digestfile in the list of files to deliver
                 fh.write("{}\n".format(os.path.basename(digestpath)))
-        except (IOError, fs.FileNotFoundException, fs.PatternNotMatchedException) as e:
-            raise DelivererError("failed to stage delivery - reason: {}".format(e))
+        except (
+            IOError,
+            fs.FileNotFoundException,
+            fs.PatternNotMatchedException,
+            fs.InvalidPatternException,
+            fs.CorruptFileException,
+        ) as e:
+            raise DelivererError(
+                "failed to stage delivery - reason: {}".format(e)
+            ) from e
         return True
 
+    @timing.timed("transfer")
     def do_delivery(self):
-        """Deliver the staged delivery folder using rsync
+        """Deliver the staged delivery folder using rsync or, if the
+        transfer_mode is 'stream', by `stream_delivery`
         :returns: True if delivery was successful, False if unsuccessful
         :raises DelivererRsyncError: if an exception occurred during
             transfer
+        :raises DelivererError: if the files could not be streamed
         """
+        if self.transfer_mode == "stream":
+            return self.stream_delivery()
         agent = transfer.RsyncAgent(
             self.expand_path(self.stagingpath),
             dest_path=self.expand_path(self.deliverypath),
@@ -257,14 +545,170 @@ class Deliverer(object):
                 "--perms": None,
                 "--chmod": "ug+rwX,o-rwx",
                 "--verbose": None,
+                "--stats": None,
                 "--exclude": ["*rsync.out", "*rsync.err"],
             },
         )
-        create_folder(os.path.dirname(self.transfer_log()))
+        transfer_log = self.transfer_log()
+        create_folder(os.path.dirname(transfer_log))
+        start = time.time()
         try:
-            return agent.transfer(transfer_log=self.transfer_log())
+            transferred = agent.transfer(transfer_log=transfer_log)
         except transfer.TransferError as e:
-            raise DelivererRsyncError(e)
+            raise DelivererRsyncError(e) from e
+        if transferred:
+            # the output of rsync is logged to <prefix>_rsync.out by
+            # taca.utils.misc.call_external_command
+            try:
+                nbytes = _rsync_transferred_bytes("{}_rsync.out".format(transfer_log))
+            except (IOError, OSError) as e:
+                nbytes = None
+                logger.debug("could not read the rsync log of {}: {}".format(self, e))
+            if nbytes is not None:
+                metrics.observe_transfer("rsync", nbytes, time.time() - start)
+        return transferred
+
+    def stream_delivery(self):
+        """Deliver the staged delivery folder by copying the staged files to
+        the delivery path, computing the checksum of each file from the same
+        reads as the copy, so that the source of each file is read only once.
+
+        The checksums deferred while staging are added to the staging digest
+        file and the checksums known from before are verified, using the tree
+        digests cached with them where there are any. Each delivered
+        file is checked to have the size of the bytes read, and a file not
+        matching its checksum does not replace the delivered file. The
+        delivery path must be on a local or mounted filesystem.
+
+        The delivered files keep the modification time of their source, and
+        a file already delivered with the same size, modification time and
+        checksum, as listed in the delivered digest file, is not copied
+        again.
+
+        :returns: True if delivery was successful
+        :raises DelivererError: if a file could not be delivered or did not
+            match its checksum
+        """
+        if getattr(self, "remote_host", None):
+            raise DelivererError(
+                "the 'stream' transfer_mode can not deliver to a remote host"
+            )
+        stagingpath = self.expand_path(self.stagingpath)
+        deliverypath = self.expand_path(self.deliverypath)
+        digestpath = self.staging_digestfile()
+        digestname = os.path.relpath(digestpath, stagingpath)
+        deferred = getattr(self, "deferred_digests", set())
+        with open(self.staging_filelist(), "r") as fh:
+            fpaths = [line.strip() for line in fh]
+        fpaths = [fpath for fpath in fpaths if fpath and fpath != digestname]
+        expected = _read_digestfile(digestpath)
+        # the checksums of the files delivered before, for a top-up delivery
+        delivered = _read_digestfile(self.delivered_digestfile())
+
+        def _copy(fpath):
+            srcpath = os.path.join(stagingpath, fpath)
+            destpath = os.path.join(deliverypath, fpath)
+            src_stat = os.stat(srcpath)
+            if fpath in delivered and (
+                fpath in deferred or delivered[fpath] == expected.get(fpath)
+            ):
+                try:
+                    dest_stat = os.stat(destpath)
+                    if (dest_stat.st_size, dest_stat.st_mtime_ns) == (
+                        src_stat.st_size,
+                        src_stat.st_mtime_ns,
+                    ):
+                        return fpath, delivered[fpath], None, 0
+                except OSError:
+                    pass
+            # the same permissions as given by rsync with --chmod=ug+rwX,o-rwx
+            mode = (src_stat.st_mode & 0o770) | 0o660
+            if src_stat.st_mode & 0o111:
+                mode |= 0o110
+            # a known checksum is verified with the tree digest cached with
+            # it, if any, which is cheaper to compute than the checksum
+            known = fpath in expected and fpath not in deferred
+            cached = None
+            if known:
+                cached = fs.read_tree_digest(os.path.realpath(srcpath))
+                if cached is not None and (
+                    cached.get("hash_algorithm") != self.hash_algorithm
+                    or cached.get("digest") != expected[fpath]
+                ):
+                    cached = None
+            tree = (
+                fs.TreeHasher(
+                    cached["blocksize"],
+                    cached.get("algorithm", fs.DEFAULT_INTEGRITY_ALGORITHM),
+                )
+                if cached is not None
+                else None
+            )
+
+            def _verify(digest):
+                if tree is not None:
+                    return tree.tree()["root"] == cached["root"]
+                return digest == expected[fpath]
+
+            try:
+                digest = fs.copy_and_hash(
+                    srcpath,
+                    destpath,
+                    hash_algorithm=self.hash_algorithm if tree is None else None,
+                    blocksize=self.hash_blocksize,
+                    mode=mode,
+                    tree=tree,
+                    gzip_checker=(
+                        fs.GzipChecker(srcpath)
+                        if self.check_gzip and fs.is_gzip_file(srcpath)
+                        else None
+                    ),
+                    verify=_verify if known else None,
+                    preserve_mtime=True,
+                )
+            except fs.ChecksumMismatchException:
+                return fpath, None, False, 0
+            return fpath, digest, known or None, src_stat.st_size
+
+        start = time.time()
+        mismatched = []
+        # the bytes copied, not counting the files already delivered
+        copied = 0
+        try:
+            with open(digestpath, "a") as dh:
+                for fpath, digest, verified, nbytes in fs.run_stage(
+                    fpaths, _copy, workers=self.hash_workers
+                ):
+                    copied += nbytes
+                    if fpath in deferred:
+                        dh.write("{}  {}\n".format(digest, fpath))
+                    elif verified is False:
+                        logger.error(
+                            "staged file {} does not match its checksum {} and "
+                            "was not delivered".format(fpath, expected[fpath])
+                        )
+                        mismatched.append(fpath)
+            self.deferred_digests = set()
+            # the digest file is delivered only once all files are delivered
+            if mismatched:
+                raise DelivererError(
+                    "{} staged files did not match their checksums".format(
+                        len(mismatched)
+                    )
+                )
+            fs.copy_and_hash(
+                digestpath,
+                self.delivered_digestfile(),
+                hash_algorithm=self.hash_algorithm,
+                mode=0o660,
+            )
+            copied += os.path.getsize(digestpath)
+        except (IOError, OSError, fs.CorruptFileException) as e:
+            raise DelivererError(
+                "failed to stream delivery - reason: {}".format(e)
+            ) from e
+        metrics.observe_transfer("stream", copied, time.time() - start)
+        return True
 
     def delivered_digestfile(self):
         """
@@ -307,6 +751,33 @@ class Deliverer(object):
             )
         )
 
+    def timing_tracefile(self):
+        """
+        :returns: path to the json file to write the timing of the delivery
+            to, next to the transfer logs, or None if there is no log path
+        """
+        return self.log_file("timing.json")
+
+    def log_file(self, suffix):
+        """
+        :returns: path to a timestamped file with the given suffix in the
+            log folder, or None if no log path is configured
+        """
+        if self.logpath is None:
+            return None
+        logfile = self.expand_path(
+            os.path.join(
+                self.logpath,
+                "{}_{}.{}".format(
+                    self.sampleid or self.projectid,
+                    datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),
+                    suffix,
+                ),
+            )
+        )
+        create_folder(os.path.dirname(logfile))
+        return logfile
+
     def expand_path(self, path):
         """Will expand a path by replacing placeholders with correspondingly
         named attributes belonging to this Deliverer instance. Placeholders
@@ -342,13 +813,16 @@ class Deliverer(object):
             except AttributeError as e:
                 raise DelivererError(
                     "the path '{}' could not be expanded - reason: {}".format(path, e)
-                )
+                ) from e
 
+    @timing.timed("statusdb")
     def aggregate_meta_info(self):
         """A method to collect meta info about delivered files (like size, md5 value)
         Which files are interested (by default only 'fastq' and 'bam' files) can be
         controlled by setting 'files_interested' in 'aggregate_meta_info' section.
         It needs a database credentials file to put the aggregated info.
+        If 'staged_files_db' is set, the info is saved in the document of the
+        sample in that database instead of in the project document.
         """
         save_meta_info = getattr(self, "save_meta_info", False)
         if not save_meta_info:
@@ -357,8 +831,7 @@ class Deliverer(object):
             with open(os.getenv("STATUS_DB_CONFIG"), "r") as db_cred_file:
                 db_conf = yaml.safe_load(db_cred_file)["statusdb"]
             sdb = ProjectSummaryConnection(db_conf)
-            proj_obj = sdb.get_entry(self.projectname)
-            meta_info_dict = proj_obj.get("staged_files", {})
+            merger = fs.DictMerger()
             staging_path = self.expand_path(self.stagingpath)
             hash_files = glob.glob(
                 os.path.join(
@@ -374,9 +847,48 @@ class Deliverer(object):
                     root_path=staging_path,
                     files_filter=[".fastq", ".bam"],
                 )
-                meta_info_dict = fs.merge_dicts(meta_info_dict, hash_dict)
-            proj_obj["staged_files"] = meta_info_dict
-            sdb.save_db_doc(proj_obj)
+                merger.merge(hash_dict)
+            meta_info_dict = merger.materialise()
+            staged_files_db = getattr(self, "staged_files_db", None)
+            if staged_files_db:
+                proj_obj = {}
+
+                def _inline(sampleid):
+                    # the project document is only fetched for samples
+                    # staged before they had a document of their own
+                    if not proj_obj:
+                        with metrics.database_request("statusdb"):
+                            proj_obj.update(sdb.get_entry(self.projectname) or {})
+                    return proj_obj.get("staged_files", {}).get(sampleid, {})
+
+                for sampleid, files in meta_info_dict.items():
+                    sf.update_staged_files(
+                        sdb.connection,
+                        staged_files_db,
+                        self.projectid,
+                        sampleid,
+                        files,
+                        inline=functools.partial(_inline, sampleid),
+                    )
+                logger.info(
+                    "Updated metainfo for sample {} in project {} in {} in StatusDB".format(
+                        self.sampleid, self.projectid, staged_files_db
+                    )
+                )
+                return True
+            with metrics.database_request("statusdb"):
+                proj_obj = sdb.get_entry(self.projectname)
+            merger = fs.DictMerger(proj_obj.setdefault("staged_files", {}))
+            merger.merge(meta_info_dict).materialise()
+            if not merger.changed:
+                logger.info(
+                    "Metainfo for sample {} in project {} is up to date in StatusDB".format(
+                        self.sampleid, self.projectid
+                    )
+                )
+                return True
+            with metrics.database_request("statusdb"):
+                sdb.save_db_doc(proj_obj)
             logger.info(
                 "Updated metainfo for sample {} in project {} with id {} in StatusDB".format(
                     self.sampleid, self.projectid, proj_obj.get("_id")
@@ -392,6 +904,7 @@ class ProjectDeliverer(Deliverer):
     def __init__(self, projectid=None, sampleid=None, **kwargs):
         super(ProjectDeliverer, self).__init__(projectid, sampleid, **kwargs)
 
+    @timing.timed("charon")
     def all_samples_delivered(self, sampleentries=None):
         """Checks the delivery status of all project samples
 
@@ -411,24 +924,17 @@ class ProjectDeliverer(Deliverer):
             ]
         )
 
+    @timing.timed("report")
     def create_report(self):
         """Create a final aggregate report via a system call"""
-        logprefix = os.path.abspath(
-            self.expand_path(os.path.join(self.logpath, self.projectid))
+        logprefix = self.report_logprefix(self.projectid)
+        _run_report_command(
+            self.aggregate_report_command(),
+            self.expand_path(self.reportpath),
+            logprefix=None if logprefix is None else "{}_aggregate".format(logprefix),
         )
-        try:
-            if not create_folder(os.path.dirname(logprefix)):
-                logprefix = None
-        except AttributeError:
-            logprefix = None
-        with chdir(self.expand_path(self.reportpath)):
-            cl = self.report_aggregate.split(" ")
-            call_external_command(
-                cl,
-                with_log_files=(logprefix is not None),
-                prefix="{}_aggregate".format(logprefix),
-            )
 
+    @timing.timed("copy_report")
     def copy_report(self):
         """Copies the aggregate report and version reports files to a specified outbox directory.
         :returns: list of the paths to the files it has successfully copied (i.e. the targets)
@@ -496,6 +1002,7 @@ class ProjectDeliverer(Deliverer):
 
         return files_copied
 
+    @timing.timed("charon")
     def db_entry(self):
         """Fetch a database entry representing the instance's project
         :returns: a json-formatted database entry
@@ -504,6 +1011,7 @@ class ProjectDeliverer(Deliverer):
         """
         return db.project_entry(db.dbcon(), self.projectid)
 
+    @timing.reported
     def deliver_project(self):
         """Deliver all samples in a project to the destination specified by
         deliverypath
@@ -535,16 +1043,29 @@ class ProjectDeliverer(Deliverer):
             # right now, don't catch any errors since we're assuming any thrown
             # errors needs to be handled by manual intervention
             status = True
-            samples = [
-                sentry["sampleid"]
-                for sentry in db.project_sample_entries(db.dbcon(), self.projectid).get(
-                    "samples", []
-                )
-            ]
+            with self.timer.phase("charon"):
+                samples = [
+                    sentry["sampleid"]
+                    for sentry in db.project_sample_entries(
+                        db.dbcon(), self.projectid
+                    ).get("samples", [])
+                ]
             samples_to_deliver = len(samples)
             delivered_samples = 0
+            # the samples' file patterns mostly hit the same directories, so
+            # share the directory listings between the sample deliveries
+            listing_cache = fs.DirectoryListingCache()
+            # and the patterns, which are the same for all samples until expanded
+            self.compile_patterns()
             for sampleid in samples:
-                st = SampleDeliverer(self.projectid, sampleid).deliver_sample()
+                sd = SampleDeliverer(
+                    self.projectid,
+                    sampleid,
+                    listing_cache=listing_cache,
+                    patterns=self.patterns,
+                    parent_timer=self.timer,
+                )
+                st = sd.deliver_sample()
                 status = status and st
                 if st:
                     delivered_samples += 1
@@ -566,7 +1087,11 @@ class ProjectDeliverer(Deliverer):
             # Atleast one sample should have been staged/delivered for the following steps
             if os.path.exists(self.expand_path(self.stagingpath)):
                 # Try to deliver any miscellaneous files for the project (like reports, analysis)
-                ProjectMiscDeliverer(self.projectid).deliver_misc_data()
+                ProjectMiscDeliverer(
+                    self.projectid,
+                    listing_cache=listing_cache,
+                    parent_timer=self.timer,
+                ).deliver_misc_data()
             # query the database whether all samples in the project have been sucessfully delivered
             if self.all_samples_delivered():
                 # this is the only delivery status we want to set on the project level, in order to avoid concurrently
@@ -605,6 +1130,109 @@ class ProjectDeliverer(Deliverer):
         except (db.DatabaseError, DelivererInterruptedError, Exception):
             raise
 
+    def plan_delivery(self):
+        """Work out what a delivery of this project would do, without
+        staging, hashing or transferring anything. The files for each sample
+        that would be delivered are located and the time needed for staging
+        and transfer is estimated from the hash throughput, measured on the
+        largest file needing a checksum unless 'hash_throughput' (MB/s) is
+        configured, and the configured 'transfer_throughput' (MB/s).
+
+        :returns: a dict with the delivery plan
+        """
+        plan = {
+            "projectid": self.projectid,
+            "stage_only": self.stage_only,
+            "hash_algorithm": self.hash_algorithm,
+            "samples": {},
+            "skipped_samples": {},
+        }
+        planning_errors = (
+            fs.FileNotFoundException,
+            fs.PatternNotMatchedException,
+            fs.InvalidPatternException,
+            DelivererError,
+        )
+        listing_cache = fs.DirectoryListingCache()
+        self.compile_patterns()
+        summaries = []
+        sampleentries = db.project_sample_entries(db.dbcon(), self.projectid).get(
+            "samples", []
+        )
+        for sampleentry in sampleentries:
+            sd = SampleDeliverer(
+                self.projectid,
+                sampleentry["sampleid"],
+                listing_cache=listing_cache,
+                patterns=self.patterns,
+            )
+            reason = sd.check_deliverable(sampleentry)
+            if reason is not None:
+                plan["skipped_samples"][sd.sampleid] = reason
+                continue
+            try:
+                summary = sd.plan_files()
+            except planning_errors as e:
+                reason = "staging would fail: {}".format(e)
+                plan["skipped_samples"][sd.sampleid] = reason
+                continue
+            plan["samples"][sd.sampleid] = summary
+            summaries.append(summary)
+        if getattr(self, "misc_files_to_deliver", None) is not None:
+            misc = ProjectMiscDeliverer(self.projectid, listing_cache=listing_cache)
+            try:
+                plan["miscellaneous"] = misc.plan_files()
+                summaries.append(plan["miscellaneous"])
+            except planning_errors as e:
+                plan["miscellaneous"] = {"error": str(e)}
+        plan["totals"] = {
+            "samples": len(plan["samples"]),
+            "skipped_samples": len(plan["skipped_samples"]),
+        }
+        for key in ["files", "bytes", "bytes_to_hash"]:
+            plan["totals"][key] = sum(summary[key] for summary in summaries)
+        largest_to_hash = max(
+            [s["largest_file_to_hash"] for s in summaries if s["largest_file_to_hash"]],
+            key=lambda f: f["bytes"],
+            default=None,
+        )
+
+        hash_rate = getattr(self, "hash_throughput", None)
+        if hash_rate:
+            hash_rate = float(hash_rate) * 1024 * 1024
+        elif largest_to_hash is not None:
+            hash_rate = fs.measure_hash_throughput(
+                largest_to_hash["path"], hash_algorithm=self.hash_algorithm
+            )
+        transfer_rate = getattr(self, "transfer_throughput", None)
+        if transfer_rate:
+            transfer_rate = float(transfer_rate) * 1024 * 1024
+        plan["throughput"] = {
+            "hash_bytes_per_second": hash_rate,
+            "transfer_bytes_per_second": transfer_rate,
+        }
+        staging_seconds = (
+            plan["totals"]["bytes_to_hash"] / hash_rate
+            if hash_rate
+            else (0.0 if not plan["totals"]["bytes_to_hash"] else None)
+        )
+        transfer_seconds = 0.0
+        if not self.stage_only:
+            transfer_seconds = (
+                plan["totals"]["bytes"] / transfer_rate if transfer_rate else None
+            )
+        plan["estimate"] = {
+            "staging_seconds": staging_seconds,
+            "transfer_seconds": transfer_seconds,
+            "total_seconds": (
+                staging_seconds + transfer_seconds
+                if staging_seconds is not None and transfer_seconds is not None
+                else None
+            ),
+        }
+        return plan
+
+    @timing.timed("ena_tsv")
     def generate_ena_tsv_files(self):
         logger.info("Fetching information for ENA TSV generation")
         with open(os.getenv("STATUS_DB_CONFIG"), "r") as db_cred_file:
@@ -615,13 +1243,17 @@ class ProjectDeliverer(Deliverer):
                         LOG=logger,
                         outdir=self.expand_path("<ANALYSISPATH>/reports/"),
                         db_conf=db_conf,
+                        staged_files_db=getattr(self, "staged_files_db", None),
                     )
             tsv_file_path = tsvgen.generate_tsv_file()
-            tsvgen.validate_tsv_file(tsv_file_path)
+            tsvgen.validate_tsv_file(
+                tsv_file_path, max_errors=getattr(self, "ena_tsv_max_errors", None)
+            )
         except Exception as e:
             logger.warning(f"Generating ENA TSV files failed due to '{e}'")
         logger.info(f"Generated TSV files for project {self.projectid}")
 
+    @timing.timed("charon")
     def update_delivery_status(self, status="DELIVERED"):
         """Update the delivery_status field in the database to the supplied
         status for the project specified by this instance
@@ -632,6 +1264,33 @@ class ProjectDeliverer(Deliverer):
         return db.update_project(db.dbcon(), self.projectid, delivery_status=status)
 
 
+def generate_ena_tsv_files(deliverers):
+    """Generate the ENA TSV files of several projects in one pass, fetching
+    the projects from StatusDB with one request and generating the files of
+    the projects concurrently
+
+    :param deliverers: a list of ProjectDeliverer instances
+    :returns: a list with a dict summarizing the outcome for each project
+    """
+    logger.info(
+        "Fetching information for ENA TSV generation of {} projects".format(
+            len(deliverers)
+        )
+    )
+    with open(os.getenv("STATUS_DB_CONFIG"), "r") as db_cred_file:
+        db_conf = yaml.safe_load(db_cred_file)["statusdb"]
+    return generate_tsv_files(
+        [d.projectid for d in deliverers],
+        db_conf=db_conf,
+        outdir={
+            d.projectid: d.expand_path("<ANALYSISPATH>/reports/") for d in deliverers
+        },
+        LOG=logger,
+        max_errors=getattr(deliverers[0], "ena_tsv_max_errors", None),
+        staged_files_db=getattr(deliverers[0], "staged_files_db", None),
+    )
+
+
 class ProjectMiscDeliverer(Deliverer):
     """
     A class for handling meta data for projects
@@ -639,6 +1298,7 @@ class ProjectMiscDeliverer(Deliverer):
 
     def __init__(self, projectid=None, sampleid=None, **kwargs):
         super(ProjectMiscDeliverer, self).__init__(projectid, sampleid, **kwargs)
+        self.timer.name = "{} miscellaneous files".format(self.projectid)
         self.files_to_deliver = getattr(self, "misc_files_to_deliver", None)
 
     def staging_digestfile(self):
@@ -657,6 +1317,7 @@ class ProjectMiscDeliverer(Deliverer):
         """
         return self.expand_path(os.path.join(self.stagingpath, "miscellaneous.lst"))
 
+    @timing.reported
     def deliver_misc_data(self):
         if self.files_to_deliver == None:
             logger.info(
@@ -690,49 +1351,49 @@ class SampleDeliverer(Deliverer):
     def __init__(self, projectid=None, sampleid=None, **kwargs):
         super(SampleDeliverer, self).__init__(projectid, sampleid, **kwargs)
 
+    @timing.timed("report")
     def create_report(self):
         """Create a sample report and an aggregate report via a system call"""
-        logprefix = os.path.abspath(
-            self.expand_path(
-                os.path.join(
-                    self.logpath, "{}-{}".format(self.projectid, self.sampleid)
-                )
-            )
+        logprefix = self.report_logprefix("{}-{}".format(self.projectid, self.sampleid))
+        reportpath = self.expand_path(self.reportpath)
+        # create the ign_sample_report for this sample
+        cl = self.report_sample.split(" ")
+        cl.extend(["--samples", self.sampleid])
+        _run_report_command(
+            cl,
+            reportpath,
+            logprefix=None if logprefix is None else "{}_sample".format(logprefix),
         )
-        try:
-            if not create_folder(os.path.dirname(logprefix)):
-                logprefix = None
-        except AttributeError:
-            logprefix = None
-        with chdir(self.expand_path(self.reportpath)):
-            # create the ign_sample_report for this sample
-            cl = self.report_sample.split(" ")
-            cl.extend(["--samples", self.sampleid])
-            call_external_command(
-                cl,
-                with_log_files=(logprefix is not None),
-                prefix="{}_sample".format(logprefix),
-            )
-            # estimate the delivery date for this sample to 0.5 days ahead
-            cl = self.report_aggregate.split(" ")
-            cl.extend(
-                [
-                    "--samples_extra",
-                    json.dumps(
-                        {
-                            self.sampleid: {
-                                "delivered": "{}(expected)".format(_timestamp(days=0.5))
-                            }
-                        }
-                    ),
-                ]
-            )
-            call_external_command(
-                cl,
-                with_log_files=(logprefix is not None),
-                prefix="{}_aggregate".format(logprefix),
-            )
+        _run_report_command(
+            self.aggregate_report_command([self.sampleid]),
+            reportpath,
+            logprefix=None if logprefix is None else "{}_aggregate".format(logprefix),
+        )
+
+    def check_deliverable(self, sampleentry=None):
+        """Check, without updating the database, whether deliver_sample would
+        go ahead with delivering this sample
 
+        :params sampleentry: a database sample entry to use instead of
+            fetching from db
+        :returns: None if the sample would be delivered, otherwise a string
+            with the reason why it would be skipped
+        """
+        sampleentry = sampleentry or self.db_entry()
+        if self.get_analysis_status(sampleentry) != "ANALYZED":
+            if not self.force and not self.ignore_analysis_status:
+                return "analysis has not finished"
+        if self.get_delivery_status(sampleentry) == "DELIVERED" and not self.force:
+            return SAMPLE_DELIVERED
+        if self.get_delivery_status(sampleentry) == "IN_PROGRESS" and not self.force:
+            return "delivery already in progress"
+        if self.get_sample_status(sampleentry) == "ABORTED":
+            return SAMPLE_ABORTED
+        if self.get_sample_status(sampleentry) == "FRESH" and not self.force:
+            return "marked as FRESH"
+        return None
+
+    @timing.timed("charon")
     def db_entry(self):
         """Fetch a database entry representing the instance's project and sample
         :returns: a json-formatted database entry
@@ -741,6 +1402,7 @@ class SampleDeliverer(Deliverer):
         """
         return db.sample_entry(db.dbcon(), self.projectid, self.sampleid)
 
+    @timing.reported
     def deliver_sample(self, sampleentry=None):
         """Deliver a sample to the destination specified by the config.
         Will check if the sample has already been delivered and should not
@@ -768,33 +1430,9 @@ class SampleDeliverer(Deliverer):
             else:
                 logger.info("Staging {}".format(str(self)))
             try:
-                if self.get_analysis_status(sampleentry) != "ANALYZED":
-                    if not self.force and not self.ignore_analysis_status:
-                        logger.info(
-                            "{} has not finished analysis and will not be delivered".format(
-                                str(self)
-                            )
-                        )
-                        return False
-                if (
-                    self.get_delivery_status(sampleentry) == "DELIVERED"
-                    and not self.force
-                ):
-                    logger.info(
-                        "{} has already been delivered. Sample will not be delivered again this time.".format(
-                            str(self)
-                        )
-                    )
-                    return True
-                if (
-                    self.get_delivery_status(sampleentry) == "IN_PROGRESS"
-                    and not self.force
-                ):
-                    logger.info(
-                        "delivery of {} is already in progress".format(str(self))
-                    )
-                    return False
-                if self.get_sample_status(sampleentry) == "ABORTED":
+                sampleentry = sampleentry or self.db_entry()
+                reason = self.check_deliverable(sampleentry)
+                if reason == SAMPLE_ABORTED:
                     logger.info(
                         "{} has been marked as ABORTED and will not be delivered".format(
                             str(self)
@@ -806,13 +1444,12 @@ class SampleDeliverer(Deliverer):
                         self.update_delivery_status(status="NOT_DELIVERED")
                     # otherwhise leave it empty. Return True as an aborted sample should not fail a delivery
                     return True
-                if self.get_sample_status(sampleentry) == "FRESH" and not self.force:
+                if reason is not None:
                     logger.info(
-                        "{} is marked as FRESH (new unprocessed data is available) and will not be delivered".format(
-                            str(self)
-                        )
+                        "{} will not be delivered, {}".format(str(self), reason)
                     )
-                    return False
+                    # an already delivered sample does not fail the delivery
+                    return reason == SAMPLE_DELIVERED
                 if self.get_delivery_status(sampleentry) == "FAILED":
                     logger.info(
                         "retrying delivery of previously failed sample {}".format(
@@ -829,20 +1466,19 @@ class SampleDeliverer(Deliverer):
             # set the delivery status to in_progress which will also mean that any concurrent deliveries
             # will leave this sample alone
             self.update_delivery_status(status="IN_PROGRESS")
-            # an error with the reports should not abort the delivery, so handle
+            # the reports are generated while the delivery is staged, an error
+            # with the reports should not abort the delivery
             try:
                 if self.report_sample and self.report_aggregate:
                     logger.info("creating sample reports")
-                    self.create_report()
+                    self.start_report()
             except AttributeError:
                 pass
-            except Exception as e:
-                logger.warning(
-                    "failed to create reports for {}, reason: {}".format(self, e)
-                )
-            # stage the delivery
+            # stage the delivery, the staging waits for the reports before
+            # looking for any files created by them
             if not self.stage_delivery():
                 raise DelivererError("sample was not properly staged")
+            self.wait_for_reports()
             logger.info("{} successfully staged".format(str(self)))
             if not self.stage_only:
                 # perform the delivery
@@ -853,18 +1489,23 @@ class SampleDeliverer(Deliverer):
                 self.update_delivery_status()
                 # write a delivery acknowledgement to disk
                 self.acknowledge_delivery()
+                metrics.SAMPLES.inc(status="delivered")
             else:
                 self.update_delivery_status(status="STAGED")
+                metrics.SAMPLES.inc(status="staged")
                 # Try aggregate meta info for staged sample and update in appropriate DB
                 self.aggregate_meta_info()
             return True
         except DelivererInterruptedError:
+            metrics.SAMPLES.inc(status="failed")
             self.update_delivery_status(status="NOT_DELIVERED")
             raise
         except Exception:
+            metrics.SAMPLES.inc(status="failed")
             self.update_delivery_status(status="FAILED")
             raise
 
+    @timing.timed("charon")
     def update_delivery_status(self, status="DELIVERED"):
         """Update the delivery_status field in the database to the supplied
         status for the project and sample specified by this instance
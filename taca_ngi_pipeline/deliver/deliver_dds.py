@@ -10,18 +10,38 @@ import subprocess
 import sys
 import re
 import datetime
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from ngi_pipeline.database.classes import CharonSession
 from taca.utils.filesystem import create_folder
 from taca.utils.config import CONFIG
 from taca.utils.statusdb import StatusdbSession, ProjectSummaryConnection
 
 from .deliver import ProjectDeliverer, SampleDeliverer, DelivererInterruptedError
+from . import timing
 from ..utils.database import DatabaseError
+from ..utils import filesystem as fs
+from ..utils import metrics
 
 logger = logging.getLogger(__name__)
 
 
+def _folder_size(folder):
+    """
+    :returns: the total size in bytes of the files below a folder, following
+        symlinks
+    """
+    nbytes = 0
+    for dirpath, _, filenames in os.walk(folder, followlinks=True):
+        for fname in filenames:
+            try:
+                nbytes += os.path.getsize(os.path.join(dirpath, fname))
+            except OSError:
+                pass
+    return nbytes
+
+
 def proceed_or_not(question):
     yes = set(["yes", "y", "ye"])
     no = set(["no", "n"])
@@ -87,6 +107,7 @@ class DDSProjectDeliverer(ProjectDeliverer):
             return "PARTIAL"  # The project underwent a delivery, but not for all the samples
         return "NOT_DELIVERED"  # The project is not delivered
 
+    @timing.reported
     def release_DDS_delivery_project(self, dds_project, no_dds_mail, dds_deadline=45):
         """Update charon when data upload is finished and release DDS project to user.
         For this to work on runfolder deliveries, update the delivery status in Charon maually.
@@ -103,7 +124,9 @@ class DDSProjectDeliverer(ProjectDeliverer):
         question = "About to release project {} in DDS delivery project {} to user. Continue? ".format(
             self.projectid, dds_project
         )
-        if proceed_or_not(question):
+        with self.timer.phase("prompt"):
+            proceed = proceed_or_not(question)
+        if proceed:
             logger.info("Releasing DDS project {} to user".format(dds_project))
         else:
             logger.error("{} delivery has been aborted.".format(str(self)))
@@ -124,7 +147,8 @@ class DDSProjectDeliverer(ProjectDeliverer):
             ]
             if no_dds_mail:
                 cmd.append("--no-mail")
-            process_handle = subprocess.run(cmd)
+            with self.timer.phase("dds_release"):
+                process_handle = subprocess.run(cmd)
             process_handle.check_returncode()
             logger.info(
                 "Project {} succefully delivered. Delivery project is {}.".format(
@@ -145,8 +169,9 @@ class DDSProjectDeliverer(ProjectDeliverer):
             )
             for sample_id in in_progress_samples:
                 try:
-                    sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
-                    sample_deliverer.update_delivery_status(status=delivery_status)
+                    with self.timer.phase("charon"):
+                        sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
+                        sample_deliverer.update_delivery_status(status=delivery_status)
                 except Exception as e:
                     logger.exception(
                         "Sample {}: Problems in setting sample status on charon.".format(
@@ -159,10 +184,13 @@ class DDSProjectDeliverer(ProjectDeliverer):
             all_samples_delivered = True
             for sample_id in self.get_samples_from_charon(delivery_status=None):
                 try:
-                    sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
-                    if sample_deliverer.get_sample_status() == "ABORTED":
+                    with self.timer.phase("charon"):
+                        sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
+                        sample_status = sample_deliverer.get_sample_status()
+                        sample_delivery_status = sample_deliverer.get_delivery_status()
+                    if sample_status == "ABORTED":
                         continue
-                    if sample_deliverer.get_delivery_status() != "DELIVERED":
+                    if sample_delivery_status != "DELIVERED":
                         all_samples_delivered = False
                 except Exception as e:
                     logger.exception(
@@ -173,6 +201,7 @@ class DDSProjectDeliverer(ProjectDeliverer):
             if all_samples_delivered:
                 self.update_delivery_status(status=delivery_status)
 
+    @timing.reported
     def deliver_project(self):
         """Deliver all samples in a project with DDS
 
@@ -200,7 +229,9 @@ class DDSProjectDeliverer(ProjectDeliverer):
                 "{} has already been partially delivered. "
                 "Please confirm you want to proceed.".format(str(self))
             )
-            if proceed_or_not("Do you want to proceed (yes/no): "):
+            with self.timer.phase("prompt"):
+                proceed = proceed_or_not("Do you want to proceed (yes/no): ")
+            if proceed:
                 logger.info(
                     "{} has already been partially delivered. "
                     "User confirmed to proceed.".format(str(self))
@@ -239,7 +270,9 @@ class DDSProjectDeliverer(ProjectDeliverer):
             len(samples_to_deliver),
             ", ".join(misc_to_deliver),
         )
-        if proceed_or_not(question):
+        with self.timer.phase("prompt"):
+            proceed = proceed_or_not(question)
+        if proceed:
             logger.info("Proceeding with delivery of {}".format(str(self)))
         else:
             logger.error(
@@ -266,8 +299,9 @@ class DDSProjectDeliverer(ProjectDeliverer):
         samples_in_progress = []
         for sample_id in samples_to_deliver:
             try:
-                sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
-                sample_deliverer.update_sample_status()
+                with self.timer.phase("charon"):
+                    sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
+                    sample_deliverer.update_sample_status()
             except Exception as e:
                 logger.exception(
                     "Sample status for {} has not been updated in Charon.".format(
@@ -304,11 +338,12 @@ class DDSProjectDeliverer(ProjectDeliverer):
             )
             for sample_id in samples_to_deliver:
                 try:
-                    sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
-                    sample_deliverer.save_delivery_token_in_charon(delivery_status)
-                    sample_deliverer.add_dds_name_delivery_in_charon(
-                        dds_name_of_delivery
-                    )
+                    with self.timer.phase("charon"):
+                        sample_deliverer = DDSSampleDeliverer(self.projectid, sample_id)
+                        sample_deliverer.save_delivery_token_in_charon(delivery_status)
+                        sample_deliverer.add_dds_name_delivery_in_charon(
+                            dds_name_of_delivery
+                        )
                 except Exception as e:
                     logger.exception(
                         "Failed in saving sample information for sample {}".format(
@@ -325,20 +360,64 @@ class DDSProjectDeliverer(ProjectDeliverer):
 
         return status
 
+    @timing.reported
     def deliver_run_folder(self):
-        """Symlink run folders to stage path, create DDS delivery project and upload data."""
+        """Verify the run folder archives against their checksums, symlink the
+        verified ones to the stage path, create a DDS delivery project and
+        upload the data. The archives are verified for up to
+        'runfolder_workers' flowcells at a time. Flowcells with missing or
+        corrupt archives are skipped.
+
+        The staging folder is uploaded with a single `dds data put`, unless
+        'runfolder_upload_workers' is more than 1, in which case the flowcells
+        are uploaded that many at a time with one `dds data put` each.
+
+        :returns: True if all flowcells were uploaded, False otherwise
+        """
         # Stage the data
         dst = self.expand_path(self.stagingpath)
         path_to_data = self.expand_path(self.datapath)
+        workers = max(
+            1, min(len(self.fcid), int(getattr(self, "runfolder_workers", 4)))
+        )
 
         status = True
         create_folder(dst)
-        for fcid in self.fcid:
+        with self.timer.phase("verify"):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                verified = dict(
+                    zip(
+                        self.fcid,
+                        executor.map(
+                            lambda fcid: self._verify_run_folder(path_to_data, fcid),
+                            self.fcid,
+                        ),
+                    )
+                )
+        corrupt = [fcid for fcid in self.fcid if not verified[fcid]]
+        if corrupt:
+            logger.error(
+                "The run folder archives for flowcells {} are missing or do not "
+                "match their checksums and will not be delivered".format(
+                    ", ".join(corrupt)
+                )
+            )
+            status = False
+        flowcells = [fcid for fcid in self.fcid if verified[fcid]]
+        if not flowcells:
+            logger.error(
+                "No run folder archives to deliver for project {}".format(
+                    self.projectid
+                )
+            )
+            return False
+        for fcid in flowcells:
             runfolder_archive = os.path.join(path_to_data, fcid + ".tar")
             runfolder_md5file = runfolder_archive + ".md5"
             try:
-                os.symlink(runfolder_archive, os.path.join(dst, fcid + ".tar"))
-                os.symlink(runfolder_md5file, os.path.join(dst, fcid + ".tar.md5"))
+                with self.timer.phase("symlink"):
+                    os.symlink(runfolder_archive, os.path.join(dst, fcid + ".tar"))
+                    os.symlink(runfolder_md5file, os.path.join(dst, fcid + ".tar.md5"))
                 logger.info(
                     "Symlinking files {} and {} to {}".format(
                         runfolder_archive, runfolder_md5file, dst
@@ -363,46 +442,122 @@ class DDSProjectDeliverer(ProjectDeliverer):
             logger.exception("Unable to detect DDS delivery project.")
             raise e
 
-        # Upload with DDS
-        dds_delivery_status = self.upload_data(delivery_id)
+        # Upload with DDS, the whole staging folder at once unless several
+        # uploads into the delivery project at a time are enabled
+        upload_workers = max(
+            1,
+            min(len(flowcells), int(getattr(self, "runfolder_upload_workers", 1))),
+        )
+        if upload_workers == 1:
+            uploads = [(", ".join(flowcells), {})]
+        else:
+            uploads = [
+                (
+                    fcid,
+                    dict(
+                        sources=[
+                            os.path.join(dst, fcid + ".tar"),
+                            os.path.join(dst, fcid + ".tar.md5"),
+                        ],
+                        mount_dir=os.path.join(self.dds_log_dir(), fcid),
+                        label=fcid,
+                    ),
+                )
+                for fcid in flowcells
+            ]
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            uploads = [
+                (fcids, executor.submit(self.upload_data, delivery_id, **kwargs))
+                for fcids, kwargs in uploads
+            ]
+        upload_error = None
+        for fcids, upload in uploads:
+            try:
+                dds_delivery_status = upload.result()
+            except subprocess.CalledProcessError as e:
+                upload_error = upload_error or e
+                dds_delivery_status = None
+            if dds_delivery_status:
+                logger.info(
+                    "DDS upload of flowcells {} for project {} to delivery project "
+                    "{} was sucessful".format(fcids, self.projectid, delivery_id)
+                )
+            else:
+                logger.error(
+                    "Something when wrong when uploading flowcells {} of {} to DDS "
+                    "project {}".format(fcids, self.projectid, delivery_id)
+                )
+                status = False
+        if upload_error is not None:
+            raise upload_error
+        return status
 
-        if dds_delivery_status:
-            logger.info(
-                "DDS upload for project {} to delivery project {} was sucessful".format(
-                    self.projectid, delivery_id
+    def _verify_run_folder(self, path_to_data, fcid):
+        """Verify the run folder archive of a flowcell against its md5 file,
+        logging the progress
+        :returns: True if the archive matches its checksum, False otherwise
+        """
+        runfolder_archive = os.path.join(path_to_data, fcid + ".tar")
+        logged = [0]
+
+        def _progress(nbytes, total):
+            # log every tenth of the archive
+            tenths = nbytes * 10 // total if total else 10
+            if tenths > logged[0]:
+                logged[0] = tenths
+                logger.info(
+                    "Verified {}% of {} ({:.1f} of {:.1f} GB)".format(
+                        tenths * 10, runfolder_archive, nbytes / 1e9, total / 1e9
+                    )
                 )
-            )
-        else:
+
+        try:
+            return fs.verify_checksum(
+                runfolder_archive,
+                runfolder_archive + ".md5",
+                hash_algorithm="md5",
+                progress=_progress,
+                blocksize=self.hash_blocksize,
+                tree_workers=self.tree_digest_workers,
+                integrity_algorithm=self.integrity_algorithm,
+            )
+        except fs.FileNotFoundException as e:
             logger.error(
-                "Something when wrong when uploading {} to DDS project {}".format(
-                    self.projectid, delivery_id
+                "Unable to verify the run folder archive for flowcell {}: {}".format(
+                    fcid, e
                 )
             )
-            status = False
-        return status
+            return False
 
+    @timing.timed("charon")
     def save_delivery_token_in_charon(self, delivery_token):
         """Updates delivery_token in Charon at project level"""
         charon_session = CharonSession()
-        charon_session.project_update(self.projectid, delivery_token=delivery_token)
+        with metrics.database_request("charon"):
+            charon_session.project_update(self.projectid, delivery_token=delivery_token)
 
+    @timing.timed("charon")
     def delete_delivery_token_in_charon(self):
         """Removes delivery_token from Charon upon successful delivery"""
         charon_session = CharonSession()
-        charon_session.project_update(self.projectid, delivery_token="NO-TOKEN")
+        with metrics.database_request("charon"):
+            charon_session.project_update(self.projectid, delivery_token="NO-TOKEN")
 
+    @timing.timed("charon")
     def add_dds_name_delivery_in_charon(self, name_of_delivery):
         """Updates delivery_projects in Charon at project level"""
         charon_session = CharonSession()
         try:
             # fetch the project
-            project_charon = charon_session.project_get(self.projectid)
+            with metrics.database_request("charon"):
+                project_charon = charon_session.project_get(self.projectid)
             delivery_projects = project_charon["delivery_projects"]
             if name_of_delivery not in delivery_projects:
                 delivery_projects.append(name_of_delivery)
-                charon_session.project_update(
-                    self.projectid, delivery_projects=delivery_projects
-                )
+                with metrics.database_request("charon"):
+                    charon_session.project_update(
+                        self.projectid, delivery_projects=delivery_projects
+                    )
                 logger.info(
                     "Charon delivery_projects for project {} "
                     "updated with value {}".format(self.projectid, name_of_delivery)
@@ -420,13 +575,15 @@ class DDSProjectDeliverer(ProjectDeliverer):
                 "delivering {}.".format(self.projectid)
             )
 
+    @timing.timed("statusdb")
     def add_dds_name_delivery_in_statusdb(self, name_of_delivery):
         """Updates delivery_projects in StatusDB at project level"""
         save_meta_info = getattr(self, "save_meta_info", False)
         if not save_meta_info:
             return
         status_db = ProjectSummaryConnection(self.config_statusdb)
-        project_page = status_db.get_entry(self.projectid, use_id_view=True)
+        with metrics.database_request("statusdb"):
+            project_page = status_db.get_entry(self.projectid, use_id_view=True)
         delivery_projects = []
         if "delivery_projects" in project_page:
             delivery_projects = project_page["delivery_projects"]
@@ -435,7 +592,8 @@ class DDSProjectDeliverer(ProjectDeliverer):
 
         project_page["delivery_projects"] = delivery_projects
         try:
-            status_db.save_db_doc(project_page)
+            with metrics.database_request("statusdb"):
+                status_db.save_db_doc(project_page)
             logger.info(
                 "Delivery_projects for project {} updated with value {} in statusdb".format(
                     self.projectid, name_of_delivery
@@ -448,47 +606,78 @@ class DDSProjectDeliverer(ProjectDeliverer):
                 )
             )
 
-    def upload_data(self, name_of_delivery):
-        """Upload staged sample data with DDS"""
-        stage_dir = self.expand_path(self.stagingpath)
+    def dds_log_dir(self):
+        """
+        :returns: the folder for the DDS logs of this project
+        """
         log_dir = os.path.join(
             os.path.dirname(CONFIG.get("log").get("file")), "DDS_logs"
         )
-        project_log_dir = os.path.join(log_dir, self.projectid)
+        return os.path.join(log_dir, self.projectid)
+
+    @timing.timed("dds_upload")
+    def upload_data(self, name_of_delivery, sources=None, mount_dir=None, label=None):
+        """Upload staged sample data with DDS
+
+        :param list sources: the files to upload, instead of the whole staging
+            folder. They are put with the name of the staging folder as
+            destination
+        :param string mount_dir: the folder for the logs of this upload, it
+            must not be shared with concurrent uploads. Defaults to the DDS
+            log folder of the project
+        :param string label: if given, the echoed dds output is prefixed with it
+        """
+        stage_dir = self.expand_path(self.stagingpath)
         cmd = [
             "dds",
             "--no-prompt",
             "data",
             "put",
             "--mount-dir",
-            project_log_dir,
+            mount_dir or self.dds_log_dir(),
             "--project",
             name_of_delivery,
-            "--source",
-            stage_dir,
         ]
+        if sources is None:
+            cmd.extend(["--source", stage_dir])
+        else:
+            for source in sources:
+                cmd.extend(["--source", source])
+            cmd.extend(["--destination", os.path.basename(stage_dir.rstrip(os.sep))])
+        start = time.time()
         try:
             output = ""
             for line in self._execute(cmd):
                 output += line
-                print(line, end="")
+                if label is None:
+                    print(line, end="")
+                else:
+                    print("[{}] {}".format(label, line), end="")
         except subprocess.CalledProcessError as e:
             logger.exception(
                 "DDS upload failed while uploading {} to {}".format(
-                    stage_dir, name_of_delivery
+                    stage_dir if sources is None else ", ".join(sources),
+                    name_of_delivery,
                 )
             )
             raise e
         if "Upload completed!" in output:
             delivery_status = "uploaded"
+            if sources is None:
+                nbytes = _folder_size(stage_dir)
+            else:
+                nbytes = sum(os.path.getsize(source) for source in sources)
+            metrics.observe_transfer("dds", nbytes, time.time() - start)
         else:
             delivery_status = None
         return delivery_status
 
+    @timing.timed("charon")
     def get_samples_from_charon(self, delivery_status="STAGED"):
         """Takes as input a delivery status and return all samples with that delivery status"""
         charon_session = CharonSession()
-        result = charon_session.project_get_samples(self.projectid)
+        with metrics.database_request("charon"):
+            result = charon_session.project_get_samples(self.projectid)
         samples = result.get("samples")
         if samples is None:
             raise AssertionError(
@@ -504,6 +693,7 @@ class DDSProjectDeliverer(ProjectDeliverer):
                 samples_of_interest.append(sample_id)
         return samples_of_interest
 
+    @timing.timed("dds_create")
     def _create_delivery_project(self):
         """Create a DDS delivery project and return the ID"""
         create_project_cmd = [
@@ -634,15 +824,17 @@ class DDSProjectDeliverer(ProjectDeliverer):
                 )
             )
 
+    @timing.timed("order_portal")
     def _get_order_detail(self):
         """Fetch order details from order portal"""
         status_db = StatusdbSession(self.config_statusdb)
-        rows = status_db.connection.post_view(
-            db="projects",
-            ddoc="order_portal",
-            view="ProjectID_to_PortalID",
-            key=self.projectid,
-        ).get_result()["rows"]
+        with metrics.database_request("statusdb"):
+            rows = status_db.connection.post_view(
+                db="projects",
+                ddoc="order_portal",
+                view="ProjectID_to_PortalID",
+                key=self.projectid,
+            ).get_result()["rows"]
         if len(rows) < 1:
             raise AssertionError(
                 "Project {} not found in StatusDB".format(self.projectid)
@@ -715,22 +907,27 @@ class DDSSampleDeliverer(SampleDeliverer):
     def save_delivery_token_in_charon(self, delivery_token):
         """Updates delivery_token in Charon at sample level"""
         charon_session = CharonSession()
-        charon_session.sample_update(
-            self.projectid, self.sampleid, delivery_token=delivery_token
-        )
+        with metrics.database_request("charon"):
+            charon_session.sample_update(
+                self.projectid, self.sampleid, delivery_token=delivery_token
+            )
 
     def add_dds_name_delivery_in_charon(self, name_of_delivery):
         """Updates delivery_projects in Charon at project level"""
         charon_session = CharonSession()
         try:
             # Fetch the project
-            sample_charon = charon_session.sample_get(self.projectid, self.sampleid)
+            with metrics.database_request("charon"):
+                sample_charon = charon_session.sample_get(self.projectid, self.sampleid)
             delivery_projects = sample_charon["delivery_projects"]
             if name_of_delivery not in sample_charon:
                 delivery_projects.append(name_of_delivery)
-                charon_session.sample_update(
-                    self.projectid, self.sampleid, delivery_projects=delivery_projects
-                )
+                with metrics.database_request("charon"):
+                    charon_session.sample_update(
+                        self.projectid,
+                        self.sampleid,
+                        delivery_projects=delivery_projects,
+                    )
                 logger.info(
                     "Charon delivery_projects for sample {} updated "
                     "with value {}".format(self.sampleid, name_of_delivery)
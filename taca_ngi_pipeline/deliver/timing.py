@@ -0,0 +1,157 @@
+"""
+Timing of the phases of a delivery
+"""
+
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import threading
+import time
+
+from io import open
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer(object):
+    """Accumulates the wall time spent in named phases of a delivery, like
+    'charon', 'report', 'hash' or 'transfer'. Phases can be timed from several
+    threads at once, so phases that run concurrently, like the globbing and
+    hashing of the staging pipeline, can add up to more than the total time.
+
+    A timer can be given a parent timer, e.g. the timer of the project
+    delivery for the timers of its sample deliveries, and will then be
+    included in the parent's trace.
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.phases = {}
+        self.children = []
+        self.started = datetime.datetime.now()
+        self.seconds = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        if parent is not None:
+            parent.add_child(self)
+
+    def add_child(self, timer):
+        with self._lock:
+            self.children.append(timer)
+
+    def add(self, phase, seconds, count=1):
+        """Add time spent in a phase
+        :param string phase: name of the phase
+        :param float seconds: the time spent
+        :param int count: the number of times the phase was entered
+        """
+        with self._lock:
+            timed = self.phases.setdefault(phase, {"seconds": 0.0, "count": 0})
+            timed["seconds"] += seconds
+            timed["count"] += count
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Context manager timing the enclosed block as a phase"""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def stop(self):
+        """Stop the timer, setting the total time"""
+        self.seconds = time.perf_counter() - self._start
+        return self.seconds
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "started": self.started.isoformat(),
+                "seconds": self.seconds,
+                "phases": {k: dict(v) for k, v in self.phases.items()},
+                "children": [child.as_dict() for child in self.children],
+            }
+
+    def summary(self):
+        """
+        :returns: a one-line breakdown of the time spent, with the phases
+            taking the most time first
+        """
+        with self._lock:
+            phases = sorted(
+                self.phases.items(), key=lambda p: p[1]["seconds"], reverse=True
+            )
+        return "{}: {:.2f}s total{}".format(
+            self.name,
+            self.seconds or 0.0,
+            "".join(
+                ", {} {:.2f}s ({}x)".format(name, p["seconds"], p["count"])
+                for name, p in phases
+            ),
+        )
+
+    def write_trace(self, tracefile):
+        """Write the timing, including the timing of the children, as json"""
+        with open(tracefile, "w") as fh:
+            fh.write(json.dumps(self.as_dict(), indent=2))
+
+
+def timed(phase):
+    """Decorator timing a Deliverer method as a phase, using the timer of
+    the instance if it has one
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            timer = getattr(self, "timer", None)
+            if timer is None:
+                return fn(self, *args, **kwargs)
+            with timer.phase(phase):
+                return fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def reported(fn):
+    """Decorator for the Deliverer methods running a whole delivery. Once the
+    method returns, the time breakdown is logged and, unless the timer is
+    part of an enclosing delivery, written as a json trace to the path
+    returned by the `timing_tracefile` method of the instance.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        timer = getattr(self, "timer", None)
+        if timer is None:
+            return fn(self, *args, **kwargs)
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            timer.stop()
+            logger.info("Time spent delivering {}".format(timer.summary()))
+            if timer.parent is None:
+                try:
+                    tracefile = self.timing_tracefile()
+                    if tracefile is not None:
+                        timer.write_trace(tracefile)
+                        logger.info(
+                            "Timing trace for {} written to {}".format(
+                                timer.name, tracefile
+                            )
+                        )
+                except (AttributeError, IOError, OSError) as e:
+                    logger.warning(
+                        "could not write timing trace for {}, reason: {}".format(
+                            timer.name, e
+                        )
+                    )
+
+    return wrapper
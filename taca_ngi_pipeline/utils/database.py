@@ -2,6 +2,8 @@ __author__ = "Pontus"
 
 from ngi_pipeline.database import classes as db
 
+from . import metrics
+
 
 class DatabaseError(Exception):
     pass
@@ -16,7 +18,8 @@ def _wrap_database_query(query_fn, *query_args, **query_kwargs):
         if an error occurred when communicating with the database
     """
     try:
-        return query_fn(*query_args, **query_kwargs)
+        with metrics.database_request("charon"):
+            return query_fn(*query_args, **query_kwargs)
     except db.CharonError as ce:
         raise DatabaseError(ce)
 
@@ -1,18 +1,38 @@
 #!/usr/bin/env python
 
 import argparse
+import bisect
+from collections import Counter
+import contextlib
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from datetime import date
+import hashlib
+import itertools
+import json
+import multiprocessing
+import tempfile
+import requests
 import yaml
-from taca.utils.statusdb import (
-    ProjectSummaryConnection,
-    GenericFlowcellRunConnection,
-)
+from taca.utils.statusdb import ProjectSummaryConnection
 import os
 import re
 import logging
 import csv
 from scilifelab_metadata_templates.genomics import validate_genomics_data
 
+from taca_ngi_pipeline.utils.staged_files import read_staged_files
+
+try:
+    from ibm_cloud_sdk_core import ApiException
+except ImportError:
+    # the client taca connects to StatusDB with raises these on HTTP errors
+    ApiException = requests.exceptions.HTTPError
+
 template = {
    "study_alias": "", #Optional
    "sample_alias": "", #Optional
@@ -39,6 +59,32 @@ template = {
    "template_version": "0.0.1" # Version of the scilifelab_metadata_templates template used to generate the metadata file
 }
 
+# the path of a FASTQ file, e.g. ABC123/P12345_1001_S1_L001_R1_001.fastq.gz,
+# split into the path without the read type, the read type (R1-R3 or the
+# I1/I2 index reads) and the file set
+FASTQ_NAME_PATTERN = re.compile(
+    r"^(?P<stem>.+)_(?P<read>[RI][1-9])(?P<set>_\d{3})?\.fastq\.gz$"
+)
+
+# the TSV files are validated in chunks of rows, in parallel
+VALIDATION_CHUNK_ROWS = 5000
+# the validation errors logged one by one, the others are only counted
+VALIDATION_LOGGED_ERRORS = 20
+
+
+def validation_pool(workers=None):
+    """Create a pool of worker processes to validate TSV files in. The workers
+    are spawned rather than forked, since forking a process with other
+    threads running, e.g. generating other files, can deadlock the workers.
+    The pool can be shared by the validations of several files.
+
+    :param workers: the number of processes, the number of CPUs if None
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
 class tsv_generator(object):
     """
     A class with class methods to generate run/experiment TSV files
@@ -49,27 +95,47 @@ class tsv_generator(object):
         self,
         project,
         outdir=os.getcwd(),
-        flowcells=None,
         LOG=None,
         db_conf=None,
+        projdb_conn=None,
+        incremental=True,
+        staged_files_db=None,
     ):
-        """Instantiate required objects"""
+        """Instantiate required objects
+
+        :param project: the project id, or the project document if already
+            fetched from StatusDB
+        :param projdb_conn: a ProjectSummaryConnection to use instead of
+            connecting to StatusDB
+        :param incremental: keep the state of the generated file next to it,
+            so that only the rows of changed samples are validated again
+        :param staged_files_db: the database with the staged files of each
+            sample, for the samples not in the staged_files of the project
+        """
         self.LOG = LOG
+        self.incremental = incremental
+        self.db_conf = db_conf
         try:
-            self.projdb_conn = ProjectSummaryConnection(db_conf)
-            self.fc_con = GenericFlowcellRunConnection(db_conf)
+            self.projdb_conn = projdb_conn
+            if self.projdb_conn is None and (
+                isinstance(project, str) or staged_files_db
+            ):
+                self.projdb_conn = ProjectSummaryConnection(db_conf)
             self._check_and_load_project(project)
             assert isinstance(self.project_doc, dict), (
                 f"Could not get proper project document for {project} from StatusDB"
             )
             self.staged_files = self.project_doc.get("staged_files", {})
+            if staged_files_db:
+                self.staged_files = read_staged_files(
+                    self.projdb_conn.connection,
+                    staged_files_db,
+                    self.project_doc["project_id"],
+                    inline=self.staged_files,
+                )
             assert self.staged_files, (
                 f"No staged samples for project {project}, cannot generate TSV files"
             )
-            self._check_and_load_flowcells(flowcells)
-            assert isinstance(self.flowcells, dict), (
-                f"Could not get the flowcells for project {self.project_doc['project_id']} from StatusDB"
-            )
         except AssertionError as e:
             self.LOG.error(e)
             raise e
@@ -80,7 +146,8 @@ class tsv_generator(object):
         self._load_staged_files()
 
     def _check_and_load_project(self, project):
-        """Get the project document from couchDB"""
+        """Get the project document from couchDB if not already given"""
+        project_doc = project
         if isinstance(project, str):
             self.LOG.info(f"Fetching project '{project}' from statusDB")
             project_doc = self.projdb_conn.get_entry(
@@ -88,24 +155,6 @@ class tsv_generator(object):
             )
         self.project_doc = project_doc
 
-    def _check_and_load_flowcells(self, flowcells):
-        """Get the project's flowcells if not already given"""
-        if not flowcells or not isinstance(flowcells, dict):
-            self.LOG.info(
-                f"Fetching flowcells sequenced for project '{self.project_doc['project_id']}' from StatusDB"
-            )
-            flowcells = {}
-            # get flowcells for project
-            for db in ["x_flowcells", "nanopore_runs", "element_runs"]:
-                flowcells.update(
-                    self.fc_con.get_project_flowcell(
-                        self.project_doc["project_id"],
-                        self.project_doc.get("open_date", "2015-01-01"),
-                        dbname=db,
-                    )
-                )
-        self.flowcells = flowcells
-
     def _check_and_load_outdir(self, outdir):
         """Check the given outdir and see if its valid one"""
         if not os.path.exists(outdir):
@@ -135,6 +184,7 @@ class tsv_generator(object):
         self.common_details["metadata_file_creation_date"] = str(date.today())
         self.common_details["template_name"] = "genomics_template"
         self.common_details["template_version"] = template["template_version"]
+        self.fieldnames = list(template)
 
         proj_details = self.project_doc.get("details", {})
         # get library construction method and parse neccesary information
@@ -166,9 +216,8 @@ class tsv_generator(object):
             if read1 > 0:
                 if read2 > 0:
                     self.common_details["library_layout"] = "PAIRED"
-                    # Add reverse file name and md5 keys to the template for paired end data
-                    template["reverse_file_name"] = ""
-                    template["reverse_file_md5"] = ""
+                    # Add reverse file name and md5 columns for paired end data
+                    self.fieldnames += ["reverse_file_name", "reverse_file_md5"]
                 else:
                     self.common_details["library_layout"] = "SINGLE"
             else:
@@ -183,71 +232,455 @@ class tsv_generator(object):
             self.common_details["library_layout"] = "UNKNOWN"
 
     def _load_staged_files(self):
-        """Load the staged files for the project and check if they are in expected format"""
+        """Load the staged FASTQ files of the project and pair their reads.
 
+        The files are indexed in one pass by their path without the read type,
+        i.e. by sample, flowcell, lane and file set. The first read is the
+        forward read and, for paired end data, R3 or else R2 the reverse read,
+        since R2 holds the UMIs when there are three reads. Index reads are
+        not submitted.
+        """
+        paired = self.common_details["library_layout"] == "PAIRED"
+        reads_by_set = {}
         for sample, files in self.staged_files.items():
             for file_name, file_stats in files.items():
-                if file_name.endswith("fastq.gz"):
-                    fastq_name = (
-                        file_name.split("/")[-1]
-                        .replace(".fastq.gz", "")
-                        .replace("_R1_", "_")
-                        .replace("_R2_", "_")
-                    )
-                    if fastq_name not in self.file_pairs_delivered:
-                        self.file_pairs_delivered[fastq_name] = {
-                            "file_type": "fastq",
-                            "file_name": "",
-                            "file_md5": "",
-                            "experimental_sample_id": sample,
-                            "library_name": sample,
-                            "associated_sample_id": self.samples[sample].get(
-                                "customer_name", ""
-                            ),
-                        }
-                        if self.common_details["library_layout"] == "PAIRED":
-                            self.file_pairs_delivered[fastq_name][
-                                "reverse_file_name"
-                            ] = ""
-                            self.file_pairs_delivered[fastq_name][
-                                "reverse_file_md5"
-                            ] = ""
-                    if "_R1_" in file_name:
-                        self.file_pairs_delivered[fastq_name]["file_name"] = file_name
-                        self.file_pairs_delivered[fastq_name]["file_md5"] = (
-                            file_stats.get("md5_sum", "")
-                        )
-                    elif "_R2_" in file_name:
-                        self.file_pairs_delivered[fastq_name]["reverse_file_name"] = (
-                            file_name
-                        )
-                        self.file_pairs_delivered[fastq_name]["reverse_file_md5"] = (
-                            file_stats.get("md5_sum", "")
-                        )
+                match = FASTQ_NAME_PATTERN.match(file_name)
+                if match is not None:
+                    stem, read, fileset = match.group("stem", "read", "set")
+                    fastq_name = stem + (fileset or "")
+                elif file_name.endswith(".fastq.gz"):
+                    # a file without read type is a single end read
+                    fastq_name, read = file_name[: -len(".fastq.gz")], "R1"
+                else:
+                    continue
+                reads = reads_by_set.setdefault(fastq_name, (sample, {}))[1]
+                reads[read] = (file_name, file_stats.get("md5_sum", ""))
+
+        for fastq_name, (sample, reads) in reads_by_set.items():
+            if "R1" not in reads:
+                self.LOG.warning(
+                    f"No forward read found for {fastq_name}, skipping {', '.join(sorted(reads))}"
+                )
+                continue
+            file_pair = {
+                "file_type": "fastq",
+                "experimental_sample_id": sample,
+                "library_name": sample,
+                "associated_sample_id": self.samples[sample].get("customer_name", ""),
+            }
+            file_pair["file_name"], file_pair["file_md5"] = reads["R1"]
+            if paired:
+                file_pair["reverse_file_name"], file_pair["reverse_file_md5"] = (
+                    reads.get("R3") or reads.get("R2") or ("", "")
+                )
+            self.file_pairs_delivered[fastq_name] = file_pair
 
     def generate_tsv_file(self):
-        """Generate TSV file from the string template"""
+        """Generate TSV file from the string template. If the rows are the same
+        as when the file was last validated, the file is left as it is.
+
+        Only the validation is incremental: the rows of all samples are built
+        from the whole project document and the file is rewritten as soon as
+        one sample changed, since that is linear in the number of files and
+        the document cannot be fetched per sample. The state keeps a digest of
+        the rows of each sample, not the revision of the document.
+        """
         tsv_file_path = os.path.join(
             self.outdir, f"{self.project_doc['project_id']}_submission.tsv"
         )
-        with open(tsv_file_path, "w", newline="") as tsvfile:
-            writer = csv.DictWriter(tsvfile, fieldnames=template.keys(), delimiter="\t")
+        self.tsv_file_path = tsv_file_path
+        # the rows of each sample, as a range of the rows of the file
+        self.sample_rows = {}
+        self.sample_digests = {}
+        rows_by_sample = {}
+        for file_pair in self.file_pairs_delivered.values():
+            rows_by_sample.setdefault(file_pair["experimental_sample_id"], []).append(
+                file_pair
+            )
+        n_rows = 0
+        for sample, rows in rows_by_sample.items():
+            self.sample_rows[sample] = (n_rows, n_rows + len(rows))
+            self.sample_digests[sample] = hashlib.md5(
+                json.dumps(rows, sort_keys=True).encode()
+            ).hexdigest()
+            n_rows += len(rows)
+
+        state = self._read_state(tsv_file_path)
+        if state is not None and [
+            (sample, previous["digest"])
+            for sample, previous in state["samples"].items()
+        ] == list(self.sample_digests.items()):
+            self.LOG.info(f"TSV file at {tsv_file_path} is up to date")
+            return tsv_file_path
+        # write to a temporary file first, not to leave a partial file
+        # matching the state of a previous run
+        tmp_path = f"{tsv_file_path}.tmp"
+        with open(tmp_path, "w", newline="") as tsvfile:
+            writer = csv.DictWriter(tsvfile, fieldnames=self.fieldnames, delimiter="\t")
             writer.writeheader()
-            for file_pair in self.file_pairs_delivered.values():
-                row = {**self.common_details, **file_pair}
-                writer.writerow(row)
+            for rows in rows_by_sample.values():
+                for file_pair in rows:
+                    writer.writerow({**self.common_details, **file_pair})
+        os.replace(tmp_path, tsv_file_path)
         self.LOG.info(f"Generated TSV file at {tsv_file_path}")
         return tsv_file_path
 
-    def validate_tsv_file(self, tsv_file_path):
-        """Validate the generated TSV file against the genomics schema"""
-        validation_errors = validate_genomics_data(tsv_file_path, None)
-        if validation_errors:
-            self.LOG.error("Validation errors found in the generated TSV file:")
-            for error in validation_errors:
-                self.LOG.error(f"Row {error['row']}: {error['message']}")
-        else:
+    def _state_file(self, tsv_file_path):
+        return f"{tsv_file_path}.state.json"
+
+    def _state_key(self):
+        """What the rows of all samples depend on, the creation date aside"""
+        return {
+            "fieldnames": self.fieldnames,
+            "common_details": {
+                key: value
+                for key, value in self.common_details.items()
+                if key != "metadata_file_creation_date"
+            },
+        }
+
+    def _read_state(self, tsv_file_path):
+        """Read the state of the TSV file when it was last validated
+        :returns: a dict with the digest of the rows and the validation errors
+            of each sample, or None if there is no usable state
+        """
+        if not self.incremental or not os.path.exists(tsv_file_path):
+            return None
+        try:
+            with open(self._state_file(tsv_file_path)) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if state.get("key") != self._state_key():
+            return None
+        return state
+
+    def _write_state(self, tsv_file_path, validation_errors):
+        """Save the digest of the rows and the validation errors of each
+        sample, with the rows of the errors counted from the first row of the
+        sample"""
+        samples = {
+            sample: {"digest": digest, "errors": []}
+            for sample, digest in self.sample_digests.items()
+        }
+        # the samples are in the order of their rows
+        first_rows = [first_row for first_row, _ in self.sample_rows.values()]
+        sample_names = list(self.sample_rows)
+        for error in validation_errors:
+            # the errors are numbered from 1 for the first row of the file
+            i = bisect.bisect_right(first_rows, error["row"] - 1) - 1
+            samples[sample_names[i]]["errors"].append(
+                {**error, "row": error["row"] - first_rows[i]}
+            )
+        state_file = self._state_file(tsv_file_path)
+        with open(f"{state_file}.tmp", "w") as fh:
+            json.dump({"key": self._state_key(), "samples": samples}, fh)
+        os.replace(f"{state_file}.tmp", state_file)
+
+    def validate_tsv_file(
+        self,
+        tsv_file_path,
+        max_errors=None,
+        chunk_size=VALIDATION_CHUNK_ROWS,
+        workers=None,
+        executor=None,
+    ):
+        """Validate the generated TSV file against the genomics schema. The
+        file is read in chunks of rows, which are validated in a pool of
+        worker processes unless the file fits in one chunk. Only the rows of
+        the samples that changed since the file was last validated are
+        validated again.
+
+        :param max_errors: stop validating once this many errors are found
+        :param workers: the number of worker processes, or of chunks to
+            validate at a time in `executor`
+        :param executor: a pool from `validation_pool` to validate the chunks
+            in, instead of creating one for this file
+        :returns: a list of the validation errors, sorted by row
+        """
+        validation_errors = []
+        rows = None
+        sample_rows = {}
+        if tsv_file_path == getattr(self, "tsv_file_path", None):
+            sample_rows = self.sample_rows
+        state = self._read_state(tsv_file_path) if sample_rows else None
+        if state is not None:
+            rows = set()
+            for sample, (first_row, last_row) in sample_rows.items():
+                previous = state["samples"].get(sample)
+                if previous and previous["digest"] == self.sample_digests[sample]:
+                    validation_errors.extend(
+                        {**error, "row": error["row"] + first_row}
+                        for error in previous["errors"]
+                    )
+                else:
+                    rows.update(range(first_row, last_row))
+            self.LOG.info(
+                f"Validating the {len(rows)} rows of {tsv_file_path} that changed "
+                "since it was last validated"
+            )
+        if rows != set() and not (max_errors and len(validation_errors) >= max_errors):
+            validation_errors.extend(
+                _validate_tsv_rows(
+                    tsv_file_path,
+                    rows,
+                    max_errors and max_errors - len(validation_errors),
+                    chunk_size,
+                    workers,
+                    executor,
+                )
+            )
+        validation_errors.sort(key=lambda error: error.get("row", 0))
+        if max_errors and len(validation_errors) >= max_errors:
+            validation_errors = validation_errors[:max_errors]
+            self.LOG.error(
+                f"Stopped validating {tsv_file_path} after {max_errors} errors"
+            )
+        elif (
+            self.incremental
+            and sample_rows
+            and all(isinstance(error.get("row"), int) for error in validation_errors)
+        ):
+            self._write_state(tsv_file_path, validation_errors)
+        self._log_validation_errors(validation_errors)
+        return validation_errors
+
+    def _log_validation_errors(self, validation_errors):
+        """Log the first validation errors and the number of errors of each type"""
+        if not validation_errors:
             self.LOG.info("No validation errors found in the generated TSV file.")
+            return
+        self.LOG.error("Validation errors found in the generated TSV file:")
+        for error in validation_errors[:VALIDATION_LOGGED_ERRORS]:
+            self.LOG.error(f"Row {error.get('row')}: {error.get('message')}")
+        if len(validation_errors) > VALIDATION_LOGGED_ERRORS:
+            self.LOG.error(
+                f"... and {len(validation_errors) - VALIDATION_LOGGED_ERRORS} more errors"
+            )
+            for error_type, count in Counter(
+                _validation_error_type(error) for error in validation_errors
+            ).most_common():
+                self.LOG.error(f"{count} rows: {error_type}")
+
+
+def _validate_tsv_rows(
+    tsv_file_path, rows, max_errors, chunk_size, workers, executor=None
+):
+    """Validate the given rows of a TSV file, or all rows if None, in chunks
+    :returns: a list of the validation errors
+    """
+    validation_errors = []
+    with tempfile.TemporaryDirectory() as chunk_dir:
+        chunks = _tsv_chunks(tsv_file_path, chunk_size, chunk_dir, rows)
+        first_chunks = list(itertools.islice(chunks, 2))
+        if len(first_chunks) < 2:
+            for chunk in first_chunks:
+                validation_errors.extend(_validate_tsv_chunk(*chunk))
+            return validation_errors
+        workers = workers or os.cpu_count() or 1
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(validation_pool(workers))
+            pending = set()
+            for chunk in itertools.chain(first_chunks, chunks):
+                if max_errors and len(validation_errors) >= max_errors:
+                    # the chunks not yet validated are left out
+                    for future in pending:
+                        future.cancel()
+                    break
+                pending.add(executor.submit(_validate_tsv_chunk, *chunk))
+                # only keep a few chunks in memory at a time
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        validation_errors.extend(future.result())
+            for future in pending:
+                if not future.cancelled():
+                    validation_errors.extend(future.result())
+    return validation_errors
+
+
+def _tsv_chunks(tsv_file_path, chunk_size, chunk_dir, rows=None):
+    """Split a TSV file into files of up to `chunk_size` consecutive rows in
+    `chunk_dir`, each with the header of the file
+
+    :param rows: the indexes of the rows to include, all rows if None
+    :yields: tuples with the path of each chunk and the number of rows
+        before it
+    """
+    with open(tsv_file_path, newline="") as fh:
+        reader = csv.reader(fh, delimiter="\t")
+        header = next(reader, None)
+        chunk, rows_before = [], 0
+        for n, row in enumerate(reader):
+            if rows is not None and n not in rows:
+                continue
+            if chunk and (len(chunk) == chunk_size or rows_before + len(chunk) != n):
+                yield _write_tsv_chunk(chunk_dir, header, chunk, rows_before)
+                chunk = []
+            if not chunk:
+                rows_before = n
+            chunk.append(row)
+        if chunk:
+            yield _write_tsv_chunk(chunk_dir, header, chunk, rows_before)
+
+
+def _write_tsv_chunk(chunk_dir, header, rows, rows_before):
+    chunk_file = os.path.join(chunk_dir, f"rows_{rows_before}.tsv")
+    with open(chunk_file, "w", newline="") as chunk:
+        writer = csv.writer(chunk, delimiter="\t")
+        writer.writerow(header)
+        writer.writerows(rows)
+    return chunk_file, rows_before
+
+
+def _validate_tsv_chunk(chunk_file, rows_before):
+    """Validate a chunk of a TSV file, in a worker process
+    :returns: the validation errors, with the rows numbered as in the whole file
+    """
+    try:
+        validation_errors = validate_genomics_data(chunk_file, None) or []
+    finally:
+        os.remove(chunk_file)
+    for error in validation_errors:
+        if isinstance(error.get("row"), int):
+            error["row"] += rows_before
+    return validation_errors
+
+
+def _validation_error_type(error):
+    """The message of a validation error without the offending values, which
+    are quoted in the messages"""
+    return error.get("type") or re.sub(r"'[^']*'", "'...'", error.get("message", ""))
+
+
+def fetch_project_docs(projdb_conn, projects, LOG):
+    """Fetch the documents of several projects from StatusDB with one bulk
+    request to _all_docs, falling back to one request per project if the
+    connection does not support it or the bulk request fails
+
+    :returns: a dict with the project documents by project id, the projects
+        that could not be found are left out
+    """
+    try:
+        doc_ids = {
+            pid: projdb_conn.id_view[pid]
+            for pid in projects
+            if pid in projdb_conn.id_view
+        }
+        rows = (
+            projdb_conn.connection.post_all_docs(
+                db=projdb_conn.dbname, keys=list(doc_ids.values()), include_docs=True
+            )
+            .get_result()
+            .get("rows", [])
+        )
+        docs = {row["id"]: row["doc"] for row in rows if row.get("doc")}
+        project_docs = {
+            pid: docs[doc_id] for pid, doc_id in doc_ids.items() if doc_id in docs
+        }
+        LOG.info(f"Fetched {len(project_docs)} projects in one bulk request")
+        return project_docs
+    except (
+        AttributeError,
+        TypeError,
+        KeyError,
+        ApiException,
+        requests.exceptions.RequestException,
+    ) as e:
+        LOG.warning(
+            "Could not fetch the projects in bulk, fetching one at a time: "
+            f"{type(e).__name__}: {e}"
+        )
+    project_docs = {}
+    for pid in projects:
+        project_doc = projdb_conn.get_entry(pid, use_id_view=True, db="projects")
+        if project_doc:
+            project_docs[pid] = project_doc
+    LOG.info(f"Fetched {len(project_docs)} projects one at a time")
+    return project_docs
+
+
+def generate_tsv_files(
+    projects,
+    db_conf=None,
+    outdir=os.getcwd(),
+    LOG=None,
+    workers=4,
+    max_errors=None,
+    incremental=True,
+    staged_files_db=None,
+):
+    """Generate and validate the TSV files of several projects in one pass.
+    The project documents are fetched with one bulk request and the files of
+    up to `workers` projects are generated at a time, sharing the one
+    connection to StatusDB and one pool of processes validating the files.
+
+    :param projects: a list of project ids
+    :param outdir: the output directory, or a dict with the output directory
+        of each project
+    :param max_errors: stop validating a file once this many errors are found
+    :param incremental: only validate the rows of the samples that changed
+        since the files were last validated
+    :param staged_files_db: the database with the staged files of each sample
+    :returns: a list with a dict summarizing the outcome for each project
+    """
+    projdb_conn = ProjectSummaryConnection(db_conf)
+    LOG.info(f"Fetching {len(projects)} projects from statusDB")
+    project_docs = fetch_project_docs(projdb_conn, projects, LOG)
+
+    def _generate(pid):
+        summary = {
+            "project": pid,
+            "tsv_file": "",
+            "rows": 0,
+            "validation_errors": 0,
+            "error": "",
+        }
+        project_outdir = (
+            outdir.get(pid, os.getcwd()) if isinstance(outdir, dict) else outdir
+        )
+        try:
+            assert pid in project_docs, f"Could not find project {pid} in StatusDB"
+            tsvgen = tsv_generator(
+                project_docs[pid],
+                outdir=project_outdir,
+                LOG=LOG,
+                db_conf=db_conf,
+                projdb_conn=projdb_conn,
+                incremental=incremental,
+                staged_files_db=staged_files_db,
+            )
+            summary["tsv_file"] = tsvgen.generate_tsv_file()
+            summary["rows"] = len(tsvgen.file_pairs_delivered)
+            summary["validation_errors"] = len(
+                tsvgen.validate_tsv_file(
+                    summary["tsv_file"], max_errors=max_errors, executor=pool
+                )
+            )
+        except Exception as e:
+            LOG.error(f"Generating the TSV file for {pid} failed due to '{e}'")
+            summary["error"] = str(e)
+        return summary
+
+    # the files are generated in threads and validated in one pool of worker
+    # processes shared by all projects
+    with validation_pool() as pool, ThreadPoolExecutor(max_workers=workers) as executor:
+        summaries = list(executor.map(_generate, projects))
+    return summaries
+
+
+def write_summary(summaries, fh):
+    """Write the outcome of generating the TSV files of several projects
+    as TSV to the given file handle"""
+    writer = csv.DictWriter(
+        fh,
+        fieldnames=["project", "tsv_file", "rows", "validation_errors", "error"],
+        delimiter="\t",
+        lineterminator="\n",
+    )
+    writer.writeheader()
+    writer.writerows(summaries)
 
 
 if __name__ == "__main__":
@@ -255,8 +688,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "project",
         type=str,
+        nargs="+",
         metavar="<project id>",
-        help="NGI project id for which TSV files are to be generated",
+        help="NGI project ids for which TSV files are to be generated",
     )
     parser.add_argument(
         "--outdir",
@@ -270,18 +704,47 @@ if __name__ == "__main__":
         default=os.getenv("STATUS_DB_CONFIG"),
         help="Path to the statusdb configuration file",
     )
+    parser.add_argument(
+        "--max_errors",
+        type=int,
+        default=None,
+        help="Stop validating a TSV file once this many errors are found",
+    )
+    parser.add_argument(
+        "--staged_files_db",
+        type=str,
+        default=None,
+        help="StatusDB database with the staged files of each sample, if not kept in the project documents",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Regenerate and validate the whole TSV files, even for the samples that did not change",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of projects to generate TSV files for at a time",
+    )
     kwargs = vars(parser.parse_args())
     LOG = logging.getLogger("ena_tsv_generator")
-    LOG.info(f"Generating TSV files for project {kwargs['project']}")
+    LOG.info(f"Generating TSV files for projects {', '.join(kwargs['project'])}")
     with open(kwargs["db_conf_path"], "r") as db_cred_file:
         db_conf = yaml.safe_load(db_cred_file)["statusdb"]
 
-    tsvgen = tsv_generator(
+    summaries = generate_tsv_files(
         kwargs["project"],
-        LOG=LOG,
-        outdir=kwargs["outdir"],
         db_conf=db_conf,
+        outdir=kwargs["outdir"],
+        LOG=LOG,
+        workers=kwargs["workers"],
+        max_errors=kwargs["max_errors"],
+        incremental=not kwargs["full"],
+        staged_files_db=kwargs["staged_files_db"],
     )
-    tsv_file_path = tsvgen.generate_tsv_file()
-    tsvgen.validate_tsv_file(tsv_file_path)
-    LOG.info(f"Generated TSV files for project {kwargs['project']}")
+    os.makedirs(kwargs["outdir"], exist_ok=True)
+    summary_file = os.path.join(kwargs["outdir"], "ena_tsv_summary.tsv")
+    with open(summary_file, "w", newline="") as fh:
+        write_summary(summaries, fh)
+    LOG.info(f"Generated TSV files for projects, see the summary in {summary_file}")
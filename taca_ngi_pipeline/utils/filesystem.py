@@ -1,14 +1,50 @@
 __author__ = "Pontus"
 
-from glob import iglob
+from glob import iglob, has_magic
 from logging import getLogger
 from os import path, walk, sep as os_sep
-from taca.utils.misc import hashfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from . import metrics
 from io import open
+import fnmatch
+import hashlib
+import json
+import os
+import queue
+import re
 import six
+import threading
+import time
+import zlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logger = getLogger(__name__)
 
+# the maximum number of items allowed in flight between two staging stages
+DEFAULT_QUEUE_SIZE = 64
+# the number of bytes read at a time when computing checksums
+DEFAULT_HASH_BLOCKSIZE = 8 * 1024 * 1024
+# the number of bytes hashed between dropping the hashed pages of a file from
+# the page cache
+DROP_CACHE_BYTES = 256 * 1024 * 1024
+# the size of the blocks of a tree digest and the suffix of the files they
+# are cached in, see TreeHasher
+TREE_BLOCKSIZE = 64 * 1024 * 1024
+TREE_SUFFIX = ".b2tree"
+# the algorithm of the integrity digests, i.e. the tree digests, which are
+# only used internally and not delivered, see integrity_hasher
+DEFAULT_INTEGRITY_ALGORITHM = "blake2b"
+# the suffixes of the gzip compressed files, BAM files being compressed with
+# BGZF, which is a series of gzip members
+GZIP_SUFFIXES = (".gz", ".bgz", ".bam")
+# the maximum number of bytes decompressed at a time when checking a gzip file
+GZIP_CHECK_OUTPUT_SIZE = 16 * 1024 * 1024
+
 # Handle hashfile output in both python versions
 try:
     unicode
@@ -24,7 +60,431 @@ class PatternNotMatchedException(Exception):
     pass
 
 
-def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
+class InvalidPatternException(Exception):
+    pass
+
+
+class CorruptFileException(Exception):
+    pass
+
+
+class ChecksumMismatchException(Exception):
+    pass
+
+
+class DeliveryPattern(object):
+    """An entry in the 'files_to_deliver' config, compiled into the source
+    path pattern, the destination path and the per-pattern options
+    """
+
+    # the options that can be given in the third element of an entry
+    OPTIONS = ("required", "no_digest", "no_digest_cache", "report")
+
+    def __init__(
+        self,
+        source,
+        destination,
+        required=False,
+        no_digest=False,
+        no_digest_cache=False,
+        report=False,
+    ):
+        self.source = source
+        self.destination = destination
+        self.required = required
+        self.no_digest = no_digest
+        self.no_digest_cache = no_digest_cache
+        # the matching files are created by the report commands
+        self.report = report
+        self.is_glob = has_magic(source)
+
+    def __repr__(self):
+        return "DeliveryPattern({!r}, {!r}, {})".format(
+            self.source, self.destination, self.options()
+        )
+
+    @classmethod
+    def compile(cls, pattern):
+        """Compile an entry in 'files_to_deliver', which should be a list
+        with a source path pattern, a destination path and optionally a
+        dict with options
+
+        :param pattern: the entry to compile, a DeliveryPattern is returned
+            as is
+        :returns: a DeliveryPattern instance
+        :raises InvalidPatternException: if the entry is malformed. Unknown
+            options are logged and ignored, so that configs with options
+            for other versions still work
+        """
+        if isinstance(pattern, cls):
+            return pattern
+        if not isinstance(pattern, (list, tuple)) or len(pattern) not in (2, 3):
+            raise InvalidPatternException(
+                "pattern {} should be a list with a source path, a destination "
+                "path and optionally a dict with options".format(pattern)
+            )
+        if not all(isinstance(p, six.string_types) for p in pattern[0:2]):
+            raise InvalidPatternException(
+                "source and destination paths in pattern {} should be strings".format(
+                    pattern
+                )
+            )
+        extra = pattern[2] if len(pattern) > 2 else {}
+        if not isinstance(extra, dict):
+            raise InvalidPatternException(
+                "options in pattern {} should be a dict".format(pattern)
+            )
+        unknown = [k for k in extra if k not in cls.OPTIONS]
+        if unknown:
+            logger.warning(
+                "ignoring unknown options {} in pattern {}, expected any of {}".format(
+                    ", ".join(map(str, unknown)), pattern, ", ".join(cls.OPTIONS)
+                )
+            )
+        return cls(
+            pattern[0],
+            pattern[1],
+            **{k: v for k, v in extra.items() if k in cls.OPTIONS},
+        )
+
+    def expand(self, expand_fn):
+        """Create a copy of this pattern with placeholders in the source
+        and destination paths expanded
+
+        :param expand_fn: a function taking a path and returning the path
+            with placeholders expanded
+        :returns: a new DeliveryPattern instance
+        """
+        return DeliveryPattern(
+            expand_fn(self.source), expand_fn(self.destination), **self.options()
+        )
+
+    def options(self):
+        """:returns: the options of this pattern as a dict"""
+        return {option: getattr(self, option) for option in self.OPTIONS}
+
+
+def compile_patterns(patterns):
+    """Compile the entries in a 'files_to_deliver' config
+
+    :param patterns: a list of entries to compile, or None. Entries that are
+        already DeliveryPattern instances are passed through as they are
+    :returns: a list of DeliveryPattern instances
+    :raises InvalidPatternException: if any of the entries is malformed
+    """
+    return [DeliveryPattern.compile(pattern) for pattern in patterns or []]
+
+
+def check_required_patterns(
+    patterns, hash_algorithm="md5", listing_cache=None, skip_reports=False
+):
+    """Do a fast pass over the required patterns, checking that they match
+    at least one existing path. Only the globs are expanded, folders are not
+    traversed and no checksums are computed, so a delivery that would fail
+    on a missing file fails before any time is spent on hashing.
+
+    :param patterns: a list of DeliveryPattern instances
+    :param bool skip_reports: if True, patterns for files created by the
+        report commands are not checked, since the reports may still be
+        being generated
+    :raises PatternNotMatchedException: if a required pattern does not
+        match anything
+    :raises FileNotFoundException: if a required pattern matches a path
+        that does not exist, e.g. a broken symlink
+    """
+    expand_glob = listing_cache.iglob if listing_cache is not None else iglob
+    for pattern in patterns:
+        if not pattern.required or (skip_reports and pattern.report):
+            continue
+        matches = 0
+        for spath in expand_glob(pattern.source):
+            if _is_checksum_file(spath, hash_algorithm):
+                continue
+            matches += 1
+            if not path.exists(spath):
+                msg = "path {} does not exist, possibly because of a broken symlink".format(
+                    spath
+                )
+                logger.error(msg)
+                raise FileNotFoundException(msg)
+        if matches == 0:
+            msg = "no files matching search expression '{}' found ".format(
+                pattern.source
+            )
+            logger.error(msg)
+            raise PatternNotMatchedException(msg)
+
+
+class DirectoryListingCache(object):
+    """A cache of directory listings, meant to be shared by the deliveries
+    of all samples in a project. Patterns that only differ by sample id will
+    typically hit the same directories, which with the cache are listed once
+    with `os.scandir` instead of once per sample. The patterns are matched
+    against the cached listings with precompiled regular expressions, with
+    the same semantics as `glob.iglob`.
+
+    A cached listing is only used as long as the modification time of the
+    directory is unchanged, so files created in a directory after it was
+    listed, e.g. reports, will be picked up. Like git does for its index,
+    a listing taken less than `racy_seconds` after the directory was modified
+    is not trusted, since a file created within the timestamp granularity
+    would not change the modification time.
+    """
+
+    def __init__(self, racy_seconds=2.0):
+        self.racy_seconds = racy_seconds
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def listdir(self, dirpath, dironly=False):
+        """List the entries in a directory, using the cached listing if
+        the directory has not been modified since it was listed
+
+        :param string dirpath: the directory to list
+        :param bool dironly: if True, only list entries that are directories
+        :returns: a list of entry names, empty if the directory could not be
+            listed
+        """
+        try:
+            mtime = os.stat(dirpath or os.curdir).st_mtime
+        except OSError:
+            return []
+        with self._lock:
+            cached = self._listings.get(dirpath)
+        if cached is None or cached[0] != mtime:
+            listed_at = time.time()
+            try:
+                with os.scandir(dirpath or os.curdir) as it:
+                    entries = [(entry.name, _is_dir(entry)) for entry in it]
+            except OSError:
+                return []
+            cached = (mtime, entries)
+            if listed_at - mtime > self.racy_seconds:
+                with self._lock:
+                    self._listings[dirpath] = cached
+        return [name for name, is_dir in cached[1] if is_dir or not dironly]
+
+    def iglob(self, pattern):
+        """Return an iterator of the paths matching a pattern, like
+        `glob.iglob` but with the directories listed through the cache
+        """
+        return self._iglob(pattern, False)
+
+    def _iglob(self, pattern, dironly):
+        dirname, basename = path.split(pattern)
+        if not has_magic(pattern):
+            if (dironly and path.isdir(pattern)) or (
+                not dironly and path.lexists(pattern)
+            ):
+                yield pattern
+            return
+        if dirname != pattern and has_magic(dirname):
+            dirs = self._iglob(dirname, True)
+        else:
+            dirs = [dirname]
+        for currdir in dirs:
+            if has_magic(basename):
+                names = self.listdir(currdir, dironly)
+                if not _is_hidden(basename):
+                    names = [name for name in names if not _is_hidden(name)]
+                match = _compile_glob(basename)
+                names = [name for name in names if match(name)]
+            elif basename:
+                names = [basename] if path.lexists(path.join(currdir, basename)) else []
+            else:
+                names = [basename] if path.isdir(currdir) else []
+            for name in names:
+                yield path.join(currdir, name)
+
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def _is_hidden(name):
+    return name[0] == "."
+
+
+@lru_cache(maxsize=1024)
+def _compile_glob(pattern):
+    """Translate a glob pattern into a compiled regular expression, the
+    compiled expressions are cached so each pattern is only compiled once
+    :returns: the match method of the compiled regular expression
+    """
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+# marker put on a stage queue by the feeding thread when its input is exhausted
+_STAGE_DONE = object()
+# the checksum returned by gather_files for files whose checksum is computed
+# later, when they are transferred
+DEFERRED_DIGEST = object()
+
+
+def run_stage(items, fn, workers=1, queue_size=DEFAULT_QUEUE_SIZE):
+    """Apply a function to each item of an iterable on a pool of worker
+    threads, yielding the results in the order of the input.
+
+    The input is consumed by a separate feeding thread which hands the items
+    to the workers through a bounded queue. When the consumer falls behind,
+    the queue fills up and the feeding thread blocks, so at most `queue_size`
+    items are in flight regardless of how many items the input produces.
+    Stages can be chained by passing the generator returned from one stage
+    as the input to the next one.
+
+    Exceptions raised by `fn` or by the input iterable are re-raised in the
+    consumer at the position where they occurred.
+
+    :param items: an iterable with the items to process
+    :param fn: the function to apply to each item
+    :param int workers: the number of worker threads to apply `fn` on
+    :param int queue_size: the maximum number of items in flight
+    :returns: a generator of the results of `fn`
+    """
+    pending = queue.Queue(maxsize=max(1, queue_size))
+    stopped = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def _put(item):
+        # block on a full queue, but give up if the consumer has gone away
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed():
+        try:
+            for item in items:
+                if not _put(executor.submit(fn, item)):
+                    break
+            else:
+                _put(_STAGE_DONE)
+        except Exception as e:
+            _put(e)
+        finally:
+            # let an upstream stage know that its output is no longer needed
+            if hasattr(items, "close"):
+                items.close()
+
+    feeder = threading.Thread(target=_feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is _STAGE_DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item.result()
+    finally:
+        stopped.set()
+        while True:
+            try:
+                pending.get_nowait().cancel()
+            except queue.Empty:
+                break
+            except AttributeError:
+                pass
+        executor.shutdown(wait=False)
+
+
+def _walk_files(currpath, destpath):
+    # if current path is a folder, return all files below it
+    if path.isdir(currpath):
+        parent = path.dirname(currpath)
+        for parentdir, _, dirfiles in walk(currpath, followlinks=True):
+            for currfile in dirfiles:
+                fullpath = path.join(parentdir, currfile)
+                # the relative path will be used in the destination path
+                relpath = path.relpath(fullpath, parent)
+                yield (fullpath, path.join(destpath, relpath))
+    else:
+        yield (currpath, path.join(destpath, path.basename(currpath)))
+
+
+def _is_checksum_file(spath, hash_algorithm):
+    return spath.endswith((".{}".format(hash_algorithm), TREE_SUFFIX))
+
+
+def _expand_patterns(
+    patterns, hash_algorithm, listing_cache=None, wait_for_reports=None
+):
+    expand_glob = listing_cache.iglob if listing_cache is not None else iglob
+    for pattern in patterns:
+        # the report files are only looked for once the reports are done
+        if pattern.report and wait_for_reports is not None:
+            wait_for_reports()
+            wait_for_reports = None
+        matches = 0
+        for f in expand_glob(pattern.source):
+            for spath, dpath in _walk_files(f, pattern.destination):
+                # ignore checksum files
+                if not _is_checksum_file(spath, hash_algorithm):
+                    matches += 1
+                    yield spath, dpath, pattern
+        if matches == 0:
+            msg = "no files matching search expression '{}' found ".format(
+                pattern.source
+            )
+            if pattern.required:
+                logger.error(msg)
+                raise PatternNotMatchedException(msg)
+            logger.warning(msg)
+
+
+def _timed_iter(items, timer, phase):
+    """Iterate over a generator, adding the time spent producing the items to
+    a phase of the timer
+    """
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                timer.add(phase, time.perf_counter() - start, count=0)
+                return
+            timer.add(phase, time.perf_counter() - start)
+            yield item
+    finally:
+        items.close()
+
+
+def _check_exists(item):
+    spath, _, pattern = item
+    # skip and warn if a path does not exist, this includes broken symlinks
+    if path.exists(spath):
+        return item
+    # if the file pattern requires a match, throw an error. otherwise warn
+    msg = "path {} does not exist, possibly because of a broken symlink".format(spath)
+    if pattern.required:
+        logger.error(msg)
+        raise FileNotFoundException(msg)
+    logger.warning(msg)
+
+
+def gather_files(
+    patterns,
+    no_checksum=False,
+    hash_algorithm="md5",
+    hash_workers=1,
+    hash_blocksize=DEFAULT_HASH_BLOCKSIZE,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    listing_cache=None,
+    timer=None,
+    wait_for_reports=None,
+    defer_digest=False,
+    tree_digest=False,
+    integrity_algorithm=DEFAULT_INTEGRITY_ALGORITHM,
+    check_gzip=False,
+):
     """This method will locate files matching the patterns specified in
     the config and compute the checksum and construct the staging path
     according to the config.
@@ -35,6 +495,53 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
     folder or file. File globs will be expanded and folders will be
     traversed to include everything beneath.
 
+    The patterns are compiled and the required ones are checked to match
+    existing paths before anything else is done, see
+    `check_required_patterns`.
+
+    The work is done by a pipeline of stages connected by bounded queues:
+    the patterns are expanded and folders walked in one stage, the matched
+    paths are checked for existence in the next and the checksums are
+    computed by `hash_workers` threads in the last one. This way, the
+    directory traversal keeps going while the checksums are computed and
+    the memory used stays bounded, however many files a pattern expands to.
+    The order of the returned tuples is the same as for a sequential
+    traversal.
+
+    Files created by reports that are generated while the files are gathered
+    should be matched by patterns with the 'report' option. When the first
+    of these patterns is reached, `wait_for_reports` is called to block until
+    the reports are done, while the files already found are still being
+    hashed.
+
+    :param patterns: a list of DeliveryPattern instances or 'files_to_deliver'
+        entries
+    :param int hash_workers: the number of threads computing checksums
+    :param int hash_blocksize: the number of bytes read at a time when
+        computing checksums, see `stream_digest`
+    :param int queue_size: the maximum number of paths in flight between
+        two stages
+    :param DirectoryListingCache listing_cache: if given, file globs are
+        expanded against the cached directory listings
+    :param timer: if given, the time spent expanding the patterns and
+        computing checksums is added to the 'glob' and 'hash' phases of
+        this PhaseTimer
+    :param wait_for_reports: if given, a callable blocking until the reports
+        being generated are done, called before the patterns with the
+        'report' option are expanded
+    :param bool defer_digest: if True, the checksums that are not cached are
+        not computed and `DEFERRED_DIGEST` is returned in their place, e.g.
+        because they are computed while the files are transferred
+    :param bool tree_digest: if True, a tree digest is computed together with
+        each checksum and cached next to it, see `TreeHasher`. A cached
+        checksum is not used if the tree digest cached with it shows that
+        the file has changed since.
+    :param string integrity_algorithm: the algorithm of the tree digests,
+        see `integrity_hasher`
+    :param bool check_gzip: if True, the gzip compressed files are checked
+        for corruption while their checksums are computed, see `GzipChecker`.
+        The files with cached checksums are read for the check alone, unless
+        `defer_digest` is set.
     :returns: A generator of tuples with source path,
         destination path and the checksum of the source file
         (or None if source is a folder)
@@ -45,12 +552,39 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
         # skip the digest if either the global or the per-file setting is to skip
         if not any([no_checksum, no_digest]):
             checksumpath = "{}.{}".format(sourcepath, hash_algorithm)
-            try:
-                with open(checksumpath, "r") as fh:
-                    contents = unicode(next(fh))
-                    digest = contents.split()[0]
-            except (IOError, StopIteration):
-                digest = unicode(hashfile(sourcepath, hasher=hash_algorithm))
+            digest = cached_digest(sourcepath, hash_algorithm, tree_digest=tree_digest)
+            if digest is not None:
+                # streamed files are checked while they are copied instead
+                if check_gzip and not defer_digest and is_gzip_file(sourcepath):
+                    check_gzip_file(sourcepath, blocksize=hash_blocksize)
+            else:
+                if defer_digest:
+                    return sourcepath, destpath, DEFERRED_DIGEST
+                start = time.perf_counter()
+                tree = (
+                    TreeHasher(algorithm=integrity_algorithm) if tree_digest else None
+                )
+                checker = (
+                    GzipChecker(sourcepath)
+                    if check_gzip and is_gzip_file(sourcepath)
+                    else None
+                )
+                signature = _file_signature(sourcepath)
+                digest = unicode(
+                    stream_digest(
+                        sourcepath,
+                        hash_algorithm,
+                        blocksize=hash_blocksize,
+                        tree=tree,
+                        gzip_checker=checker,
+                    )
+                )
+                try:
+                    metrics.observe_hash(
+                        path.getsize(sourcepath), time.perf_counter() - start
+                    )
+                except OSError:
+                    pass
                 if not no_digest_cache:
                     try:
                         with open(checksumpath, "w") as fh:
@@ -61,58 +595,717 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
                                 digest, checksumpath, we
                             )
                         )
+                    if tree is not None:
+                        write_tree_digest(
+                            sourcepath,
+                            tree.tree(),
+                            hash_algorithm=hash_algorithm,
+                            digest=digest,
+                            signature=signature,
+                        )
         return sourcepath, destpath, digest
 
-    def _walk_files(currpath, destpath):
-        # if current path is a folder, return all files below it
-        if path.isdir(currpath):
-            parent = path.dirname(currpath)
-            for parentdir, _, dirfiles in walk(currpath, followlinks=True):
-                for currfile in dirfiles:
-                    fullpath = path.join(parentdir, currfile)
-                    # the relative path will be used in the destination path
-                    relpath = path.relpath(fullpath, parent)
-                    yield (fullpath, path.join(destpath, relpath))
-        else:
-            yield (currpath, path.join(destpath, path.basename(currpath)))
+    def _hash(item):
+        # paths that did not pass the existence check are passed on as None
+        if item is None:
+            return None
+        spath, dpath, pattern = item
+        start = time.perf_counter()
+        digest = _get_digest(
+            spath,
+            dpath,
+            no_digest_cache=pattern.no_digest_cache,
+            no_digest=pattern.no_digest,
+        )
+        if timer is not None:
+            timer.add("hash", time.perf_counter() - start)
+        return digest
 
-    if patterns is None:
-        patterns = []
-    for pattern in patterns:
-        sfile, dfile = pattern[0:2]
-        try:
-            extra = pattern[2]
-        except IndexError:
-            extra = {}
-        matches = 0
-        for f in iglob(sfile):
-            for spath, dpath in _walk_files(f, dfile):
-                # ignore checksum files
-                if not spath.endswith(".{}".format(hash_algorithm)):
-                    matches += 1
-                    # skip and warn if a path does not exist, this includes broken symlinks
-                    if path.exists(spath):
-                        yield _get_digest(
-                            spath,
-                            dpath,
-                            no_digest_cache=extra.get("no_digest_cache", False),
-                            no_digest=extra.get("no_digest", False),
+    patterns = compile_patterns(patterns)
+    check_required_patterns(
+        patterns,
+        hash_algorithm=hash_algorithm,
+        listing_cache=listing_cache,
+        skip_reports=wait_for_reports is not None,
+    )
+
+    expanded = _expand_patterns(
+        patterns, hash_algorithm, listing_cache, wait_for_reports
+    )
+    if timer is not None:
+        expanded = _timed_iter(expanded, timer, "glob")
+    existing = run_stage(expanded, _check_exists, queue_size=queue_size)
+    for gathered in run_stage(
+        existing, _hash, workers=hash_workers, queue_size=queue_size
+    ):
+        if gathered is not None:
+            yield gathered
+
+
+def plan_files(
+    patterns,
+    no_checksum=False,
+    hash_algorithm="md5",
+    listing_cache=None,
+    tree_digest=False,
+):
+    """Locate the files that gather_files would return for the patterns,
+    without computing any checksums. The cached checksums are checked with
+    `cached_digest`, like gather_files does.
+
+    :param patterns: a list of DeliveryPattern instances or 'files_to_deliver'
+        entries
+    :returns: A generator of tuples with source path, destination path, the
+        size of the source file in bytes and whether a checksum would have to
+        be computed for the source file
+    """
+    patterns = compile_patterns(patterns)
+    check_required_patterns(
+        patterns, hash_algorithm=hash_algorithm, listing_cache=listing_cache
+    )
+    for item in _expand_patterns(patterns, hash_algorithm, listing_cache):
+        if _check_exists(item) is None:
+            continue
+        spath, dpath, pattern = item
+        needs_digest = (
+            not (no_checksum or pattern.no_digest)
+            and cached_digest(spath, hash_algorithm, tree_digest=tree_digest) is None
+        )
+        yield spath, dpath, path.getsize(spath), needs_digest
+
+
+def measure_hash_throughput(
+    sourcepath, hash_algorithm="md5", sample_size=64 * 1024 * 1024
+):
+    """Measure how fast a file can be hashed by reading and hashing at most
+    `sample_size` bytes from the beginning of it
+
+    :returns: the throughput in bytes per second, or None if the file could
+        not be read
+    """
+    hasher = hashlib.new(hash_algorithm)
+    nbytes = 0
+    start = time.time()
+    try:
+        with open(sourcepath, "rb") as fh:
+            while nbytes < sample_size:
+                buf = fh.read(1024 * 1024)
+                if not buf:
+                    break
+                hasher.update(buf)
+                nbytes += len(buf)
+    except IOError as e:
+        logger.warning(
+            "could not measure hash throughput on {}: {}".format(sourcepath, e)
+        )
+        return None
+    elapsed = time.time() - start
+    if nbytes == 0 or elapsed <= 0:
+        return None
+    return nbytes / elapsed
+
+
+def is_gzip_file(sourcepath):
+    return sourcepath.endswith(GZIP_SUFFIXES)
+
+
+class GzipChecker(object):
+    """Check that a gzip or BGZF file is intact by decompressing it as it is
+    read, e.g. while its checksum is computed, so that it is not read again
+    as by `gzip -t`. The decompressed data is discarded.
+
+    Each member of the file is decompressed until its end, where zlib
+    verifies the CRC and the size in the trailer, and the file is
+    truncated if it ends within a member. Zeros after the last member are
+    padding, which `gzip -t` accepts too.
+    """
+
+    def __init__(self, sourcepath):
+        self.sourcepath = sourcepath
+        self.members = 0
+        self._decompressor = zlib.decompressobj(31)
+        self._in_member = False
+        self._padding = False
+
+    def update(self, data):
+        """Decompress the next bytes of the file
+
+        :raises CorruptFileException: if the data is not valid gzip data
+        """
+        while data:
+            if self.members and not self._in_member:
+                if self._padding or data[0] == 0:
+                    self._padding = True
+                    if bytes(data).strip(b"\0"):
+                        raise CorruptFileException(
+                            "{} has trailing data after the padding of member "
+                            "{}".format(self.sourcepath, self.members)
                         )
-                    else:
-                        # if the file pattern requires a match, throw an error. otherwise warn
-                        msg = "path {} does not exist, possibly because of a broken symlink".format(
-                            spath
+                    return
+            self._in_member = True
+            try:
+                # the output is limited, since a block of compressed data
+                # can decompress to much more than fits in memory
+                self._decompressor.decompress(data, GZIP_CHECK_OUTPUT_SIZE)
+            except zlib.error as e:
+                raise CorruptFileException(
+                    "{} is corrupt after member {}: {}".format(
+                        self.sourcepath, self.members, e
+                    )
+                ) from e
+            if self._decompressor.eof:
+                self.members += 1
+                data = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(31)
+                self._in_member = False
+            else:
+                data = self._decompressor.unconsumed_tail
+
+    def finish(self):
+        """Check that the whole file has been decompressed
+
+        :raises CorruptFileException: if the file ends within a member or is
+            empty
+        """
+        if self._in_member:
+            # the output held back by the limit on the last update
+            try:
+                self._decompressor.flush()
+            except zlib.error as e:
+                raise CorruptFileException(
+                    "{} is corrupt after member {}: {}".format(
+                        self.sourcepath, self.members, e
+                    )
+                ) from e
+            if self._decompressor.eof:
+                self.members += 1
+                unused = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(31)
+                self._in_member = False
+                if unused:
+                    self.update(unused)
+                    return self.finish()
+        if self._in_member or self.members == 0:
+            raise CorruptFileException(
+                "{} is truncated after member {}".format(self.sourcepath, self.members)
+            )
+
+
+def _fadvise(fd, offset, length, advice):
+    # posix_fadvise is not available on all platforms and the advice is only
+    # a hint, so not being able to give it is not an error
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def stream_digest(
+    sourcepath,
+    hash_algorithm="md5",
+    blocksize=DEFAULT_HASH_BLOCKSIZE,
+    progress=None,
+    drop_cache=True,
+    tree=None,
+    gzip_checker=None,
+):
+    """Compute the checksum of a file, reading it in blocks into a buffer
+    that is reused for every block.
+
+    The kernel is advised that the file is read sequentially and, unless
+    `drop_cache` is False, to drop the pages already hashed from the page
+    cache. The delivered files are read once and are often larger than the
+    page cache, so keeping their pages would only evict more useful ones.
+
+    :param int blocksize: the number of bytes read at a time
+    :param progress: if given, a callable that is called with the number of
+        bytes read so far and the size of the file after each block
+    :param bool drop_cache: if False, the pages of the file are left in the
+        page cache, e.g. if the file will be read again shortly
+    :param TreeHasher tree: if given, the file is also fed to this tree
+        hasher, computing its tree digest from the same reads
+    :param GzipChecker gzip_checker: if given, the file is also fed to this
+        checker
+    :returns: the hex digest of the file
+    :raises CorruptFileException: if the file does not pass the gzip check
+    """
+    hasher = hashlib.new(hash_algorithm)
+    with open(sourcepath, "rb", buffering=0) as fh:
+        for block in _read_blocks(fh, blocksize, progress, drop_cache):
+            hasher.update(block)
+            if tree is not None:
+                tree.update(block)
+            if gzip_checker is not None:
+                gzip_checker.update(block)
+    if gzip_checker is not None:
+        gzip_checker.finish()
+    return hasher.hexdigest()
+
+
+def check_gzip_file(sourcepath, blocksize=DEFAULT_HASH_BLOCKSIZE):
+    """Check that a gzip compressed file is intact by reading it through a
+    `GzipChecker`, for files whose checksums are not computed
+
+    :raises CorruptFileException: if the file does not pass the check
+    """
+    checker = GzipChecker(sourcepath)
+    with open(sourcepath, "rb", buffering=0) as fh:
+        for block in _read_blocks(fh, blocksize):
+            checker.update(block)
+    checker.finish()
+
+
+def _read_blocks(fh, blocksize, progress=None, drop_cache=True):
+    # read an unbuffered file into a buffer that is reused for every block,
+    # see stream_digest
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    nbytes = dropped = 0
+    fd = fh.fileno()
+    total = os.fstat(fd).st_size
+    _fadvise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+    while True:
+        n = fh.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+        nbytes += n
+        if drop_cache and nbytes - dropped >= DROP_CACHE_BYTES:
+            _fadvise(fd, dropped, nbytes - dropped, "POSIX_FADV_DONTNEED")
+            dropped = nbytes
+        if progress is not None:
+            progress(nbytes, total)
+    if drop_cache and nbytes > dropped:
+        _fadvise(fd, dropped, 0, "POSIX_FADV_DONTNEED")
+
+
+def copy_and_hash(
+    sourcepath,
+    destpath,
+    hash_algorithm="md5",
+    blocksize=DEFAULT_HASH_BLOCKSIZE,
+    mode=None,
+    tree=None,
+    gzip_checker=None,
+    verify=None,
+    preserve_mtime=False,
+):
+    """Copy a file and compute its checksum from the same reads, so that the
+    source is only read once. The copy is written to a temporary file next
+    to the destination, synced and checked to have the size of the bytes
+    read before it is renamed to the destination.
+
+    :param string hash_algorithm: the algorithm of the checksum, or None to
+        not compute it
+    :param int mode: if given, the permissions of the destination file
+    :param TreeHasher tree: if given, the file is also fed to this tree
+        hasher
+    :param GzipChecker gzip_checker: if given, the file is also fed to this
+        checker, and it is not copied if it does not pass
+    :param verify: if given, a callable that is passed the hex digest once
+        the file is read and returns False if the copy should not replace
+        the destination
+    :param bool preserve_mtime: if True, the destination file is given the
+        modification time of the source file
+    :returns: the hex digest of the file, or None if no hash_algorithm is
+        given
+    :raises IOError: if the file could not be copied
+    :raises CorruptFileException: if the file does not pass the gzip check
+    :raises ChecksumMismatchException: if the copy does not pass `verify`
+    """
+    hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+    partpath = "{}.part".format(destpath)
+    os.makedirs(path.dirname(destpath) or ".", exist_ok=True)
+    nbytes = 0
+    try:
+        with (
+            open(sourcepath, "rb", buffering=0) as sh,
+            open(partpath, "wb", buffering=0) as dh,
+        ):
+            source_stat = os.fstat(sh.fileno())
+            for block in _read_blocks(sh, blocksize):
+                if hasher is not None:
+                    hasher.update(block)
+                if tree is not None:
+                    tree.update(block)
+                if gzip_checker is not None:
+                    gzip_checker.update(block)
+                # an unbuffered write may write only part of the block
+                remaining = block
+                while remaining:
+                    written = dh.write(remaining)
+                    remaining = remaining[written:]
+                    nbytes += written
+            if gzip_checker is not None:
+                gzip_checker.finish()
+            os.fsync(dh.fileno())
+            if mode is not None:
+                os.fchmod(dh.fileno(), mode)
+        if path.getsize(partpath) != nbytes:
+            raise IOError(
+                "{} has {} bytes, but {} bytes were read from {}".format(
+                    partpath, path.getsize(partpath), nbytes, sourcepath
+                )
+            )
+        digest = hasher.hexdigest() if hasher is not None else None
+        if verify is not None and not verify(digest):
+            raise ChecksumMismatchException(
+                "{} does not match its checksum".format(sourcepath)
+            )
+        if preserve_mtime:
+            os.utime(partpath, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(partpath, destpath)
+    except BaseException:
+        try:
+            os.unlink(partpath)
+        except OSError:
+            pass
+        raise
+    return digest
+
+
+def integrity_hasher(algorithm=DEFAULT_INTEGRITY_ALGORITHM):
+    """Create a hash object for the integrity digests, which only need to
+    detect that data has changed and can use faster algorithms than the
+    checksums delivered to the customers
+
+    :param string algorithm: 'blake2b' for a 256-bit BLAKE2b, 'xxh3_64' or
+        'xxh3_128' if the xxhash package is installed, or any other algorithm
+        available through hashlib
+    :raises ValueError: if the algorithm is not available
+    """
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    if algorithm in ("xxh3_64", "xxh3_128"):
+        if xxhash is None:
+            raise ValueError(
+                "the integrity algorithm {} requires the xxhash package".format(
+                    algorithm
+                )
+            )
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def _tree_root(blocks, algorithm):
+    root = integrity_hasher(algorithm)
+    for block in blocks:
+        root.update(bytes.fromhex(block))
+    return root.hexdigest()
+
+
+class TreeHasher(object):
+    """Compute the tree digest of a stream, i.e. an integrity digest of each
+    block of `blocksize` bytes and a root digest over the digests of the
+    blocks, by default with BLAKE2b.
+
+    Unlike md5 or sha1, the blocks of a tree digest can be hashed in
+    parallel, see `tree_digest`, and a file that does not match its tree
+    digest can be told which blocks differ. The tree digest of a file is
+    computed from the same reads as its checksum the first time it is
+    hashed, so that the file can then be verified in parallel.
+    """
+
+    def __init__(self, blocksize=TREE_BLOCKSIZE, algorithm=DEFAULT_INTEGRITY_ALGORITHM):
+        self.blocksize = blocksize
+        self.algorithm = algorithm
+        self.size = 0
+        self.blocks = []
+        self._hasher = integrity_hasher(algorithm)
+        self._filled = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            n = min(len(data), self.blocksize - self._filled)
+            self._hasher.update(data[:n])
+            self._filled += n
+            self.size += n
+            data = data[n:]
+            if self._filled == self.blocksize:
+                self.blocks.append(self._hasher.hexdigest())
+                self._hasher = integrity_hasher(self.algorithm)
+                self._filled = 0
+
+    def tree(self):
+        """
+        :returns: the tree digest as a dict with the algorithm, the block
+            size, the size of the stream, the hex digests of the blocks and
+            the root digest
+        """
+        blocks = list(self.blocks)
+        # the last partial block, or the only block of an empty stream
+        if self._filled or not blocks:
+            blocks.append(self._hasher.hexdigest())
+        return {
+            "algorithm": self.algorithm,
+            "blocksize": self.blocksize,
+            "size": self.size,
+            "blocks": blocks,
+            "root": _tree_root(blocks, self.algorithm),
+        }
+
+
+def _pread_into(fd, view, offset):
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [view], offset)
+    data = os.pread(fd, len(view), offset)
+    view[: len(data)] = data
+    return len(data)
+
+
+def tree_digest(
+    sourcepath,
+    blocksize=TREE_BLOCKSIZE,
+    workers=4,
+    readsize=DEFAULT_HASH_BLOCKSIZE,
+    drop_cache=True,
+    algorithm=DEFAULT_INTEGRITY_ALGORITHM,
+):
+    """Compute the tree digest of a file, hashing its blocks in parallel on
+    `workers` threads reading with positional reads from one descriptor
+
+    :param int readsize: the number of bytes read at a time by each thread
+    :returns: the tree digest, see `TreeHasher.tree`
+    :raises IOError: if the file could not be read
+    """
+    fd = os.open(sourcepath, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        nblocks = max(1, -(-size // blocksize))
+
+        def _hash_block(n):
+            hasher = integrity_hasher(algorithm)
+            view = memoryview(bytearray(min(readsize, blocksize)))
+            offset = n * blocksize
+            end = min(size, offset + blocksize)
+            while offset < end:
+                nread = _pread_into(fd, view[: end - offset], offset)
+                if not nread:
+                    raise IOError("{} was truncated while hashed".format(sourcepath))
+                hasher.update(view[:nread])
+                offset += nread
+            if drop_cache:
+                _fadvise(fd, n * blocksize, blocksize, "POSIX_FADV_DONTNEED")
+            return hasher.hexdigest()
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            blocks = list(executor.map(_hash_block, range(nblocks)))
+    finally:
+        os.close(fd)
+    return {
+        "algorithm": algorithm,
+        "blocksize": blocksize,
+        "size": size,
+        "blocks": blocks,
+        "root": _tree_root(blocks, algorithm),
+    }
+
+
+def verify_tree_digest(sourcepath, tree, workers=4):
+    """Verify a file against a tree digest, hashing its blocks in parallel
+
+    :param dict tree: a tree digest, see `TreeHasher.tree`
+    :returns: the indices of the blocks that differ, an empty list if the
+        file matches the tree digest
+    """
+    observed = tree_digest(
+        sourcepath,
+        tree["blocksize"],
+        workers=workers,
+        algorithm=tree.get("algorithm", DEFAULT_INTEGRITY_ALGORITHM),
+    )
+    if observed["root"] == tree["root"] and observed["size"] == tree["size"]:
+        return []
+    return [
+        n
+        for n in range(max(len(observed["blocks"]), len(tree["blocks"])))
+        if n >= len(observed["blocks"])
+        or n >= len(tree["blocks"])
+        or observed["blocks"][n] != tree["blocks"][n]
+    ]
+
+
+def read_tree_digest(sourcepath):
+    """
+    :returns: the tree digest cached next to a file, or None if there is
+        none or it could not be read
+    """
+    try:
+        with open("{}{}".format(sourcepath, TREE_SUFFIX), "r") as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_tree_digest(sourcepath, tree, **fields):
+    """Cache the tree digest of a file next to it, together with e.g. the
+    checksum that was computed with it. Errors are logged, not raised.
+    """
+    treepath = "{}{}".format(sourcepath, TREE_SUFFIX)
+    try:
+        with open("{}.tmp".format(treepath), "w") as fh:
+            json.dump(dict(tree, **fields), fh)
+        os.replace("{}.tmp".format(treepath), treepath)
+    except (IOError, OSError) as e:
+        logger.warning(
+            "could not write tree digest of {} to {}: {}".format(
+                sourcepath, treepath, e
+            )
+        )
+
+
+def cached_digest(sourcepath, hash_algorithm="md5", tree_digest=False):
+    """Read the checksum of a file cached next to it, if it can be trusted.
+    With `tree_digest`, a cached checksum is not trusted if the tree digest
+    cached with it says the file has changed since.
+
+    :returns: the cached checksum, or None if there is no cached checksum or
+        it is out of date
+    """
+    checksumpath = "{}.{}".format(sourcepath, hash_algorithm)
+    try:
+        with open(checksumpath, "r") as fh:
+            digest = unicode(next(fh)).split()[0]
+    except (IOError, OSError, StopIteration, IndexError):
+        return None
+    if tree_digest and _changed_since_digest(sourcepath, hash_algorithm, digest):
+        logger.info("{} has changed since its checksum was cached".format(sourcepath))
+        return None
+    return digest
+
+
+def _changed_since_digest(sourcepath, hash_algorithm, digest):
+    # a file has changed if the tree digest cached with its checksum was
+    # computed when the file had another size or modification time
+    tree = read_tree_digest(sourcepath)
+    if (
+        tree is None
+        or tree.get("hash_algorithm") != hash_algorithm
+        or tree.get("digest") != digest
+    ):
+        return False
+    try:
+        return tree.get("signature") != _file_signature(sourcepath)
+    except OSError:
+        return False
+
+
+def _file_signature(sourcepath):
+    st = os.stat(sourcepath)
+    return "{}:{}".format(st.st_size, st.st_mtime_ns)
+
+
+def verify_checksum(
+    sourcepath,
+    checksumfile,
+    hash_algorithm="md5",
+    progress=None,
+    cache=True,
+    blocksize=DEFAULT_HASH_BLOCKSIZE,
+    tree_workers=0,
+    integrity_algorithm=DEFAULT_INTEGRITY_ALGORITHM,
+):
+    """Verify a file against the checksum in a checksum file, e.g. a run
+    folder archive against its .md5 file. A successful verification is
+    recorded in a '.verified' file next to the checksum file, together with
+    the size and modification time of the file, so that the file is not
+    hashed again as long as it is unchanged.
+
+    :param string checksumfile: a file with the expected checksum as the
+        first word
+    :param progress: passed on to `stream_digest`
+    :param int blocksize: passed on to `stream_digest`
+    :param bool cache: if False, the '.verified' file is neither used nor
+        written
+    :param int tree_workers: if given, a tree digest is cached next to the
+        file when its checksum is verified. If the file has been modified
+        since, e.g. copied again, it is verified against the tree digest on
+        this many threads instead of computing its checksum sequentially,
+        and the blocks that differ are logged.
+    :param string integrity_algorithm: the algorithm of the tree digest,
+        see `integrity_hasher`
+    :returns: True if the checksum matches, False otherwise
+    :raises FileNotFoundException: if the file or the checksum file is missing
+    """
+    try:
+        with open(checksumfile, "r") as fh:
+            expected = fh.read().split()[0].lower()
+        signature = _file_signature(sourcepath)
+    except (IOError, OSError, IndexError) as e:
+        raise FileNotFoundException(
+            "could not read {} or {}: {}".format(sourcepath, checksumfile, e)
+        ) from e
+    verifiedfile = "{}.verified".format(checksumfile)
+    if cache:
+        try:
+            with open(verifiedfile, "r") as fh:
+                if fh.read().split() == [expected, signature]:
+                    logger.info(
+                        "{} has already been verified, not hashing it again".format(
+                            sourcepath
                         )
-                        if extra.get("required", False):
-                            logger.error(msg)
-                            raise FileNotFoundException(msg)
-                        logger.warning(msg)
-        if matches == 0:
-            msg = "no files matching search expression '{}' found ".format(sfile)
-            if extra.get("required", False):
-                logger.error(msg)
-                raise PatternNotMatchedException(msg)
-            logger.warning(msg)
+                    )
+                    return True
+        except (IOError, OSError):
+            pass
+    tree = read_tree_digest(sourcepath) if tree_workers else None
+    if (
+        tree is not None
+        and tree.get("hash_algorithm") == hash_algorithm
+        and tree.get("digest") == expected
+        and tree.get("algorithm", DEFAULT_INTEGRITY_ALGORITHM) == integrity_algorithm
+    ):
+        start = time.perf_counter()
+        differing = verify_tree_digest(sourcepath, tree, workers=tree_workers)
+        metrics.observe_hash(path.getsize(sourcepath), time.perf_counter() - start)
+        if differing:
+            logger.error(
+                "{} does not match the tree digest cached when its checksum was "
+                "verified, {} blocks of {} bytes differ, starting at bytes {}".format(
+                    sourcepath,
+                    len(differing),
+                    tree["blocksize"],
+                    ", ".join(str(n * tree["blocksize"]) for n in differing[:10]),
+                )
+            )
+            return False
+    else:
+        hasher = TreeHasher(algorithm=integrity_algorithm) if tree_workers else None
+        start = time.perf_counter()
+        observed = stream_digest(
+            sourcepath,
+            hash_algorithm,
+            blocksize=blocksize,
+            progress=progress,
+            tree=hasher,
+        )
+        metrics.observe_hash(path.getsize(sourcepath), time.perf_counter() - start)
+        if observed != expected:
+            logger.error(
+                "checksum of {} is {}, but {} was expected from {}".format(
+                    sourcepath, observed, expected, checksumfile
+                )
+            )
+            return False
+        if hasher is not None:
+            write_tree_digest(
+                sourcepath,
+                hasher.tree(),
+                hash_algorithm=hash_algorithm,
+                digest=expected,
+                signature=signature,
+            )
+    if cache:
+        try:
+            with open(verifiedfile, "w") as fh:
+                fh.write("{}  {}\n".format(expected, signature))
+        except (IOError, OSError) as e:
+            logger.debug(
+                "could not cache the verification of {}: {}".format(sourcepath, e)
+            )
+    return True
 
 
 def parse_hash_file(
@@ -144,11 +1337,68 @@ def merge_dicts(mdict, sdict):
     """Merge the 2 given dictioneries, if a key already exists it is
     replaced/updated with new values depending upon data types
     """
-    for k, v in six.iteritems(sdict):
-        if isinstance(v, dict) and isinstance(mdict.get(k), dict):
-            mdict[k] = merge_dicts(mdict[k], v)
-        elif isinstance(v, list) and isinstance(mdict.get(k), list):
-            mdict[k] = sorted(set(mdict[k] + v))
-        else:
-            mdict[k] = v
-    return mdict
+    return DictMerger(mdict).merge(sdict).materialise()
+
+
+class _ListSet(set):
+    """A list being merged, kept as a set until the merge is materialised"""
+
+
+class DictMerger(object):
+    """Merges dicts into a dict in place, like merge_dicts but for merging
+    many dicts. Lists merged with other lists are kept as sets and only
+    sorted once, when the result is materialised, and the top-level keys
+    whose values changed are recorded in `changed`, e.g. to only save the
+    branches that were updated:
+
+        merger = DictMerger(staged_files)
+        for hash_dict in hash_dicts:
+            merger.merge(hash_dict)
+        staged_files = merger.materialise()
+    """
+
+    def __init__(self, mdict=None):
+        self.merged = mdict if mdict is not None else {}
+        self.changed = set()
+        # the dicts and keys of the lists kept as sets
+        self._listsets = []
+
+    def merge(self, sdict):
+        """Merge a dict into the merged dict
+        :returns: the DictMerger instance
+        """
+        for k, v in six.iteritems(sdict):
+            if self._merge_value(self.merged, k, v):
+                self.changed.add(k)
+        return self
+
+    def _merge_value(self, mdict, k, v):
+        """Merge a value into mdict[k]
+        :returns: True if mdict[k] changed
+        """
+        current = mdict.get(k)
+        if isinstance(v, dict) and isinstance(current, dict):
+            changed = False
+            for sk, sv in six.iteritems(v):
+                changed = self._merge_value(current, sk, sv) or changed
+            return changed
+        if isinstance(v, list) and isinstance(current, (list, _ListSet)):
+            if not isinstance(current, _ListSet):
+                current = mdict[k] = _ListSet(current)
+                self._listsets.append((mdict, k))
+            size = len(current)
+            current.update(v)
+            return len(current) != size
+        changed = k not in mdict or current != v
+        mdict[k] = v
+        return changed
+
+    def materialise(self):
+        """Sort the lists kept as sets
+        :returns: the merged dict
+        """
+        for mdict, k in self._listsets:
+            if isinstance(mdict.get(k), _ListSet):
+                mdict[k] = sorted(mdict[k])
+        self._listsets = []
+        return self.merged
@@ -0,0 +1,415 @@
+"""Counters and histograms describing delivery runs, exported in the
+Prometheus text format for the node exporter's textfile collector
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400)
+TEXTFILE_NAME = "taca_deliver.prom"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for name, value in pairs
+        )
+    )
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "metric {} expects the labels {}, got {}".format(
+                    self.name, self.labelnames, tuple(labels)
+                )
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        """:returns: a picklable copy of the values of this metric"""
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, snapshot):
+        """Add the values from a snapshot, e.g. taken in another process"""
+        with self._lock:
+            for key, value in snapshot.items():
+                self._values[key] = (
+                    self._merged(self._values[key], value)
+                    if key in self._values
+                    else value
+                )
+
+    def merged(self, snapshot):
+        """:returns: a snapshot of the values of this metric added to those
+        of another snapshot, leaving this metric as it is"""
+        values = dict(snapshot)
+        for key, value in self.snapshot().items():
+            values[key] = self._merged(values[key], value) if key in values else value
+        return values
+
+    def render(self, snapshot=None):
+        """:param dict snapshot: if given, the values to render instead of the
+        values of this metric"""
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.TYPE),
+        ]
+        values = self.snapshot() if snapshot is None else snapshot
+        for key in sorted(values):
+            lines.extend(self._samples(key, values[key]))
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("counters can only be incremented")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _merged(self, value, other):
+        return value + other
+
+    def _samples(self, key, value):
+        return [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, key), _format_value(value)
+            )
+        ]
+
+
+class Gauge(Counter):
+    """A value that can be set to anything"""
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _merged(self, value, other):
+        return max(value, other)
+
+
+class Histogram(_Metric):
+    """Counts of observations in cumulative buckets, with their sum"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [
+                count + (1 if value <= bound else 0)
+                for count, bound in zip(counts, self.buckets)
+            ]
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager observing the time spent in the enclosed block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), ([0], 0.0))[0][-1]
+
+    def _merged(self, value, other):
+        return ([a + b for a, b in zip(value[0], other[0])], value[1] + other[1])
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = [
+            "{}_bucket{} {}".format(
+                self.name,
+                _format_labels(self.labelnames, key, [("le", _format_value(bound))]),
+                count,
+            )
+            for count, bound in zip(counts, self.buckets)
+        ]
+        labels = _format_labels(self.labelnames, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, labels, counts[-1]))
+        return lines
+
+
+class MetricsRegistry(object):
+    """A collection of metrics that can be rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def snapshot(self):
+        """
+        :returns: a picklable copy of the values of all metrics, which can be
+            sent from a worker process to be merged into the parent's registry
+        """
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def merge(self, snapshot):
+        """Add the values from a snapshot of a registry with the same metrics"""
+        for metric in self.metrics:
+            metric.merge(snapshot.get(metric.name, {}))
+
+    def render(self, snapshot=None):
+        """
+        :param dict snapshot: if given, the values to render instead of the
+            values of the metrics, see `snapshot`
+        :returns: the metrics in the Prometheus text exposition format
+        """
+        return "".join(
+            "{}\n".format(line)
+            for metric in self.metrics
+            for line in metric.render(
+                None if snapshot is None else snapshot.get(metric.name, {})
+            )
+        )
+
+    def write_textfile(self, directory, filename=TEXTFILE_NAME):
+        """Add the metrics to those in a file in the directory read by the node
+        exporter's textfile collector.
+
+        The totals of the earlier runs are kept in a hidden state file next to
+        it, which the collector does not read, and are read and written
+        under a lock, so that runs finishing at the same time do not overwrite
+        each other's metrics. The files are written to temporary files first
+        and then renamed, so the collector never reads a partial file. The
+        metrics of this registry are then reset, so that they are not added
+        again by the next call.
+
+        :returns: the path to the written file
+        """
+        path = os.path.join(directory, filename)
+        statepath = os.path.join(directory, ".{}.json".format(filename))
+        with open(os.path.join(directory, ".{}.lock".format(filename)), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = self._read_state(statepath)
+            totals = {
+                metric.name: metric.merged(totals.get(metric.name, {}))
+                for metric in self.metrics
+            }
+            # the totals are only saved once they are exported, and the
+            # metrics only reset once they are saved
+            _write_atomic(path, self.render(totals))
+            _write_atomic(
+                statepath,
+                json.dumps(
+                    {
+                        name: [[list(key), value] for key, value in values.items()]
+                        for name, values in totals.items()
+                    }
+                ),
+            )
+            self.reset()
+        return path
+
+    def _read_state(self, statepath):
+        try:
+            with open(statepath, "r") as fh:
+                state = json.load(fh)
+            return {
+                name: {tuple(key): value for key, value in values}
+                for name, values in state.items()
+            }
+        except FileNotFoundError:
+            return {}
+        except (TypeError, ValueError) as e:
+            logger.warning(
+                "ignoring the unreadable metrics in {}, reason: {}".format(statepath, e)
+            )
+            return {}
+
+
+def _write_atomic(path, content):
+    fd, tmppath = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".{}.".format(os.path.basename(path))
+    )
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(content)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+REGISTRY = MetricsRegistry()
+
+SAMPLES = REGISTRY.register(
+    Counter(
+        "taca_deliver_samples_total",
+        "Samples processed by the deliverers, by outcome",
+        ["status"],
+    )
+)
+HASHED_BYTES = REGISTRY.register(
+    Counter("taca_deliver_hashed_bytes_total", "Bytes read to compute checksums")
+)
+HASH_SECONDS = REGISTRY.register(
+    Counter("taca_deliver_hash_seconds_total", "Time spent computing checksums")
+)
+HASH_THROUGHPUT = REGISTRY.register(
+    Histogram(
+        "taca_deliver_hash_throughput_megabytes_per_second",
+        "Checksum throughput per file in MB/s",
+        buckets=(10, 25, 50, 100, 200, 400, 800, 1600),
+    )
+)
+SYMLINKED_FILES = REGISTRY.register(
+    Counter("taca_deliver_symlinked_files_total", "Files symlinked when staging")
+)
+DATABASE_REQUESTS = REGISTRY.register(
+    Counter(
+        "taca_deliver_database_requests_total",
+        "Requests to Charon and StatusDB, by outcome",
+        ["database", "outcome"],
+    )
+)
+DATABASE_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "taca_deliver_database_request_seconds",
+        "Latency of the requests to Charon and StatusDB",
+        ["database"],
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    )
+)
+TRANSFERRED_BYTES = REGISTRY.register(
+    Counter(
+        "taca_deliver_transferred_bytes_total",
+        "Bytes transferred to the delivery destination",
+        ["method"],
+    )
+)
+TRANSFER_SECONDS = REGISTRY.register(
+    Histogram(
+        "taca_deliver_transfer_seconds",
+        "Duration of the transfers to the delivery destination",
+        ["method"],
+    )
+)
+LAST_RUN = REGISTRY.register(
+    Gauge(
+        "taca_deliver_last_run_timestamp_seconds",
+        "Time the last delivery run finished, by outcome",
+        ["status"],
+    )
+)
+
+
+@contextlib.contextmanager
+def database_request(database):
+    """Context manager counting and timing a request to a database
+    :param string database: 'charon' or 'statusdb'
+    """
+    outcome = "error"
+    try:
+        with DATABASE_REQUEST_SECONDS.time(database=database):
+            yield
+        outcome = "success"
+    finally:
+        DATABASE_REQUESTS.inc(database=database, outcome=outcome)
+
+
+def observe_hash(nbytes, seconds):
+    HASHED_BYTES.inc(nbytes)
+    HASH_SECONDS.inc(seconds)
+    if seconds > 0:
+        HASH_THROUGHPUT.observe(nbytes / seconds / 1e6)
+
+
+def observe_transfer(method, nbytes, seconds):
+    TRANSFERRED_BYTES.inc(nbytes, method=method)
+    TRANSFER_SECONDS.observe(seconds, method=method)
+
+
+def export(directory, success=True):
+    """Write the metrics of this run to the textfile collector directory,
+    logging rather than raising any error since the metrics should never
+    fail a delivery
+
+    :param directory: the textfile collector directory, if None nothing is
+        written
+    :param bool success: whether the run was successful
+    """
+    if not directory:
+        return None
+    LAST_RUN.set(time.time(), status="success" if success else "failure")
+    try:
+        path = REGISTRY.write_textfile(directory)
+        logger.debug("delivery metrics written to {}".format(path))
+        return path
+    except (IOError, OSError) as e:
+        logger.warning(
+            "could not write delivery metrics to {}, reason: {}".format(directory, e)
+        )
+        return None
@@ -0,0 +1,91 @@
+"""The files staged for each sample, kept in StatusDB as one document per
+sample instead of in the ``staged_files`` field of the project document, so
+that updating a sample does not transfer the whole project document:
+
+    {
+        "_id": "P12345_1001",
+        "project_id": "P12345",
+        "sample_id": "P12345_1001",
+        "staged_files": {"P12345_1001/...fastq.gz": {"md5_sum": ..., ...}},
+    }
+
+The documents of a project are read with one range request to ``_all_docs``,
+since the sample ids start with the project id.
+"""
+
+import logging
+
+from . import metrics
+from .filesystem import DictMerger
+
+logger = logging.getLogger(__name__)
+
+# attempts to update the document of a sample if it is updated concurrently
+UPDATE_ATTEMPTS = 3
+
+
+def read_staged_files(connection, dbname, projectid, inline=None):
+    """Read the staged files of the samples in a project
+
+    :param connection: a cloudant client, e.g. the connection of a
+        ProjectSummaryConnection
+    :param dbname: the database with the documents of the samples
+    :param inline: the staged_files of the project document, for the samples
+        without a document of their own
+    :returns: a dict with the staged files of each sample, by sample id
+    """
+    staged_files = dict(inline or {})
+    with metrics.database_request("statusdb"):
+        rows = connection.post_all_docs(
+            db=dbname,
+            start_key="{}_".format(projectid),
+            end_key="{}_\ufff0".format(projectid),
+            include_docs=True,
+        ).get_result()["rows"]
+    for row in rows:
+        doc = row.get("doc")
+        if doc and doc.get("project_id") == projectid:
+            staged_files[doc["sample_id"]] = doc.get("staged_files", {})
+    return staged_files
+
+
+def update_staged_files(connection, dbname, projectid, sampleid, files, inline=None):
+    """Merge the given staged files into the document of a sample, creating
+    the document if needed
+
+    :param files: a dict with the staged files of the sample
+    :param inline: a function returning the staged files of the sample in the
+        project document, which are carried over when the document of the
+        sample is created
+    :returns: the revision of the document, which is not written if the
+        staged files are already in it
+    """
+    for attempt in range(1, UPDATE_ATTEMPTS + 1):
+        try:
+            with metrics.database_request("statusdb"):
+                doc = connection.get_document(db=dbname, doc_id=sampleid).get_result()
+        except Exception as e:
+            if getattr(e, "code", None) != 404:
+                raise
+            doc = {
+                "project_id": projectid,
+                "sample_id": sampleid,
+                "staged_files": inline() if inline is not None else {},
+            }
+        merger = DictMerger(doc.setdefault("staged_files", {}))
+        merger.merge(files).materialise()
+        if "_rev" in doc and not merger.changed:
+            return doc["_rev"]
+        try:
+            with metrics.database_request("statusdb"):
+                return connection.put_document(
+                    db=dbname, doc_id=sampleid, document=doc
+                ).get_result()["rev"]
+        except Exception as e:
+            if getattr(e, "code", None) != 409 or attempt == UPDATE_ATTEMPTS:
+                raise
+            logger.debug(
+                "the staged files of {} were updated concurrently, retrying".format(
+                    sampleid
+                )
+            )
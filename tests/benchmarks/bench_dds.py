@@ -0,0 +1,113 @@
+"""Benchmark of the DDS deliverer's handling of dds output
+
+The scripted fake dds in tests/data/fake_dds is put first on PATH and
+`dds data put` is run with a large synthetic staging folder, once directly
+with its output discarded and once through DDSProjectDeliverer.upload_data,
+so the overhead of streaming, echoing and collecting the output can be told
+apart from the cost of the fake client itself, e.g.
+
+    python tests/benchmarks/bench_dds.py --files 2000 --progress-lines 100
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from unittest import mock
+
+from taca_ngi_pipeline.deliver import deliver, deliver_dds
+
+FAKE_DDS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "fake_dds"
+)
+
+
+def create_staging_folder(stagingpath, files):
+    for n in range(files):
+        sampledir = os.path.join(stagingpath, "P1_{}".format(1001 + n // 8), "02-FASTQ")
+        os.makedirs(sampledir, exist_ok=True)
+        open(
+            os.path.join(
+                sampledir, "P1_{}_L00{}_R1_001.fastq.gz".format(1001 + n // 8, n % 8)
+            ),
+            "w",
+        ).close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--progress-lines", type=int, default=50)
+    parser.add_argument("--line-length", type=int, default=120)
+    parser.add_argument(
+        "--delay", type=float, default=0.0, help="seconds between output lines"
+    )
+    parser.add_argument("--output", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    rootdir = tempfile.mkdtemp(prefix="bench_taca_dds_")
+    stagingpath = os.path.join(rootdir, "STAGING")
+    create_staging_folder(stagingpath, args.files)
+    env = {
+        "PATH": os.pathsep.join([FAKE_DDS_DIR, os.environ.get("PATH", "")]),
+        "FAKE_DDS_PROGRESS_LINES": str(args.progress_lines),
+        "FAKE_DDS_LINE_LENGTH": str(args.line_length),
+        "FAKE_DDS_DELAY": str(args.delay),
+    }
+    config = {
+        "log": {"file": os.path.join(rootdir, "logs", "taca.log")},
+        "deliver": {"stagingpath": stagingpath},
+    }
+    results = {}
+    try:
+        with (
+            mock.patch.dict(os.environ, env),
+            mock.patch.dict(deliver_dds.CONFIG, config),
+        ):
+            cmd = ["dds", "--no-prompt", "data", "put", "--source", stagingpath]
+            start = time.perf_counter()
+            subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+            results["fake_dds_seconds"] = time.perf_counter() - start
+
+            with mock.patch.object(deliver.db, "dbcon"):
+                deliverer = deliver_dds.DDSProjectDeliverer("P1", do_release=True)
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()) as echoed:
+                status = deliverer.upload_data("ngisthlm00001")
+            results["upload_data_seconds"] = time.perf_counter() - start
+            results["status"] = status
+            results["lines"] = echoed.getvalue().count("\n")
+            results["bytes"] = len(echoed.getvalue())
+            results["max_rss_increase_kb"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+            )
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+    results["overhead_seconds"] = (
+        results["upload_data_seconds"] - results["fake_dds_seconds"]
+    )
+    results["lines_per_second"] = results["lines"] / results["upload_data_seconds"]
+    report = {
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Benchmark of the checksum kernel against taca's hashfile
+
+A file is hashed with taca.utils.misc.hashfile and with stream_digest at a
+range of block sizes, and the throughput of each is reported in MB/s. The
+integrity algorithms used for the internal tree digests are measured too,
+both read sequentially and with tree_digest on --tree-workers threads. The
+file is created under --tmpdir, which can be on a network filesystem to
+measure it there, or an existing file can be given with --file, e.g.
+
+    python tests/benchmarks/bench_hashing.py --tmpdir /proj/ngi/nobackup \\
+        --size 4096 --blocksize 1 8 32
+
+The pages of the file are dropped from the page cache before each run, so
+that the file is read from storage rather than from memory. This only works
+for pages that are not dirty and where posix_fadvise is available, so the
+created file is synced before the runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from taca.utils.misc import hashfile
+
+from taca_ngi_pipeline.utils import filesystem as fs
+
+MB = 1024 * 1024
+
+
+def create_file(tmpdir, size):
+    fd, fpath = tempfile.mkstemp(prefix="bench_taca_hashing_", dir=tmpdir)
+    block = os.urandom(MB)
+    with os.fdopen(fd, "wb") as fh:
+        for _ in range(size):
+            fh.write(block)
+        fh.flush()
+        os.fsync(fh.fileno())
+    return fpath
+
+
+def drop_from_cache(fpath):
+    fd = os.open(fpath, os.O_RDONLY)
+    try:
+        fs._fadvise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
+
+
+def timed(fn, fpath, repeat, cold):
+    """Hash a file `repeat` times
+    :returns: a dict with the timings of the runs and the best throughput
+    """
+    seconds = []
+    for _ in range(repeat):
+        if cold:
+            drop_from_cache(fpath)
+        start = time.perf_counter()
+        fn(fpath)
+        seconds.append(time.perf_counter() - start)
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "mb_per_second": os.path.getsize(fpath) / MB / min(seconds),
+    }
+
+
+def _integrity_digest(fpath, algorithm):
+    tree = fs.TreeHasher(algorithm=algorithm)
+    with open(fpath, "rb", buffering=0) as fh:
+        for block in fs._read_blocks(fh, fs.DEFAULT_HASH_BLOCKSIZE):
+            tree.update(block)
+    return tree.tree()
+
+
+def run_benchmarks(
+    fpath, hash_algorithm, blocksizes, repeat, cold, integrity_algorithms, workers
+):
+    results = {
+        "taca_hashfile": timed(
+            lambda f: hashfile(f, hasher=hash_algorithm), fpath, repeat, cold
+        )
+    }
+    for blocksize in blocksizes:
+        results["stream_digest_{}mb".format(blocksize)] = timed(
+            lambda f, b=blocksize: fs.stream_digest(
+                f, hash_algorithm, blocksize=b * MB
+            ),
+            fpath,
+            repeat,
+            cold,
+        )
+    for algorithm in integrity_algorithms:
+        results["integrity_{}".format(algorithm)] = timed(
+            lambda f, a=algorithm: _integrity_digest(f, a), fpath, repeat, cold
+        )
+        results["tree_digest_{}_{}w".format(algorithm, workers)] = timed(
+            lambda f, a=algorithm: fs.tree_digest(f, workers=workers, algorithm=a),
+            fpath,
+            repeat,
+            cold,
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--file", default=None, help="hash this file")
+    parser.add_argument(
+        "--tmpdir", default=None, help="create the file to hash under this path"
+    )
+    parser.add_argument(
+        "--size", type=int, default=1024, help="size of the created file in MB"
+    )
+    parser.add_argument(
+        "--blocksize",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32],
+        help="block sizes in MB to run stream_digest with",
+    )
+    parser.add_argument("--hash-algorithm", default="md5")
+    parser.add_argument(
+        "--integrity-algorithm",
+        nargs="+",
+        default=["blake2b"] + (["xxh3_128"] if fs.xxhash is not None else []),
+        help="integrity algorithms to compute tree digests with",
+    )
+    parser.add_argument("--tree-workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="do not drop the file from the page cache before each run",
+    )
+    parser.add_argument("--output", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    fpath = args.file or create_file(args.tmpdir, args.size)
+    try:
+        results = run_benchmarks(
+            fpath,
+            args.hash_algorithm,
+            args.blocksize,
+            args.repeat,
+            not args.warm,
+            args.integrity_algorithm,
+            args.tree_workers,
+        )
+    finally:
+        if args.file is None:
+            os.unlink(fpath)
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    print(
+        "\n".join(
+            "{:<24}{:>10.1f} MB/s".format(name, result["mb_per_second"])
+            for name, result in results.items()
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Benchmarks for the staging and hashing hot paths
+
+A synthetic project tree is generated under a temporary directory and
+gather_files, stage_delivery, parse_hash_file, merge_dicts and expand_path
+are timed on it, with Charon and StatusDB mocked. The results are written as
+JSON so that runs on different commits can be compared, e.g.
+
+    python tests/benchmarks/bench_staging.py --samples 100 --output before.json
+    git checkout my-branch
+    python tests/benchmarks/bench_staging.py --samples 100 --output after.json \\
+        --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from unittest import mock
+
+from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.utils import filesystem as fs
+
+DELIVERCFG = {
+    "analysispath": "<ROOTDIR>/ANALYSIS",
+    "datapath": "<ROOTDIR>/DATA",
+    "stagingpath": "<ROOTDIR>/STAGING",
+    "deliverypath": "<ROOTDIR>/DELIVERY",
+    "logpath": "<ROOTDIR>/logs",
+    "reportpath": "<ANALYSISPATH>",
+    "hash_algorithm": "md5",
+    "files_to_deliver": [
+        ["<DATAPATH>/<SAMPLEID>", "<STAGINGPATH>/<SAMPLEID>/02-FASTQ"],
+        ["<ANALYSISPATH>/reports/<SAMPLEID>_*.html", "<STAGINGPATH>/00-Reports"],
+        ["<ANALYSISPATH>/qc/<SAMPLEID>.*", "<STAGINGPATH>/<SAMPLEID>/01-QC"],
+    ],
+}
+
+
+def create_project_tree(
+    rootdir, samples, files_per_sample, file_size, depth, projectid="P1"
+):
+    """Create a synthetic project with data files nested `depth` levels
+    below each sample folder and shared report and qc folders holding
+    files for all samples
+
+    :returns: the list of sample ids
+    """
+    sampleids = ["{}_{}".format(projectid, 1001 + n) for n in range(samples)]
+    content = os.urandom(min(file_size, 1024 * 1024))
+    for folder in ["reports", "qc"]:
+        os.makedirs(os.path.join(rootdir, "ANALYSIS", folder))
+    for sampleid in sampleids:
+        datadir = os.path.join(
+            rootdir, "DATA", sampleid, *["level{}".format(d) for d in range(depth)]
+        )
+        os.makedirs(datadir)
+        for n in range(files_per_sample):
+            fpath = os.path.join(
+                datadir, "{}_L00{}_R1_001.fastq.gz".format(sampleid, n)
+            )
+            with open(fpath, "wb") as fh:
+                written = 0
+                while written < file_size:
+                    chunk = content[: file_size - written]
+                    fh.write(chunk)
+                    written += len(chunk)
+        for fname in [
+            os.path.join("reports", "{}_sample_report.html".format(sampleid)),
+            os.path.join("qc", "{}.metrics".format(sampleid)),
+            os.path.join("qc", "{}.qc".format(sampleid)),
+        ]:
+            with open(os.path.join(rootdir, "ANALYSIS", fname), "w") as fh:
+                fh.write(sampleid)
+    return sampleids
+
+
+def remove_checksum_files(rootdir, hash_algorithm):
+    for dirpath, _, files in os.walk(rootdir):
+        for fname in files:
+            if fname.endswith(".{}".format(hash_algorithm)):
+                os.unlink(os.path.join(dirpath, fname))
+
+
+def timed(fn, repeat):
+    """Call a function `repeat` times
+    :returns: a dict with the timings of the calls and the last result
+    """
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "mean": sum(seconds) / len(seconds),
+    }, result
+
+
+def run_benchmarks(rootdir, sampleids, repeat, hash_workers):
+    results = {}
+    cfg = dict(DELIVERCFG, rootdir=rootdir, hash_workers=hash_workers)
+    with (
+        mock.patch.object(deliver.db, "dbcon"),
+        mock.patch.object(deliver, "ProjectSummaryConnection"),
+    ):
+        deliverers = [
+            deliver.SampleDeliverer("P1", sampleid, **cfg) for sampleid in sampleids
+        ]
+
+        results["expand_path"], _ = timed(
+            lambda: [
+                d.expand_path(p)
+                for d in deliverers
+                for pattern in d.files_to_deliver
+                for p in pattern[0:2]
+            ],
+            repeat,
+        )
+
+        def _gather(no_checksum, listing_cache=None):
+            count = 0
+            for d in deliverers:
+                d.no_checksum = no_checksum
+                d.listing_cache = listing_cache
+                count += sum(1 for _ in d.gather_files())
+            return count
+
+        results["gather_files_no_checksum"], nfiles = timed(
+            lambda: _gather(True), repeat
+        )
+        results["gather_files_listing_cache"], _ = timed(
+            lambda: _gather(True, fs.DirectoryListingCache(racy_seconds=0)), repeat
+        )
+
+        def _gather_hashing():
+            remove_checksum_files(rootdir, cfg["hash_algorithm"])
+            return _gather(False)
+
+        results["gather_files_hashing"], _ = timed(_gather_hashing, repeat)
+        results["gather_files_cached_checksums"], _ = timed(
+            lambda: _gather(False), repeat
+        )
+
+        def _stage():
+            shutil.rmtree(os.path.join(rootdir, "STAGING"), ignore_errors=True)
+            return all(d.stage_delivery() for d in deliverers)
+
+        results["stage_delivery"], _ = timed(_stage, repeat)
+
+        stagingpath = os.path.join(rootdir, "STAGING")
+        digestfiles = [d.staging_digestfile() for d in deliverers]
+        results["parse_hash_file"], parsed = timed(
+            lambda: [
+                fs.parse_hash_file(
+                    digestfile,
+                    str(datetime.datetime.now()),
+                    hash_algorithm=cfg["hash_algorithm"],
+                    root_path=stagingpath,
+                    files_filter=[".fastq", ".bam"],
+                )
+                for digestfile in digestfiles
+            ],
+            repeat,
+        )
+
+        def _merge():
+            merger = fs.DictMerger()
+            for hash_dict in parsed:
+                merger.merge(hash_dict)
+            return merger.materialise()
+
+        results["merge_dicts"], _ = timed(_merge, repeat)
+
+    for name in results:
+        results[name]["items"] = (
+            nfiles if name.startswith(("gather", "stage")) else None
+        )
+    return results
+
+
+def _git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(current, previous):
+    """Print the relative change in the minimum time of each benchmark"""
+    print(
+        "{:<32}{:>12}{:>12}{:>10}".format(
+            "benchmark", "before (s)", "after (s)", "change"
+        )
+    )
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        change = (result["min"] - before["min"]) / before["min"] if before["min"] else 0
+        print(
+            "{:<32}{:>12.4f}{:>12.4f}{:>9.1f}%".format(
+                name, before["min"], result["min"], 100 * change
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--files-per-sample", type=int, default=8)
+    parser.add_argument(
+        "--file-size", type=int, default=1024 * 1024, help="size of data files in bytes"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=2, help="directory depth below each sample"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--hash-workers", type=int, default=1)
+    parser.add_argument(
+        "--tmpdir", default=None, help="create the synthetic tree under this path"
+    )
+    parser.add_argument("--output", default=None, help="write the results to this file")
+    parser.add_argument(
+        "--compare", default=None, help="compare with the results in this file"
+    )
+    args = parser.parse_args()
+
+    rootdir = tempfile.mkdtemp(prefix="bench_taca_deliver_", dir=args.tmpdir)
+    try:
+        sampleids = create_project_tree(
+            rootdir, args.samples, args.files_per_sample, args.file_size, args.depth
+        )
+        results = run_benchmarks(rootdir, sampleids, args.repeat, args.hash_workers)
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": {
+            k: v for k, v in vars(args).items() if k not in ["output", "compare"]
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            compare(report, json.load(fh))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+"""In-process HTTP stand-ins for Charon and the StatusDB CouchDB
+
+The stand-ins serve the subset of the Charon REST API and the CouchDB
+document and view API that the deliveries use, backed by plain dicts. Every
+request is recorded, and a latency and a failure rate can be injected, so that
+the cost of the database round trips of a delivery can be measured, e.g.
+
+    with FakeCharon(latency=0.02) as charon:
+        os.environ["CHARON_BASE_URL"] = charon.url
+        ...
+        print(charon.request_counts(by="sampleid"))
+"""
+
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        self.server.service.dispatch(self)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _dispatch
+
+
+class FakeService(object):
+    """Base class of the stand-ins, handling the server thread, the latency
+    and failure injection and the bookkeeping of the requests
+
+    :param float latency: seconds to wait before answering each request
+    :param float jitter: at most this many seconds are added to the latency
+    :param float failure_rate: fraction of the requests to answer with
+        `failure_status` instead of handling them
+    :param int failure_status: the HTTP status of the injected failures
+    :param fail_routes: only inject failures for these routes, defaults to
+        all routes
+    :param int seed: seed for the random jitter and failures
+    :param ssl_context: serve over https using this ssl.SSLContext
+    """
+
+    # list of (method, regex, route name) to match the request paths against,
+    # the named groups of the regex are passed to the handler method
+    # `<route name>`
+    ROUTES = []
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        failure_rate=0.0,
+        failure_status=503,
+        fail_routes=None,
+        seed=None,
+        ssl_context=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.fail_routes = fail_routes
+        self.ssl_context = ssl_context
+        self.requests = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._routes = [
+            (method, re.compile("^{}$".format(regex)), name)
+            for method, regex, name in self.ROUTES
+        ]
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[0:2]
+        return "{}://{}:{}".format("https" if self.ssl_context else "http", host, port)
+
+    @property
+    def address(self):
+        """host:port of the running server"""
+        return "{}:{}".format(*self._server.server_address[0:2])
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        if self.ssl_context is not None:
+            self._server.socket = self.ssl_context.wrap_socket(
+                self._server.socket, server_side=True
+            )
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name=type(self).__name__
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_requests(self):
+        with self._lock:
+            self.requests = []
+
+    def request_counts(self, by="route"):
+        """Count the recorded requests
+
+        :param by: the field of the request records to count by, one of
+            'method', 'route', 'projectid' or 'sampleid'
+        :returns: a dict with the number of requests for each value of the
+            field
+        """
+        with self._lock:
+            return dict(collections.Counter(r[by] for r in self.requests))
+
+    def _record(self, method, route, params, status, started):
+        with self._lock:
+            self.requests.append(
+                {
+                    "method": method,
+                    "route": route,
+                    "projectid": params.get("projectid"),
+                    "sampleid": params.get("sampleid"),
+                    "status": status,
+                    "seconds": time.perf_counter() - started,
+                }
+            )
+
+    def _inject_failure(self, route):
+        if not self.failure_rate:
+            return False
+        if self.fail_routes is not None and route not in self.fail_routes:
+            return False
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def _sleep(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def dispatch(self, handler):
+        started = time.perf_counter()
+        parts = urlsplit(handler.path)
+        path = unquote(parts.path)
+        query = dict(parse_qsl(parts.query))
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        route, params, fn = "unknown", {}, None
+        for method, regex, name in self._routes:
+            match = regex.match(path)
+            if match and method == handler.command:
+                route, params, fn = name, match.groupdict(), getattr(self, name)
+                break
+        self._sleep()
+        if fn is None:
+            status, payload, headers = 404, {"error": "not_found"}, {}
+        elif self._inject_failure(route):
+            status, payload, headers = (
+                self.failure_status,
+                {"error": "injected failure"},
+                {},
+            )
+        else:
+            try:
+                status, payload, headers = fn(
+                    query=query, body=self._decode(body, handler), **params
+                )
+            except Exception as e:
+                status, payload, headers = 500, {"error": repr(e)}, {}
+        self._record(handler.command, route, params, status, started)
+        self._respond(handler, status, payload, headers)
+
+    @staticmethod
+    def _decode(body, handler):
+        if not body:
+            return None
+        if "application/x-www-form-urlencoded" in handler.headers.get(
+            "Content-Type", ""
+        ):
+            return dict(parse_qsl(body.decode()))
+        return json.loads(body)
+
+    @staticmethod
+    def _respond(handler, status, payload, headers):
+        data = b"" if payload is None else json.dumps(payload).encode()
+        handler.send_response(status)
+        if payload is not None:
+            handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(data)
+
+
+class FakeCharon(FakeService):
+    """Stand-in for the Charon project and sample endpoints used by
+    ngi_pipeline.database.classes.CharonSession. Point CHARON_BASE_URL at
+    `url` before ngi_pipeline is imported.
+
+    Projects and samples are kept in `projects` and `samples`, the latter
+    keyed by project id and sample id.
+    """
+
+    ROUTES = [
+        ("GET", r"/api/v1/project/(?P<projectid>[^/]+)/?", "get_project"),
+        ("PUT", r"/api/v1/project/(?P<projectid>[^/]+)/?", "update_project"),
+        ("GET", r"/api/v1/samples/(?P<projectid>[^/]+)/?", "get_samples"),
+        (
+            "GET",
+            r"/api/v1/sample/(?P<projectid>[^/]+)/(?P<sampleid>[^/]+)/?",
+            "get_sample",
+        ),
+        (
+            "PUT",
+            r"/api/v1/sample/(?P<projectid>[^/]+)/(?P<sampleid>[^/]+)/?",
+            "update_sample",
+        ),
+    ]
+
+    def __init__(self, **kwargs):
+        super(FakeCharon, self).__init__(**kwargs)
+        self.projects = {}
+        self.samples = {}
+
+    def add_project(self, projectid, samples=None, **fields):
+        """Add a project and its samples
+
+        :param samples: dict with the fields of each sample, keyed by sample id
+        """
+        with self._lock:
+            self.projects[projectid] = dict(fields, projectid=projectid)
+            self.samples[projectid] = {
+                sampleid: dict(sample, projectid=projectid, sampleid=sampleid)
+                for sampleid, sample in (samples or {}).items()
+            }
+
+    def get_project(self, projectid, **kwargs):
+        with self._lock:
+            if projectid not in self.projects:
+                return 404, {"error": "no such project"}, {}
+            return 200, dict(self.projects[projectid]), {}
+
+    def update_project(self, projectid, body=None, **kwargs):
+        with self._lock:
+            if projectid not in self.projects:
+                return 404, {"error": "no such project"}, {}
+            self.projects[projectid].update(body or {})
+            return 204, None, {}
+
+    def get_samples(self, projectid, **kwargs):
+        with self._lock:
+            if projectid not in self.projects:
+                return 404, {"error": "no such project"}, {}
+            return (
+                200,
+                {"samples": [dict(s) for s in self.samples[projectid].values()]},
+                {},
+            )
+
+    def get_sample(self, projectid, sampleid, **kwargs):
+        with self._lock:
+            sample = self.samples.get(projectid, {}).get(sampleid)
+            if sample is None:
+                return 404, {"error": "no such sample"}, {}
+            return 200, dict(sample), {}
+
+    def update_sample(self, projectid, sampleid, body=None, **kwargs):
+        with self._lock:
+            sample = self.samples.get(projectid, {}).get(sampleid)
+            if sample is None:
+                return 404, {"error": "no such sample"}, {}
+            sample.update(body or {})
+            return 204, None, {}
+
+
+class FakeCouchDB(FakeService):
+    """Stand-in for the parts of the CouchDB API used through
+    taca.utils.statusdb, i.e. session authentication, fetching and saving
+    documents, `_all_docs` and views.
+
+    Documents are kept in `databases`, keyed by database name and document
+    id. A view is a function taking a document and returning a list of
+    (key, value) tuples, registered with `add_view`. The views of the
+    `projects` database used by ProjectSummaryConnection and the order portal
+    view are registered by default.
+    """
+
+    ROUTES = [
+        ("GET", r"/", "server_information"),
+        ("POST", r"/_session", "create_session"),
+        ("GET", r"/_session", "get_session"),
+        ("DELETE", r"/_session", "delete_session"),
+        ("GET", r"/(?P<db>[^/_][^/]*)/_all_docs", "all_docs"),
+        ("POST", r"/(?P<db>[^/_][^/]*)/_all_docs", "all_docs"),
+        (
+            "GET",
+            r"/(?P<db>[^/_][^/]*)/_design/(?P<ddoc>[^/]+)/_view/(?P<view>[^/]+)",
+            "query_view",
+        ),
+        (
+            "POST",
+            r"/(?P<db>[^/_][^/]*)/_design/(?P<ddoc>[^/]+)/_view/(?P<view>[^/]+)",
+            "query_view",
+        ),
+        ("GET", r"/(?P<db>[^/_][^/]*)/?", "database_information"),
+        ("POST", r"/(?P<db>[^/_][^/]*)/?", "post_document"),
+        ("GET", r"/(?P<db>[^/_][^/]*)/(?P<docid>[^/]+)", "get_document"),
+        ("PUT", r"/(?P<db>[^/_][^/]*)/(?P<docid>[^/]+)", "put_document"),
+    ]
+
+    def __init__(self, **kwargs):
+        super(FakeCouchDB, self).__init__(**kwargs)
+        self.databases = collections.defaultdict(dict)
+        self.views = {}
+        self.add_view(
+            "projects",
+            "project",
+            "project_name",
+            lambda doc: [(doc["project_name"], None)] if "project_name" in doc else [],
+        )
+        self.add_view(
+            "projects",
+            "project",
+            "project_id",
+            lambda doc: [(doc["project_id"], None)] if "project_id" in doc else [],
+        )
+        self.add_view(
+            "projects",
+            "order_portal",
+            "ProjectID_to_PortalID",
+            lambda doc: (
+                [(doc["project_id"], doc["details"]["portal_id"])]
+                if "portal_id" in doc.get("details", {})
+                else []
+            ),
+        )
+
+    def add_view(self, db, ddoc, view, map_fn):
+        self.views[(db, ddoc, view)] = map_fn
+
+    def add_document(self, db, doc):
+        """Add a document, generating its _id if missing
+        :returns: the stored document
+        """
+        with self._lock:
+            doc = dict(doc)
+            doc.setdefault("_id", uuid.uuid4().hex)
+            doc["_rev"] = self._next_rev(None)
+            self.databases[db][doc["_id"]] = doc
+            return doc
+
+    def _record(self, method, route, params, status, started):
+        # count the document requests against the project they concern
+        doc = self.databases.get(params.get("db"), {}).get(params.get("docid"), {})
+        if "project_id" in doc:
+            params = dict(params, projectid=doc["project_id"])
+        super(FakeCouchDB, self)._record(method, route, params, status, started)
+
+    @staticmethod
+    def _next_rev(rev):
+        generation = int(rev.split("-")[0]) if rev else 0
+        return "{}-{}".format(generation + 1, uuid.uuid4().hex)
+
+    def _save(self, db, doc):
+        if db not in self.databases:
+            return 404, {"error": "not_found", "reason": "Database does not exist."}
+        current = self.databases[db].get(doc["_id"])
+        if current is not None and current["_rev"] != doc.get("_rev"):
+            return 409, {"error": "conflict", "reason": "Document update conflict."}
+        doc = dict(doc, _rev=self._next_rev(doc.get("_rev")))
+        self.databases[db][doc["_id"]] = doc
+        return 201, {"ok": True, "id": doc["_id"], "rev": doc["_rev"]}
+
+    def server_information(self, **kwargs):
+        return 200, {"couchdb": "Welcome", "version": "3.3.3"}, {}
+
+    def create_session(self, body=None, **kwargs):
+        headers = {"Set-Cookie": "AuthSession=fake; Version=1; Path=/; HttpOnly"}
+        return 200, {"ok": True, "name": (body or {}).get("name"), "roles": []}, headers
+
+    def get_session(self, **kwargs):
+        return 200, {"ok": True, "userCtx": {"name": None, "roles": []}}, {}
+
+    def delete_session(self, **kwargs):
+        return 200, {"ok": True}, {}
+
+    def database_information(self, db, **kwargs):
+        with self._lock:
+            if db not in self.databases:
+                return 404, {"error": "not_found"}, {}
+            return 200, {"db_name": db, "doc_count": len(self.databases[db])}, {}
+
+    def get_document(self, db, docid, **kwargs):
+        with self._lock:
+            doc = self.databases.get(db, {}).get(docid)
+            if doc is None:
+                return 404, {"error": "not_found", "reason": "missing"}, {}
+            return 200, json.loads(json.dumps(doc)), {}
+
+    def put_document(self, db, docid, body=None, **kwargs):
+        with self._lock:
+            status, payload = self._save(db, dict(body or {}, _id=docid))
+            return status, payload, {}
+
+    def post_document(self, db, body=None, **kwargs):
+        doc = dict(body or {})
+        doc.setdefault("_id", uuid.uuid4().hex)
+        with self._lock:
+            status, payload = self._save(db, doc)
+            return status, payload, {}
+
+    @staticmethod
+    def _query_options(query, body):
+        """Merge the view options given in the query string, where they are
+        json encoded, and in the request body
+        """
+        options = {}
+        for key, value in query.items():
+            try:
+                options[key] = json.loads(value)
+            except ValueError:
+                options[key] = value
+        options.update(body or {})
+        return options
+
+    def _rows(self, db, rows, options):
+        if "key" in options:
+            rows = [r for r in rows if r["key"] == options["key"]]
+        if "keys" in options:
+            rows = [r for key in options["keys"] for r in rows if r["key"] == key]
+        if "start_key" in options:
+            rows = [r for r in rows if r["key"] >= options["start_key"]]
+        if "end_key" in options:
+            rows = [r for r in rows if r["key"] <= options["end_key"]]
+        if options.get("include_docs"):
+            rows = [
+                dict(r, doc=json.loads(json.dumps(self.databases[db][r["id"]])))
+                for r in rows
+            ]
+        return {"total_rows": len(rows), "offset": 0, "rows": rows}
+
+    def all_docs(self, db, query=None, body=None, **kwargs):
+        options = self._query_options(query or {}, body)
+        with self._lock:
+            if db not in self.databases:
+                return 404, {"error": "not_found"}, {}
+            rows = [
+                {"id": docid, "key": docid, "value": {"rev": doc["_rev"]}}
+                for docid, doc in sorted(self.databases[db].items())
+            ]
+            return 200, self._rows(db, rows, options), {}
+
+    def query_view(self, db, ddoc, view, query=None, body=None, **kwargs):
+        options = self._query_options(query or {}, body)
+        map_fn = self.views.get((db, ddoc, view))
+        if map_fn is None:
+            return 404, {"error": "not_found", "reason": "missing_named_view"}, {}
+        with self._lock:
+            rows = [
+                {"id": docid, "key": key, "value": value}
+                for docid, doc in sorted(self.databases.get(db, {}).items())
+                for key, value in map_fn(doc)
+            ]
+            return 200, self._rows(db, rows, options), {}
@@ -0,0 +1,297 @@
+"""Load test of project deliveries against local Charon and StatusDB stand-ins
+
+Synthetic projects are generated under a temporary directory, registered in
+the stand-ins from fake_services.py and delivered one after the other with
+ProjectDeliverer.deliver_project, using the real Charon and StatusDB clients.
+The number of requests each project and sample made, and the wall time of each
+project delivery, are reported as JSON, e.g.
+
+    python tests/benchmarks/load_deliveries.py --projects 5 --samples 20 \\
+        --charon-latency 0.02 --stage-only --save-meta-info
+
+The StatusDB client connects over https, so a self-signed certificate is
+created with openssl for the CouchDB stand-in and trusted through
+REQUESTS_CA_BUNDLE.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from fake_services import FakeCharon, FakeCouchDB
+
+
+def delivery_config(rootdir, stage_only, save_meta_info, staged_files_db=None):
+    return {
+        "analysispath": os.path.join(rootdir, "<PROJECTID>", "ANALYSIS"),
+        "datapath": os.path.join(rootdir, "<PROJECTID>", "DATA"),
+        "stagingpath": os.path.join(rootdir, "<PROJECTID>", "STAGING"),
+        "deliverypath": os.path.join(rootdir, "<PROJECTID>", "DELIVERY"),
+        "logpath": os.path.join(rootdir, "<PROJECTID>", "logs"),
+        "reportpath": "<ANALYSISPATH>",
+        "deliverystatuspath": "<ANALYSISPATH>/delivery_status",
+        "copy_reports_to_reports_outbox": False,
+        "hash_algorithm": "md5",
+        "stage_only": stage_only,
+        "save_meta_info": save_meta_info,
+        "staged_files_db": staged_files_db,
+        "files_to_deliver": [
+            ["<DATAPATH>/<SAMPLEID>", "<STAGINGPATH>/<SAMPLEID>/02-FASTQ"],
+            ["<ANALYSISPATH>/reports/<SAMPLEID>_*.html", "<STAGINGPATH>/00-Reports"],
+            ["<ANALYSISPATH>/qc/<SAMPLEID>.*", "<STAGINGPATH>/<SAMPLEID>/01-QC"],
+        ],
+    }
+
+
+def make_tls_context(workdir):
+    """Create a self-signed certificate for 127.0.0.1
+    :returns: an ssl context serving it and the path to the certificate,
+        or (None, None) if openssl is not available
+    """
+    certfile = os.path.join(workdir, "cert.pem")
+    keyfile = os.path.join(workdir, "key.pem")
+    try:
+        subprocess.check_call(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-days",
+                "1",
+                "-subj",
+                "/CN=127.0.0.1",
+                "-addext",
+                "subjectAltName=IP:127.0.0.1",
+                "-keyout",
+                keyfile,
+                "-out",
+                certfile,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None, None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context, certfile
+
+
+def seed_project(charon, couchdb, projectid, sampleids):
+    projectname = "A.Load_{}_26".format(projectid)
+    charon.add_project(
+        projectid,
+        samples={
+            sampleid: {
+                "analysis_status": "ANALYZED",
+                "delivery_status": "NOT_DELIVERED",
+                "status": "STALE",
+            }
+            for sampleid in sampleids
+        },
+        name=projectname,
+        delivery_status="NOT_DELIVERED",
+    )
+    couchdb.add_document(
+        "projects",
+        {
+            "project_id": projectid,
+            "project_name": projectname,
+            "staged_files": {},
+            "samples": {sampleid: {} for sampleid in sampleids},
+            "details": {},
+        },
+    )
+
+
+def summarize(requests, key):
+    counts = {}
+    for request in requests:
+        if request[key] is not None:
+            counts[request[key]] = counts.get(request[key], 0) + 1
+    values = sorted(counts.values())
+    if not values:
+        return None
+    return {
+        "min": values[0],
+        "median": values[len(values) // 2],
+        "max": values[-1],
+        "total": sum(values),
+    }
+
+
+def run_project(deliver, CONFIG, cfg, projectid, charon, couchdb):
+    charon.reset_requests()
+    couchdb.reset_requests()
+    # the deliverers update the configuration in place, so start from a copy
+    CONFIG["deliver"] = dict(cfg)
+    start = time.perf_counter()
+    error = None
+    try:
+        status = deliver.ProjectDeliverer(projectid).deliver_project()
+    except Exception as e:
+        status, error = False, repr(e)
+    seconds = time.perf_counter() - start
+    return {
+        "projectid": projectid,
+        "status": status,
+        "error": error,
+        "seconds": seconds,
+        "charon_requests": len(charon.requests),
+        "charon_requests_by_route": charon.request_counts(by="route"),
+        "charon_requests_per_sample": summarize(charon.requests, "sampleid"),
+        "charon_seconds": sum(r["seconds"] for r in charon.requests),
+        "couchdb_requests": len(couchdb.requests),
+        "couchdb_requests_by_route": couchdb.request_counts(by="route"),
+        "couchdb_seconds": sum(r["seconds"] for r in couchdb.requests),
+        "failed_requests": sum(
+            1 for r in charon.requests + couchdb.requests if r["status"] >= 400
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--projects", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--files-per-sample", type=int, default=4)
+    parser.add_argument(
+        "--file-size", type=int, default=64 * 1024, help="size of data files in bytes"
+    )
+    parser.add_argument(
+        "--charon-latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--couchdb-latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="maximum extra seconds per request"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the requests to fail with a 503",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--stage-only", action="store_true", help="stage without transferring"
+    )
+    parser.add_argument(
+        "--save-meta-info",
+        action="store_true",
+        help="save the staged files of each sample in StatusDB",
+    )
+    parser.add_argument(
+        "--staged-files-db",
+        default=None,
+        help="save the staged files in one document per sample in this database, "
+        "instead of in the project documents",
+    )
+    parser.add_argument(
+        "--tmpdir", default=None, help="create the synthetic tree under this path"
+    )
+    parser.add_argument("--output", default=None, help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if not args.stage_only and shutil.which("rsync") is None:
+        parser.error("rsync is needed for the transfers, or use --stage-only")
+
+    rootdir = tempfile.mkdtemp(prefix="load_taca_deliver_", dir=args.tmpdir)
+    service_kwargs = {
+        "jitter": args.jitter,
+        "failure_rate": args.failure_rate,
+        "seed": args.seed,
+    }
+    ssl_context, certfile = make_tls_context(rootdir)
+    if ssl_context is None:
+        logging.warning("openssl is not available, serving StatusDB over http")
+    charon = FakeCharon(latency=args.charon_latency, **service_kwargs)
+    couchdb = FakeCouchDB(
+        latency=args.couchdb_latency, ssl_context=ssl_context, **service_kwargs
+    )
+    try:
+        with charon, couchdb:
+            # the clients read their settings from the environment when imported
+            os.environ["CHARON_BASE_URL"] = charon.url
+            os.environ["CHARON_API_TOKEN"] = "load-test"
+            if certfile:
+                os.environ["REQUESTS_CA_BUNDLE"] = certfile
+            statusdb_config = os.path.join(rootdir, "statusdb.yaml")
+            with open(statusdb_config, "w") as fh:
+                yaml.safe_dump(
+                    {
+                        "statusdb": {
+                            "url": couchdb.address,
+                            "username": "load",
+                            "password": "test",
+                        }
+                    },
+                    fh,
+                )
+            os.environ["STATUS_DB_CONFIG"] = statusdb_config
+
+            from bench_staging import create_project_tree
+            from taca.utils.config import CONFIG
+            from taca_ngi_pipeline.deliver import deliver
+
+            cfg = delivery_config(
+                rootdir, args.stage_only, args.save_meta_info, args.staged_files_db
+            )
+            if args.staged_files_db:
+                couchdb.databases[args.staged_files_db] = {}
+            projectids = ["P{}".format(100 + n) for n in range(args.projects)]
+            for projectid in projectids:
+                sampleids = create_project_tree(
+                    os.path.join(rootdir, projectid),
+                    args.samples,
+                    args.files_per_sample,
+                    args.file_size,
+                    2,
+                    projectid=projectid,
+                )
+                seed_project(charon, couchdb, projectid, sampleids)
+            results = [
+                run_project(deliver, CONFIG, cfg, projectid, charon, couchdb)
+                for projectid in projectids
+            ]
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+    report = {
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ["output"]},
+        "projects": results,
+        "total_seconds": sum(r["seconds"] for r in results),
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    for r in results:
+        print(
+            "{projectid}: {seconds:.2f}s, {charon_requests} Charon and "
+            "{couchdb_requests} StatusDB requests, {failed_requests} failed".format(
+                **r
+            ),
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main()
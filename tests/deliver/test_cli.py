@@ -0,0 +1,175 @@
+"""Unit tests for the deliver command line interface"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import subprocess
+import sys
+import unittest
+
+from click.testing import CliRunner
+from taca.utils import config
+from unittest import mock
+
+from taca_ngi_pipeline import cli
+from taca_ngi_pipeline.deliver import deliver
+
+# modules that should only be imported by the commands needing them
+HEAVY_MODULES = [
+    "taca_ngi_pipeline.deliver.deliver",
+    "taca_ngi_pipeline.deliver.deliver_dds",
+    "taca_ngi_pipeline.utils.ena_tsv_generator",
+    "taca.utils.statusdb",
+    "ngi_pipeline",
+    "requests",
+    "yaml",
+    "scilifelab_metadata_templates",
+]
+
+
+class TestImport(unittest.TestCase):
+    def test_import_modules(self):
+        """the CLI is loaded by every taca invocation and should not import the
+        modules only some commands need"""
+        code = (
+            "import json, sys; import taca_ngi_pipeline.cli; "
+            "print(json.dumps(sorted(sys.modules)))"
+        )
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        modules = json.loads(
+            subprocess.check_output([sys.executable, "-c", code], env=env)
+        )
+        imported = [
+            m
+            for m in HEAVY_MODULES
+            if any(n == m or n.startswith(m + ".") for n in modules)
+        ]
+        self.assertEqual(imported, [])
+
+
+class TestProjectCommand(unittest.TestCase):
+    def setUp(self):
+        self.factory = logging.getLogRecordFactory()
+        self.config = mock.patch.dict(config.CONFIG, {"deliver": {}}, clear=True)
+        self.config.start()
+
+    def tearDown(self):
+        # the workers prefix the log records with the project id
+        logging.setLogRecordFactory(self.factory)
+        self.config.stop()
+
+    @mock.patch.object(deliver, "ProjectDeliverer")
+    def test_deliver_project_worker(self, deliverer_mock):
+        deliverer_mock.return_value.deliver_project.return_value = True
+        deliverer_mock.return_value.profile = False
+        status, seconds, snapshot = cli._deliver_project_worker(
+            {"deliver": {"stagingpath": "/stage"}}, "P1", {"stage_only": True}
+        )
+        self.assertTrue(status)
+        self.assertGreaterEqual(seconds, 0)
+        self.assertIn("taca_deliver_samples_total", snapshot)
+        deliverer_mock.assert_called_once_with("P1", stage_only=True)
+        self.assertEqual(config.CONFIG, {"deliver": {"stagingpath": "/stage"}})
+        record = logging.getLogRecordFactory()(
+            "test", logging.INFO, __file__, 1, "delivered", None, None
+        )
+        self.assertEqual(record.getMessage(), "[P1] delivered")
+
+    @mock.patch.object(
+        concurrent.futures, "ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor
+    )
+    @mock.patch("taca.utils.misc.send_mail")
+    @mock.patch.object(deliver, "ProjectDeliverer")
+    def test_project_jobs(self, deliverer_mock, mail_mock):
+        deliverer_mock.return_value.profile = False
+        deliverer_mock.return_value.deliver_project.side_effect = [
+            True,
+            False,
+            ValueError("failed"),
+        ]
+        result = CliRunner().invoke(
+            cli.deliver, ["project", "--jobs", "2", "P1", "P2", "P3"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(deliverer_mock.call_count, 3)
+        # the failed delivery notifies the operator
+        mail_mock.assert_called_once()
+        table = result.output.splitlines()
+        self.assertEqual(table[0].split(), ["project", "status", "duration"])
+        self.assertEqual(
+            sorted(line.split()[0] for line in table[1:]), ["P1", "P2", "P3"]
+        )
+
+    @mock.patch.object(deliver, "ProjectDeliverer")
+    def test_project_jobs_fc_delivery(self, deliverer_mock):
+        result = CliRunner().invoke(
+            cli.deliver,
+            ["project", "--jobs", "2", "--fc-delivery", "FC1", "P1", "P2"],
+        )
+        # the run folders are not delivered as projects
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn("--jobs cannot be combined with --fc-delivery", result.output)
+        deliverer_mock.assert_not_called()
+
+    @mock.patch.object(deliver, "generate_ena_tsv_files")
+    @mock.patch.object(deliver, "ProjectDeliverer")
+    def test_project_ena_tsv_batch(self, deliverer_mock, generate_mock):
+        generate_mock.return_value = [
+            {
+                "project": "P1",
+                "tsv_file": "P1_submission.tsv",
+                "rows": 2,
+                "validation_errors": 0,
+                "error": "",
+            },
+            {
+                "project": "P2",
+                "tsv_file": "",
+                "rows": 0,
+                "validation_errors": 0,
+                "error": "not found",
+            },
+        ]
+        result = CliRunner().invoke(
+            cli.deliver, ["--generate_ena_tsv_only", "project", "P1", "P2"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        # the projects are generated in one pass, not delivered one by one
+        generate_mock.assert_called_once()
+        self.assertEqual(len(generate_mock.call_args[0][0]), 2)
+        deliverer_mock.return_value.deliver_project.assert_not_called()
+        self.assertEqual(
+            result.output.splitlines()[1:],
+            ["P1\tP1_submission.tsv\t2\t0\t", "P2\t\t0\t0\tnot found"],
+        )
+
+    @mock.patch.object(deliver, "ProjectDeliverer")
+    def test_project_plan(self, deliverer_mock):
+        deliverer_mock.return_value.plan_delivery.side_effect = [
+            {"projectid": "P1"},
+            {"projectid": "P2"},
+        ]
+        result = CliRunner().invoke(
+            cli.deliver, ["--plan", "project", "--jobs", "2", "P1", "P2"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        # the plans are printed by the command and nothing is delivered
+        plan, end = json.JSONDecoder().raw_decode(result.output)
+        self.assertEqual(plan, {"projectid": "P1"})
+        self.assertEqual(json.loads(result.output[end:]), {"projectid": "P2"})
+        deliverer_mock.return_value.deliver_project.assert_not_called()
+
+    def test_summary_table(self):
+        table = cli._summary_table(
+            [("P1", True, 3725), ("P12345", False, 1.5), ("P2", None, 0)]
+        )
+        self.assertEqual(
+            table.splitlines(),
+            [
+                "project  status       duration",
+                "P1       ok           1:02:05",
+                "P12345   with errors  0:00:01",
+                "P2       failed       0:00:00",
+            ],
+        )
@@ -1,5 +1,6 @@
 """Unit tests for the deliver commands"""
 
+import gzip
 import json
 
 # noinspection PyPackageRequirements
@@ -9,11 +10,13 @@ import shutil
 import signal
 import taca_ngi_pipeline.utils.filesystem
 import tempfile
+import time
 import unittest
 
 from ngi_pipeline.database import classes as db
 from taca_ngi_pipeline.deliver import deliver
 from taca_ngi_pipeline.utils import filesystem as fs
+from taca_ngi_pipeline.utils import metrics
 from taca.utils.filesystem import create_folder
 from taca.utils.misc import hashfile
 from taca.utils.transfer import SymlinkError, SymlinkAgent
@@ -253,10 +256,11 @@ class TestDeliverer(unittest.TestCase):
             os.unlink(checksumfile)
         exp_checksum = "mocked-digest"
         with mock.patch.object(
-            taca_ngi_pipeline.utils.filesystem, "hashfile", return_value=exp_checksum
+            taca_ngi_pipeline.utils.filesystem,
+            "stream_digest",
+            return_value=exp_checksum,
         ):
             # ensure that a thrown IOError when writing checksum cache file is handled gracefully
-            # mock hashfile's call to open builtin
             with mock.patch.object(
                 fs, "open", side_effect=IOError("mocked IOError")
             ) as iomock:
@@ -468,6 +472,172 @@ class TestDeliverer(unittest.TestCase):
             [os.path.exists(e) for e in expected], [True for _ in range(len(expected))]
         )
 
+    def test_stage_delivery_check_gzip(self):
+        """A corrupt gzip file fails the staging"""
+        datapath = self.deliverer.expand_path(self.deliverer.datapath)
+        with open(os.path.join(datapath, "sample.fastq.gz"), "wb") as fh:
+            fh.write(gzip.compress(b"@read\nACGT\n+\nIIII\n")[:-2])
+        self.deliverer.files_to_deliver = [["<DATAPATH>/*.fastq.gz", "<STAGINGPATH>"]]
+        self.deliverer.check_gzip = True
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.stage_delivery()
+
+    def test_stage_delivery_waits_for_reports(self):
+        """Report files are not looked for before the reports are created"""
+        reportpath = self.deliverer.expand_path("<ANALYSISPATH>/reports")
+        os.mkdir(reportpath)
+
+        def _create_report():
+            # the report is created well after the staging has started
+            time.sleep(0.2)
+            with open(os.path.join(reportpath, "sample_report.html"), "w") as fh:
+                fh.write("report")
+
+        staged = self.deliverer.expand_path("<STAGINGPATH>/sample_report.html")
+        for options in ({"report": True}, {}):
+            self.deliverer.files_to_deliver = [
+                ["<DATAPATH>/level0_folder0_file0", "<STAGINGPATH>"],
+                ["<ANALYSISPATH>/reports/*_report.html", "<STAGINGPATH>", options],
+            ]
+            with mock.patch.object(
+                self.deliverer, "create_report", side_effect=_create_report, create=True
+            ):
+                future = self.deliverer.start_report()
+                self.assertTrue(self.deliverer.stage_delivery())
+            self.assertTrue(future.done())
+            self.assertTrue(
+                os.path.exists(staged), "missing report with {}".format(options)
+            )
+            os.unlink(os.path.join(reportpath, "sample_report.html"))
+            shutil.rmtree(self.deliverer.expand_path(self.deliverer.stagingpath))
+
+    def test_rsync_transferred_bytes(self):
+        """The bytes transferred by rsync are taken from its --stats"""
+
+        def _transfer(transfer_log=None):
+            with open("{}_rsync.out".format(transfer_log), "w") as fh:
+                fh.write(
+                    "Number of regular files transferred: 2\n"
+                    "Total file size: 1,048,576 bytes\n"
+                    "Total transferred file size: 2,048 bytes\n"
+                    "Literal data: 2,048 bytes\n"
+                )
+            return True
+
+        before = metrics.TRANSFERRED_BYTES.value(method="rsync")
+        with mock.patch.object(deliver.transfer, "RsyncAgent") as agent_mock:
+            agent_mock.return_value.transfer.side_effect = _transfer
+            self.assertTrue(self.deliverer.do_delivery())
+        self.assertIn("--stats", agent_mock.call_args[1]["opts"])
+        self.assertEqual(metrics.TRANSFERRED_BYTES.value(method="rsync") - before, 2048)
+        # no bytes are counted without the stats
+        os.unlink(
+            "{}_rsync.out".format(
+                agent_mock.return_value.transfer.call_args[1]["transfer_log"]
+            )
+        )
+        with mock.patch.object(deliver.transfer, "RsyncAgent") as agent_mock:
+            agent_mock.return_value.transfer.return_value = True
+            self.assertTrue(self.deliverer.do_delivery())
+        self.assertEqual(metrics.TRANSFERRED_BYTES.value(method="rsync") - before, 2048)
+
+    def test_stream_delivery(self):
+        """Files are hashed while they are copied to the delivery path"""
+        pattern = SAMPLECFG["deliver"]["files_to_deliver"][1]
+        self.deliverer.files_to_deliver = [pattern]
+        self.deliverer.transfer_mode = "stream"
+        analysispath = self.deliverer.expand_path(self.deliverer.analysispath)
+        sources = sorted(
+            os.path.join(d, f)
+            for d, _, files in os.walk(os.path.join(analysispath, "level1_folder2"))
+            for f in files
+        )
+        for n, source in enumerate(sources):
+            with open(source, "w") as fh:
+                fh.write("file {}".format(n))
+        # the checksum of one of the files is cached
+        with open("{}.md5".format(sources[0]), "w") as fh:
+            fh.write("{}  {}".format(hashfile(sources[0], hasher="md5"), sources[0]))
+        with mock.patch.object(fs, "stream_digest") as digest:
+            self.assertTrue(self.deliverer.stage_delivery())
+            digest.assert_not_called()
+        self.assertEqual(len(self.deliverer.deferred_digests), len(sources) - 1)
+        self.assertTrue(self.deliverer.do_delivery())
+        with open(self.deliverer.delivered_digestfile(), "r") as fh:
+            delivered = dict(reversed(line.split()) for line in fh)
+        deliverypath = self.deliverer.expand_path(self.deliverer.deliverypath)
+        for source in sources:
+            fpath = os.path.relpath(source, analysispath)
+            dest = os.path.join(deliverypath, fpath)
+            self.assertFalse(os.path.islink(dest))
+            self.assertEqual(delivered[fpath], hashfile(dest, hasher="md5"))
+            self.assertEqual(delivered[fpath], hashfile(source, hasher="md5"))
+        # the files already delivered are not copied again, only the digest file
+        before = metrics.TRANSFERRED_BYTES.value(method="stream")
+        with mock.patch.object(
+            fs, "copy_and_hash", wraps=fs.copy_and_hash
+        ) as copy_mock:
+            self.assertTrue(self.deliverer.do_delivery())
+        copy_mock.assert_called_once()
+        self.assertEqual(copy_mock.call_args[0][0], self.deliverer.staging_digestfile())
+        self.assertEqual(
+            metrics.TRANSFERRED_BYTES.value(method="stream") - before,
+            os.path.getsize(self.deliverer.staging_digestfile()),
+        )
+        # a file not matching its cached checksum fails the delivery, without
+        # replacing the delivered file or delivering the digest file
+        dest = os.path.join(deliverypath, os.path.relpath(sources[0], analysispath))
+        digestfile_mtime = os.stat(self.deliverer.delivered_digestfile()).st_mtime_ns
+        with open(sources[0], "a") as fh:
+            fh.write("modified")
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.do_delivery()
+        with open(dest, "r") as fh:
+            self.assertEqual(fh.read(), "file 0")
+        self.assertEqual(
+            os.stat(self.deliverer.delivered_digestfile()).st_mtime_ns,
+            digestfile_mtime,
+        )
+        self.assertFalse(os.path.exists(dest + ".part"))
+        self.deliverer.remote_host = "remote.host"
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.do_delivery()
+
+    def test_stream_delivery_tree_digest(self):
+        """Files with cached tree digests are verified with them when streamed"""
+        pattern = SAMPLECFG["deliver"]["files_to_deliver"][1]
+        self.deliverer.files_to_deliver = [pattern]
+        self.deliverer.tree_digest_workers = 2
+        self.deliverer.integrity_algorithm = "sha256"
+        analysispath = self.deliverer.expand_path(self.deliverer.analysispath)
+        sources = sorted(
+            os.path.join(d, f)
+            for d, _, files in os.walk(os.path.join(analysispath, "level1_folder2"))
+            for f in files
+        )
+        for n, source in enumerate(sources):
+            with open(source, "w") as fh:
+                fh.write("file {}".format(n))
+        self.assertTrue(self.deliverer.stage_delivery())
+        self.assertEqual(fs.read_tree_digest(sources[0])["algorithm"], "sha256")
+        self.deliverer.transfer_mode = "stream"
+        self.assertTrue(self.deliverer.stage_delivery())
+        self.assertEqual(self.deliverer.deferred_digests, set())
+        with mock.patch.object(
+            fs, "copy_and_hash", wraps=fs.copy_and_hash
+        ) as copy_mock:
+            self.assertTrue(self.deliverer.do_delivery())
+        # only the digest file is hashed with the delivered algorithm
+        self.assertEqual(
+            [c[1]["hash_algorithm"] for c in copy_mock.call_args_list],
+            [None] * len(sources) + ["md5"],
+        )
+        # a source modified after it was staged fails the delivery
+        with open(sources[-1], "a") as fh:
+            fh.write("modified")
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.do_delivery()
+
     def test_expand_path(self):
         """Paths should expand correctly"""
         cases = [
@@ -528,6 +698,38 @@ class TestDeliverer(unittest.TestCase):
                 )
             os.unlink(ackfile)
 
+    @mock.patch.object(deliver.sf, "update_staged_files")
+    @mock.patch.object(deliver, "ProjectSummaryConnection")
+    def test_aggregate_meta_info(self, sdb_mock, update_mock):
+        """The staged files are saved in the document of the sample"""
+        stagingpath = self.deliverer.expand_path(self.deliverer.stagingpath)
+        os.makedirs(os.path.join(stagingpath, self.sampleid))
+        fastq = os.path.join(self.sampleid, "{}_R1.fastq.gz".format(self.sampleid))
+        open(os.path.join(stagingpath, fastq), "w").close()
+        with open(os.path.join(stagingpath, "{}.md5".format(self.sampleid)), "w") as fh:
+            fh.write("abc123  {}\n".format(fastq))
+        db_config = os.path.join(self.casedir, "statusdb.yaml")
+        with open(db_config, "w") as fh:
+            fh.write("statusdb:\n  url: localhost\n")
+        self.deliverer.save_meta_info = True
+        self.deliverer.staged_files_db = "staged_files"
+        self.deliverer.projectname = "A.Test_26_01"
+        with mock.patch.dict(os.environ, {"STATUS_DB_CONFIG": db_config}):
+            self.assertTrue(self.deliverer.aggregate_meta_info())
+        (_, dbname, projectid, sampleid, files), kwargs = update_mock.call_args
+        self.assertEqual(
+            (dbname, projectid, sampleid),
+            ("staged_files", self.projectid, self.sampleid),
+        )
+        self.assertEqual(files[fastq]["md5_sum"], "abc123")
+        # the project document is only fetched for samples without a document
+        sdb_mock.return_value.get_entry.assert_not_called()
+        sdb_mock.return_value.save_db_doc.assert_not_called()
+        sdb_mock.return_value.get_entry.return_value = {
+            "staged_files": {self.sampleid: {"old.fastq.gz": {}}}
+        }
+        self.assertEqual(kwargs["inline"](), {"old.fastq.gz": {}})
+
 
 class TestProjectDeliverer(unittest.TestCase):
     @classmethod
@@ -625,14 +827,86 @@ class TestProjectDeliverer(unittest.TestCase):
             dbmock().project_get_samples.assert_called_with(PROJECTENTRY["projectid"])
         PROJECTENTRY["samples"] = [SAMPLEENTRY]
 
+    def test_plan_delivery(self):
+        """planning a project delivery without staging anything"""
+        cfg = dict(
+            SAMPLECFG["deliver"],
+            rootdir=self.casedir,
+            files_to_deliver=[["<ANALYSISPATH>/<SAMPLEID>_*", "<STAGINGPATH>"]],
+        )
+        self.deliverer.transfer_throughput = 1
+        self.deliverer.files_to_deliver = cfg["files_to_deliver"]
+        analysispath = os.path.join(self.casedir, "ANALYSIS")
+        create_folder(analysispath)
+        for fname, content in [("S1_a", "x" * 10), ("S1_b", "y" * 20)]:
+            with open(os.path.join(analysispath, fname), "w") as fh:
+                fh.write(content)
+        with open(os.path.join(analysispath, "S1_b.md5"), "w") as fh:
+            fh.write("cachedchecksum  S1_b")
+        sampleentries = [
+            {"sampleid": "S1", "analysis_status": "ANALYZED", "status": "STARTED"},
+            {"sampleid": "S2", "analysis_status": "UNDER_ANALYSIS"},
+        ]
+        with (
+            mock.patch.dict(deliver.CONFIG, {"deliver": cfg}),
+            mock.patch.object(deliver.db, "dbcon", autospec=db.CharonSession),
+            mock.patch.object(
+                deliver.db,
+                "project_sample_entries",
+                return_value={"samples": sampleentries},
+            ),
+        ):
+            with mock.patch.object(
+                fs, "compile_patterns", wraps=fs.compile_patterns
+            ) as compile_mock:
+                plan = self.deliverer.plan_delivery()
+        # the patterns are compiled once for all samples
+        self.assertEqual(
+            compile_mock.call_args_list.count(mock.call(cfg["files_to_deliver"])), 1
+        )
+        self.assertEqual(list(plan["samples"].keys()), ["S1"])
+        self.assertEqual(list(plan["skipped_samples"].keys()), ["S2"])
+        self.assertEqual(plan["samples"]["S1"]["files"], 2)
+        self.assertEqual(plan["samples"]["S1"]["bytes"], 30)
+        self.assertEqual(plan["samples"]["S1"]["bytes_to_hash"], 10)
+        self.assertEqual(plan["totals"]["bytes"], 30)
+        self.assertEqual(plan["throughput"]["transfer_bytes_per_second"], 1024 * 1024)
+        self.assertIsNotNone(plan["estimate"]["staging_seconds"])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.casedir, "STAGING")),
+            "nothing should be staged when planning a delivery",
+        )
+        # the plan should be serializable
+        json.dumps(plan)
+
     def test_create_project_report(self):
         """creating the project report"""
-        with mock.patch.object(deliver, "call_external_command") as syscall:
+        with mock.patch.object(deliver, "_run_report_command") as syscall:
             self.deliverer.create_report()
             self.assertEqual(
                 " ".join(syscall.call_args[0][0]),
                 SAMPLECFG["deliver"]["report_aggregate"],
             )
+            self.assertEqual(
+                syscall.call_args[0][1],
+                self.deliverer.expand_path(SAMPLECFG["deliver"]["reportpath"]),
+            )
+            # the samples about to be delivered are reported as expected
+            cl = self.deliverer.aggregate_report_command(["S1", "S2"])
+            self.assertEqual(cl[-2], "--samples_extra")
+            self.assertEqual(sorted(json.loads(cl[-1])), ["S1", "S2"])
+
+    def test_start_report(self):
+        """reports are created in the background and waited for"""
+        with mock.patch.object(deliver, "_run_report_command") as syscall:
+            self.deliverer.start_report()
+            self.assertTrue(self.deliverer.wait_for_reports())
+            syscall.assert_called_once()
+            self.assertEqual(self.deliverer.pending_reports, [])
+            # a failed report is logged but does not raise
+            syscall.side_effect = OSError("pandoc not found")
+            self.deliverer.start_report()
+            self.assertFalse(self.deliverer.wait_for_reports())
 
     def test_copy_project_report(self):
         """Copy the project report to the specified report outbox"""
@@ -743,6 +1017,29 @@ class TestSampleDeliverer(unittest.TestCase):
         with self.assertRaises(deliver.DelivererInterruptedError):
             os.kill(os.getpid(), signal.SIGTERM)
 
+    @mock.patch.object(deliver.SampleDeliverer, "update_delivery_status")
+    @mock.patch.object(deliver.SampleDeliverer, "stage_delivery")
+    def test_deliver_sample_not_deliverable(self, stage_mock, update_mock):
+        """samples that are not deliverable are skipped before staging"""
+        self.deliverer.ignore_analysis_status = False
+        for sampleentry, delivered in [
+            ({"analysis_status": "UNDER_ANALYSIS"}, False),
+            ({"analysis_status": "ANALYZED", "delivery_status": "DELIVERED"}, True),
+            ({"analysis_status": "ANALYZED", "delivery_status": "IN_PROGRESS"}, False),
+            ({"analysis_status": "ANALYZED", "status": "FRESH"}, False),
+        ]:
+            self.assertEqual(self.deliverer.deliver_sample(sampleentry), delivered)
+        update_mock.assert_not_called()
+        # an aborted sample does not fail the delivery, but is not delivered
+        sampleentry = {
+            "analysis_status": "ANALYZED",
+            "delivery_status": "FAILED",
+            "status": "ABORTED",
+        }
+        self.assertTrue(self.deliverer.deliver_sample(sampleentry))
+        update_mock.assert_called_once_with(status="NOT_DELIVERED")
+        stage_mock.assert_not_called()
+
     def test_deliver_sample1(self):
         """transfer a sample using rsync"""
         # create some content to transfer
@@ -822,7 +1119,7 @@ class TestSampleDeliverer(unittest.TestCase):
 
     def test_create_sample_report(self):
         """creating the sample report"""
-        with mock.patch.object(deliver, "call_external_command") as syscall:
+        with mock.patch.object(deliver, "_run_report_command") as syscall:
             self.deliverer.create_report()
             self.assertEqual(
                 " ".join(syscall.call_args_list[0][0][0]),
@@ -834,3 +1131,20 @@ class TestSampleDeliverer(unittest.TestCase):
                 " ".join(syscall.call_args_list[1][0][0][:-1]),
                 "{} --samples_extra".format(SAMPLECFG["deliver"]["report_aggregate"]),
             )
+
+    def test_run_report_command(self):
+        """report commands run in the report folder and log to files"""
+        reportpath = os.path.join(self.casedir, "reports")
+        create_folder(reportpath)
+        logprefix = os.path.join(self.casedir, "report")
+        cwd = os.getcwd()
+        deliver._run_report_command(
+            ["sh", "-c", "pwd; echo failing >&2"], reportpath, logprefix=logprefix
+        )
+        with open("{}_sh.out".format(logprefix)) as fh:
+            self.assertEqual(fh.read().splitlines()[-1], reportpath)
+        with open("{}_sh.err".format(logprefix)) as fh:
+            self.assertEqual(fh.read(), "failing\n")
+        self.assertEqual(os.getcwd(), cwd)
+        with self.assertRaises(deliver.subprocess.CalledProcessError):
+            deliver._run_report_command(["false"], reportpath)
@@ -0,0 +1,221 @@
+"""Unit tests for the DDS deliverer, running against a scripted fake dds
+executable put first on PATH"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from unittest import mock
+
+from ngi_pipeline.database import classes as db
+from taca.utils.misc import hashfile
+from taca_ngi_pipeline.deliver import deliver, deliver_dds
+
+FAKE_DDS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "fake_dds"
+)
+
+
+def fake_dds(**settings):
+    """Put the fake dds first on PATH, configured by the FAKE_DDS_* environment
+    variables corresponding to the keyword arguments, e.g. fail="put"
+    """
+    env = {"FAKE_DDS_{}".format(k.upper()): str(v) for k, v in settings.items()}
+    env["PATH"] = os.pathsep.join([FAKE_DDS_DIR, os.environ.get("PATH", "")])
+    return mock.patch.dict(os.environ, env)
+
+
+class TestDDSProjectDeliverer(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_deliver_dds_")
+        self.callsfile = os.path.join(self.rootdir, "dds_calls.json")
+        self.stagingpath = os.path.join(self.rootdir, "STAGING")
+        for sampleid in ["P12345_1001", "P12345_1002"]:
+            fastqdir = os.path.join(self.stagingpath, sampleid, "02-FASTQ")
+            os.makedirs(fastqdir)
+            for read in ["R1", "R2"]:
+                open(
+                    os.path.join(fastqdir, "{}_{}_001.fastq.gz".format(sampleid, read)),
+                    "w",
+                ).close()
+        config = {
+            "log": {"file": os.path.join(self.rootdir, "logs", "taca.log")},
+            "deliver": {"stagingpath": self.stagingpath},
+        }
+        self.config = mock.patch.dict(deliver_dds.CONFIG, config)
+        self.config.start()
+        with mock.patch.object(deliver.db, "dbcon", autospec=db.CharonSession):
+            self.deliverer = deliver_dds.DDSProjectDeliverer("P12345", do_release=True)
+        self.deliverer.project_title = "P12345"
+        self.deliverer.project_desc = "A.Test_26_01 (2026-10-18)"
+        self.deliverer.pi_email = "pi@example.com"
+        self.deliverer.other_member_details = ["bx@example.com"]
+        # the deliverer echoes the dds output
+        self.print = mock.patch("builtins.print")
+        self.print.start()
+
+    def tearDown(self):
+        self.print.stop()
+        self.config.stop()
+        shutil.rmtree(self.rootdir)
+
+    def dds_calls(self):
+        with open(self.callsfile) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_create_delivery_project(self):
+        with fake_dds(project="ngisthlm01234", calls=self.callsfile):
+            self.assertEqual(self.deliverer._create_delivery_project(), "ngisthlm01234")
+        (call,) = self.dds_calls()
+        self.assertEqual(call[0:3], ["--no-prompt", "project", "create"])
+        self.assertIn("bx@example.com", call)
+
+    def test_create_delivery_project_failed(self):
+        with fake_dds(fail="create", exit_code=3):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                self.deliverer._create_delivery_project()
+        self.assertEqual(cm.exception.returncode, 3)
+        with fake_dds(project="unexpected-id"):
+            with self.assertRaises(AssertionError):
+                self.deliverer._create_delivery_project()
+
+    def test_execute(self):
+        cmd = ["dds", "data", "put", "--source", self.stagingpath]
+        with fake_dds(extra_lines=1000, progress_lines=0, line_length=200):
+            lines = list(self.deliverer._execute(cmd))
+        self.assertEqual(len(lines), 1002)
+        self.assertTrue(all(len(line) == 201 for line in lines))
+        with fake_dds(fail="put", fail_after=10):
+            lines = []
+            with self.assertRaises(subprocess.CalledProcessError):
+                for line in self.deliverer._execute(cmd):
+                    lines.append(line)
+        self.assertEqual(len(lines), 10)
+
+    def test_upload_data(self):
+        with fake_dds(progress_lines=20, calls=self.callsfile):
+            self.assertEqual(self.deliverer.upload_data("ngisthlm01234"), "uploaded")
+        (call,) = self.dds_calls()
+        self.assertEqual(
+            call[call.index("--source") + 1],
+            self.deliverer.expand_path(self.stagingpath),
+        )
+        self.assertEqual(
+            call[call.index("--mount-dir") + 1],
+            os.path.join(self.rootdir, "logs", "DDS_logs", "P12345"),
+        )
+        with fake_dds(incomplete=1):
+            self.assertIsNone(self.deliverer.upload_data("ngisthlm01234"))
+        with fake_dds(fail="put", fail_after=5):
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.deliverer.upload_data("ngisthlm01234")
+
+    def test_deliver_run_folder(self):
+        datapath = os.path.join(self.rootdir, "DATA")
+        os.makedirs(datapath)
+        for fcid in ["FC1", "FC2", "FC3"]:
+            archive = os.path.join(datapath, fcid + ".tar")
+            with open(archive, "w") as fh:
+                fh.write("run folder {}".format(fcid))
+            with open(archive + ".md5", "w") as fh:
+                digest = "0" * 32 if fcid == "FC2" else hashfile(archive, hasher="md5")
+                fh.write("{}  {}.tar\n".format(digest, fcid))
+        self.deliverer.datapath = datapath
+        self.deliverer.fcid = ["FC1", "FC2", "FC3", "FC4"]
+        with fake_dds(calls=self.callsfile):
+            # the corrupt FC2 and the missing FC4 are skipped
+            self.assertFalse(self.deliverer.deliver_run_folder())
+        # the staging folder is uploaded at once
+        (put,) = [call for call in self.dds_calls() if "put" in call]
+        self.assertEqual(put[put.index("--source") + 1], self.stagingpath)
+        self.assertNotIn("--destination", put)
+        self.assertTrue(os.path.islink(os.path.join(self.stagingpath, "FC3.tar")))
+        self.assertFalse(os.path.exists(os.path.join(self.stagingpath, "FC2.tar")))
+        # or one flowcell per upload, several at a time
+        os.unlink(self.callsfile)
+        shutil.rmtree(self.stagingpath)
+        self.deliverer.runfolder_upload_workers = 2
+        with fake_dds(calls=self.callsfile):
+            self.assertFalse(self.deliverer.deliver_run_folder())
+        puts = sorted(
+            (call for call in self.dds_calls() if "put" in call),
+            key=lambda call: call[call.index("--mount-dir") + 1],
+        )
+        self.assertEqual(len(puts), 2)
+        for fcid, call in zip(["FC1", "FC3"], puts):
+            sources = [call[n + 1] for n, a in enumerate(call) if a == "--source"]
+            self.assertEqual(
+                sources,
+                [
+                    os.path.join(self.stagingpath, fcid + ".tar"),
+                    os.path.join(self.stagingpath, fcid + ".tar.md5"),
+                ],
+            )
+            self.assertEqual(
+                call[call.index("--mount-dir") + 1],
+                os.path.join(self.rootdir, "logs", "DDS_logs", "P12345", fcid),
+            )
+        # verified archives are not hashed again on a redelivery
+        self.deliverer.fcid = ["FC1"]
+        shutil.rmtree(self.stagingpath)
+        with mock.patch.object(deliver_dds.fs, "stream_digest") as digest:
+            with fake_dds():
+                self.assertTrue(self.deliverer.deliver_run_folder())
+            digest.assert_not_called()
+
+    @mock.patch.object(deliver_dds, "DDSSampleDeliverer")
+    @mock.patch.object(deliver_dds, "proceed_or_not", return_value=True)
+    @mock.patch.object(deliver_dds.DDSProjectDeliverer, "update_delivery_status")
+    @mock.patch.object(
+        deliver_dds.DDSProjectDeliverer, "delete_delivery_token_in_charon"
+    )
+    @mock.patch.object(
+        deliver_dds.DDSProjectDeliverer,
+        "get_samples_from_charon",
+        return_value=["P12345_1001", "P12345_1002"],
+    )
+    @mock.patch.object(
+        deliver_dds.DDSProjectDeliverer,
+        "get_delivery_status",
+        return_value="IN_PROGRESS",
+    )
+    def test_release_DDS_delivery_project(
+        self, status_mock, samples_mock, token_mock, update_mock, _, sample_mock
+    ):
+        sample_mock.return_value.get_sample_status.return_value = "STAGED"
+        sample_mock.return_value.get_delivery_status.return_value = "DELIVERED"
+        with fake_dds(calls=self.callsfile):
+            self.deliverer.release_DDS_delivery_project(
+                "ngisthlm01234", no_dds_mail=True, dds_deadline=30
+            )
+        (call,) = self.dds_calls()
+        self.assertEqual(
+            call,
+            [
+                "--no-prompt",
+                "project",
+                "status",
+                "release",
+                "--project",
+                "ngisthlm01234",
+                "--deadline",
+                "30",
+                "--no-mail",
+            ],
+        )
+        sample_mock.return_value.update_delivery_status.assert_called_with(
+            status="DELIVERED"
+        )
+        token_mock.assert_called_once_with()
+        update_mock.assert_called_once_with(status="DELIVERED")
+
+        sample_mock.reset_mock()
+        with fake_dds(fail="release"):
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.deliverer.release_DDS_delivery_project(
+                    "ngisthlm01234", no_dds_mail=False
+                )
+        sample_mock.return_value.update_delivery_status.assert_not_called()
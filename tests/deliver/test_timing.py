@@ -0,0 +1,84 @@
+"""Unit tests for the timing of delivery phases"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from taca_ngi_pipeline.deliver import timing
+
+
+class _Delivery(object):
+    def __init__(self, tracefile, parent=None):
+        self.tracefile = tracefile
+        self.timer = timing.PhaseTimer("P1:P1_101", parent=parent)
+
+    def timing_tracefile(self):
+        return self.tracefile
+
+    @timing.timed("charon")
+    def update_delivery_status(self):
+        return "DELIVERED"
+
+    @timing.reported
+    def deliver(self, fail=False):
+        self.update_delivery_status()
+        with self.timer.phase("staging"):
+            if fail:
+                raise RuntimeError("staging failed")
+        return True
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add(self):
+        timer = timing.PhaseTimer("P1")
+        threads = [
+            threading.Thread(
+                target=lambda: [timer.add("hash", 0.5) for _ in range(100)]
+            )
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with timer.phase("glob"):
+            pass
+        self.assertEqual(timer.phases["hash"], {"seconds": 200.0, "count": 400})
+        self.assertEqual(timer.phases["glob"]["count"], 1)
+        timer.stop()
+        self.assertTrue(timer.summary().startswith("P1: "))
+        self.assertLess(timer.summary().index("hash"), timer.summary().index("glob"))
+
+    def test_reported(self):
+        tracefile = os.path.join(self.tmpdir, "P1_101.timing.json")
+        delivery = _Delivery(tracefile)
+        self.assertTrue(delivery.deliver())
+        with open(tracefile) as fh:
+            trace = json.load(fh)
+        self.assertEqual(trace["name"], "P1:P1_101")
+        self.assertEqual(sorted(trace["phases"]), ["charon", "staging"])
+        self.assertIsNotNone(trace["seconds"])
+
+        # a failed delivery is still reported
+        os.unlink(tracefile)
+        with self.assertRaises(RuntimeError):
+            _Delivery(tracefile).deliver(fail=True)
+        self.assertTrue(os.path.exists(tracefile))
+
+    def test_reported_child(self):
+        tracefile = os.path.join(self.tmpdir, "P1_101.timing.json")
+        parent = timing.PhaseTimer("P1")
+        _Delivery(tracefile, parent=parent).deliver()
+        # the timing of a child is only written as part of the parent's trace
+        self.assertFalse(os.path.exists(tracefile))
+        (child,) = parent.as_dict()["children"]
+        self.assertEqual(child["phases"]["charon"]["count"], 1)
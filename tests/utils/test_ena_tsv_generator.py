@@ -1,11 +1,20 @@
+import csv
+import io
 import unittest
 import tempfile
 import shutil
 import os
+import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock, patch
 
-from taca_ngi_pipeline.utils.ena_tsv_generator import tsv_generator
+from taca_ngi_pipeline.utils.ena_tsv_generator import (
+    fetch_project_docs,
+    generate_tsv_files,
+    tsv_generator,
+    write_summary,
+)
 
 class TestTsvGenerator(unittest.TestCase):
     @classmethod
@@ -42,15 +51,6 @@ class TestTsvGenerator(unittest.TestCase):
         }
         cls.pcon.get_entry.return_value = couch_doc
 
-        # Mock GenericFlowcellRunConnection
-        cls.fcon = Mock()
-        cls.fcon.get_project_flowcell.return_value = {
-            "flowcell_1": {
-                "run_name": "run_1",
-                "RunInfo": {"Id": "run_id_1"},
-            }
-        }
-
         cls.outdir = tempfile.mkdtemp()
         cls.db_conf = None
 
@@ -59,8 +59,7 @@ class TestTsvGenerator(unittest.TestCase):
         shutil.rmtree(cls.outdir)
 
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
-    def test_tsv_generator_init(self, mock_fc_conn, mock_proj_conn):
+    def test_tsv_generator_init(self, mock_proj_conn):
         """Test tsv_generator initialization"""
         mock_proj_conn.return_value.get_entry.return_value = {
             "project_id": self.pid,
@@ -75,15 +74,13 @@ class TestTsvGenerator(unittest.TestCase):
             },
             "samples": {"P12345_1001": {}},
         }
-        mock_fc_conn.return_value.get_project_flowcell.return_value = {}
 
         gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log, db_conf=self.db_conf)
         self.assertEqual(gen.project_doc["project_id"], self.pid)
         self.assertIsNotNone(gen.common_details)
 
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
-    def test_check_and_load_outdir(self, mock_fc_conn, mock_proj_conn):
+    def test_check_and_load_outdir(self, mock_proj_conn):
         """Test outdir validation and creation"""
         mock_proj_conn.return_value.get_entry.return_value = {
             "project_id": self.pid,
@@ -95,7 +92,6 @@ class TestTsvGenerator(unittest.TestCase):
             "details": {"sequencing_setup": "150-8-8-150"},
             "samples": {"P12345_1001": {}},
         }
-        mock_fc_conn.return_value.get_project_flowcell.return_value = {}
 
         test_outdir = tempfile.mkdtemp()
         try:
@@ -106,8 +102,7 @@ class TestTsvGenerator(unittest.TestCase):
             shutil.rmtree(test_outdir)
 
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
-    def test_set_common_details(self, mock_fc_conn, mock_proj_conn):
+    def test_set_common_details(self, mock_proj_conn):
         """Test that common details are set correctly"""
         project_doc = {
             "project_id": self.pid,
@@ -123,7 +118,6 @@ class TestTsvGenerator(unittest.TestCase):
             "samples": {"P12345_1001": {}},
         }
         mock_proj_conn.return_value.get_entry.return_value = project_doc
-        mock_fc_conn.return_value.get_project_flowcell.return_value = {}
 
         gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log, db_conf=self.db_conf)
         self.assertEqual(gen.common_details["unit_internal_project_id"], self.pid)
@@ -131,8 +125,7 @@ class TestTsvGenerator(unittest.TestCase):
         self.assertEqual(gen.common_details["order_id"], "ORDER123")
 
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
-    def test_load_staged_files(self, mock_fc_conn, mock_proj_conn):
+    def test_load_staged_files(self, mock_proj_conn):
         """Test that staged files are loaded correctly"""
         project_doc = {
             "project_id": self.pid,
@@ -146,14 +139,268 @@ class TestTsvGenerator(unittest.TestCase):
             "samples": {"P12345_1001": {}},
         }
         mock_proj_conn.return_value.get_entry.return_value = project_doc
-        mock_fc_conn.return_value.get_project_flowcell.return_value = {}
 
         gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log, db_conf=self.db_conf)
         self.assertIn("P12345_1001_001", gen.file_pairs_delivered)
 
-@patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
+    def test_load_staged_files_read_types(self, mock_proj_conn):
+        """Test that the reads are paired by flowcell, lane and set"""
+        files = {}
+        for fc in ["ABC123", "DEF456"]:
+            for lane in ["L001", "L002"]:
+                for read in ["I1", "I2", "R1", "R2", "R3"]:
+                    name = f"{fc}/P12345_1001_S1_{lane}_{read}_001.fastq.gz"
+                    files[name] = {"md5_sum": f"{fc}_{lane}_{read}"}
+        project_doc = {
+            "project_id": self.pid,
+            "staged_files": {
+                "P12345_1001": files,
+                "P12345_1002": {
+                    "P12345_1002_R1_001.fastq.gz": {"md5_sum": "abc"},
+                    "P12345_1002_R2_001.fastq.gz": {"md5_sum": "def"},
+                    "P12345_1002_I1_001.fastq.gz": {"md5_sum": "ghi"},
+                    "P12345_1002.fastq.gz": {"md5_sum": "jkl"},
+                },
+            },
+            "details": {"sequencing_setup": "150-8-8-150"},
+            "samples": {"P12345_1001": {}, "P12345_1002": {}},
+        }
+        mock_proj_conn.return_value.get_entry.return_value = project_doc
+
+        gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log)
+        self.assertEqual(len(gen.file_pairs_delivered), 6)
+        pair = gen.file_pairs_delivered["DEF456/P12345_1001_S1_L002_001"]
+        self.assertEqual(
+            pair["file_name"], "DEF456/P12345_1001_S1_L002_R1_001.fastq.gz"
+        )
+        self.assertEqual(pair["file_md5"], "DEF456_L002_R1")
+        # the second read holds the UMIs when there is a third read
+        self.assertEqual(pair["reverse_file_md5"], "DEF456_L002_R3")
+        self.assertEqual(
+            gen.file_pairs_delivered["P12345_1002_001"]["reverse_file_md5"], "def"
+        )
+        self.assertEqual(
+            gen.file_pairs_delivered["P12345_1002"]["reverse_file_name"], ""
+        )
+        self.assertIn("reverse_file_md5", gen.fieldnames)
+
+        # the columns of single end projects do not depend on previous projects
+        project_doc["details"]["sequencing_setup"] = "150-8-8-0"
+        gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log)
+        self.assertNotIn("reverse_file_name", gen.fieldnames)
+        self.assertNotIn(
+            "reverse_file_name", gen.file_pairs_delivered["P12345_1002_001"]
+        )
+        with open(gen.generate_tsv_file()) as fh:
+            self.assertEqual(len(fh.readlines()), 7)
+
+    @patch(
+        "taca_ngi_pipeline.utils.ena_tsv_generator.validation_pool",
+        ThreadPoolExecutor,
+    )
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.validate_genomics_data")
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
+    def test_validate_tsv_file_chunked(
+        self, mock_proj_conn, mock_validate
+    ):
+        """Test that large TSV files are validated in chunks of rows"""
+        mock_proj_conn.return_value.get_entry.return_value = {
+            "project_id": self.pid,
+            "staged_files": {
+                "P12345_1001": {"P12345_1001_R1_001.fastq.gz": {"md5_sum": "abc"}},
+            },
+            "details": {"sequencing_setup": "150-8-8-150"},
+            "samples": {"P12345_1001": {}},
+        }
+
+        def _validate(path, schema):
+            # every third row of the file is invalid
+            with open(path) as fh:
+                rows = fh.read().splitlines()[1:]
+            return [
+                {"row": n, "message": f"'{row}' is not a valid file name"}
+                for n, row in enumerate(rows, 1)
+                if int(row) % 3 == 0
+            ]
+
+        mock_validate.side_effect = _validate
+        tsv_file = os.path.join(self.outdir, "chunked.tsv")
+        with open(tsv_file, "w") as fh:
+            fh.write("file_name\n")
+            fh.writelines(f"{n}\n" for n in range(1, 51))
+        log = Mock()
+        gen = tsv_generator(self.pid, outdir=self.outdir, LOG=log)
+        errors = gen.validate_tsv_file(tsv_file, chunk_size=7, workers=2)
+        self.assertEqual(mock_validate.call_count, 8)
+        self.assertEqual([e["row"] for e in errors], list(range(3, 51, 3)))
+        # the errors are counted by type once too many to be logged one by one
+        with patch(
+            "taca_ngi_pipeline.utils.ena_tsv_generator.VALIDATION_LOGGED_ERRORS", 5
+        ):
+            gen.validate_tsv_file(tsv_file, chunk_size=7, workers=2)
+        log.error.assert_any_call("... and 11 more errors")
+        log.error.assert_any_call("16 rows: '...' is not a valid file name")
+
+        # the validation stops once enough errors are found
+        mock_validate.reset_mock()
+        errors = gen.validate_tsv_file(tsv_file, max_errors=4, chunk_size=7, workers=1)
+        self.assertEqual(len(errors), 4)
+        self.assertLess(mock_validate.call_count, 8)
+        # files fitting in one chunk are validated without a pool
+        mock_validate.reset_mock()
+        with patch(
+            "taca_ngi_pipeline.utils.ena_tsv_generator.validation_pool"
+        ) as pool:
+            errors = gen.validate_tsv_file(tsv_file)
+        pool.assert_not_called()
+        self.assertEqual(len(errors), 16)
+        # the chunks can be validated in a pool shared with other files
+        mock_validate.reset_mock()
+        with ThreadPoolExecutor(2) as executor:
+            errors = gen.validate_tsv_file(tsv_file, chunk_size=7, executor=executor)
+        self.assertEqual(mock_validate.call_count, 8)
+        self.assertEqual(len(errors), 16)
+
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.validate_genomics_data")
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
+    def test_generate_tsv_file_incremental(
+        self, mock_proj_conn, mock_validate
+    ):
+        """Test that only the rows of changed samples are validated again"""
+        staged_files = {
+            f"P12345_100{n}": {
+                f"P12345_100{n}_S{n}_L00{lane}_R1_001.fastq.gz": {"md5_sum": "abc"}
+                for lane in range(1, 4)
+            }
+            for n in range(1, 4)
+        }
+        project_doc = {
+            "project_id": self.pid,
+            "staged_files": staged_files,
+            "details": {"sequencing_setup": "150-8-8-0"},
+            "samples": {sample: {} for sample in staged_files},
+        }
+        mock_proj_conn.return_value.get_entry.return_value = project_doc
+
+        def _validate(path, schema):
+            # the rows with the checksum "bad" are invalid
+            with open(path) as fh:
+                rows = list(csv.DictReader(fh, delimiter="\t"))
+            return [
+                {"row": n, "message": "invalid checksum"}
+                for n, row in enumerate(rows, 1)
+                if row["file_md5"] == "bad"
+            ]
+
+        mock_validate.side_effect = _validate
+        outdir = tempfile.mkdtemp()
+        try:
+            staged_files["P12345_1002"]["P12345_1002_S2_L002_R1_001.fastq.gz"][
+                "md5_sum"
+            ] = "bad"
+            gen = tsv_generator(self.pid, outdir=outdir, LOG=self.log)
+            tsv_file = gen.generate_tsv_file()
+            self.assertEqual([e["row"] for e in gen.validate_tsv_file(tsv_file)], [5])
+            self.assertTrue(os.path.exists(f"{tsv_file}.state.json"))
+
+            # nothing changed, the file is neither written nor validated again
+            mock_validate.reset_mock()
+            os.utime(tsv_file, (0, 0))
+            gen = tsv_generator(self.pid, outdir=outdir, LOG=self.log)
+            self.assertEqual(gen.generate_tsv_file(), tsv_file)
+            self.assertEqual(os.stat(tsv_file).st_mtime, 0)
+            self.assertEqual([e["row"] for e in gen.validate_tsv_file(tsv_file)], [5])
+            mock_validate.assert_not_called()
+
+            # a sample is topped up, only its rows are validated again
+            staged_files["P12345_1001"]["P12345_1001_S1_L004_R1_001.fastq.gz"] = {
+                "md5_sum": "bad"
+            }
+            gen = tsv_generator(self.pid, outdir=outdir, LOG=self.log)
+            gen.generate_tsv_file()
+            with open(tsv_file) as fh:
+                self.assertEqual(len(fh.readlines()), 11)
+            self.assertEqual(
+                [e["row"] for e in gen.validate_tsv_file(tsv_file)], [4, 6]
+            )
+            mock_validate.assert_called_once()
+        finally:
+            shutil.rmtree(outdir)
+
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.validate_genomics_data")
+    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
+    def test_generate_tsv_files(self, mock_proj_conn, mock_validate):
+        """Test that several projects are fetched in bulk and generated"""
+        project_docs = {}
+        for pid in ["P12345", "P23456"]:
+            project_docs[f"doc_{pid}"] = {
+                "project_id": pid,
+                "staged_files": {
+                    f"{pid}_1001": {
+                        f"{pid}_1001_S1_L001_R1_001.fastq.gz": {"md5": "abc"},
+                        f"{pid}_1001_S1_L001_R2_001.fastq.gz": {"md5": "def"},
+                    }
+                },
+                "details": {"sequencing_setup": "150-8-8-150"},
+                "samples": {f"{pid}_1001": {}},
+            }
+        projdb_conn = mock_proj_conn.return_value
+        projdb_conn.id_view = {"P12345": "doc_P12345", "P23456": "doc_P23456"}
+        projdb_conn.connection.post_all_docs.return_value.get_result.return_value = {
+            "rows": [{"id": doc_id, "doc": doc} for doc_id, doc in project_docs.items()]
+        }
+        mock_validate.side_effect = [[], [{"row": 1, "message": "invalid"}]]
+
+        summaries = generate_tsv_files(
+            ["P12345", "P23456", "P34567"],
+            outdir=self.outdir,
+            LOG=self.log,
+            workers=1,
+        )
+        # one connection to StatusDB is shared by all projects
+        mock_proj_conn.assert_called_once()
+        projdb_conn.connection.post_all_docs.assert_called_once()
+        projdb_conn.get_entry.assert_not_called()
+        self.assertEqual(
+            [(s["project"], s["rows"], s["validation_errors"]) for s in summaries],
+            [("P12345", 1, 0), ("P23456", 1, 1), ("P34567", 0, 0)],
+        )
+        self.assertTrue(os.path.exists(summaries[0]["tsv_file"]))
+        self.assertIn("P34567", summaries[2]["error"])
+
+        output = io.StringIO()
+        write_summary(summaries, output)
+        self.assertEqual(
+            output.getvalue().splitlines()[0],
+            "project\ttsv_file\trows\tvalidation_errors\terror",
+        )
+
+        # connections without the id view fetch the projects one at a time
+        projdb_conn = Mock(spec=["get_entry"])
+        projdb_conn.get_entry.side_effect = lambda pid, **kwargs: project_docs.get(
+            f"doc_{pid}"
+        )
+        self.assertEqual(
+            sorted(fetch_project_docs(projdb_conn, ["P12345", "P34567"], self.log)),
+            ["P12345"],
+        )
+        # as do connections failing the bulk request
+        projdb_conn = Mock()
+        projdb_conn.id_view = {"P12345": "doc_P12345"}
+        projdb_conn.connection.post_all_docs.side_effect = (
+            requests.exceptions.ConnectionError("connection reset")
+        )
+        projdb_conn.get_entry.side_effect = lambda pid, **kwargs: project_docs.get(
+            f"doc_{pid}"
+        )
+        self.assertEqual(
+            sorted(fetch_project_docs(projdb_conn, ["P12345"], self.log)), ["P12345"]
+        )
+        projdb_conn.get_entry.assert_called_once()
+
 @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-def test_generate_and_validate_tsv_file(self, mock_fc_conn, mock_proj_conn):
+def test_generate_and_validate_tsv_file(self, mock_proj_conn):
     """Test TSV file generation and validation"""
     project_doc = {
         "project_id": self.pid,
@@ -179,7 +426,6 @@ def test_generate_and_validate_tsv_file(self, mock_fc_conn, mock_proj_conn):
         "open_date": "2024-01-01",
     }
     mock_proj_conn.return_value.get_entry.return_value = project_doc
-    mock_fc_conn.return_value.get_project_flowcell.return_value = {}
 
     gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log, db_conf=self.db_conf)
     tsv_file_path = gen.generate_tsv_file()
@@ -218,8 +464,7 @@ def test_generate_and_validate_tsv_file(self, mock_fc_conn, mock_proj_conn):
 
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.validate_genomics_data")
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
-    def test_validate_tsv_file(self, mock_fc_conn, mock_proj_conn, mock_validate):
+    def test_validate_tsv_file(self, mock_proj_conn, mock_validate):
         """Test TSV file validation against schema"""
         project_doc = {
             "project_id": self.pid,
@@ -237,7 +482,6 @@ def test_generate_and_validate_tsv_file(self, mock_fc_conn, mock_proj_conn):
             "open_date": "2024-01-01",
         }
         mock_proj_conn.return_value.get_entry.return_value = project_doc
-        mock_fc_conn.return_value.get_project_flowcell.return_value = {}
         mock_validate.return_value = []  # No validation errors
 
         gen = tsv_generator(self.pid, outdir=self.outdir, LOG=self.log, db_conf=self.db_conf)
@@ -249,8 +493,7 @@ def test_generate_and_validate_tsv_file(self, mock_fc_conn, mock_proj_conn):
 
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.validate_genomics_data")
     @patch("taca_ngi_pipeline.utils.ena_tsv_generator.ProjectSummaryConnection")
-    @patch("taca_ngi_pipeline.utils.ena_tsv_generator.GenericFlowcellRunConnection")
-    def test_validate_tsv_file_with_errors(self, mock_fc_conn, mock_proj_conn, mock_validate):
+    def test_validate_tsv_file_with_errors(self, mock_proj_conn, mock_validate):
         """Test TSV file validation with schema errors"""
         project_doc = {
             "project_id": self.pid,
@@ -266,7 +509,6 @@ def test_generate_and_validate_tsv_file(self, mock_fc_conn, mock_proj_conn):
             "open_date": "2024-01-01",
         }
         mock_proj_conn.return_value.get_entry.return_value = project_doc
-        mock_fc_conn.return_value.get_project_flowcell.return_value = {}
         
         # Mock validation errors
         validation_errors = [
@@ -1,5 +1,15 @@
+import glob
+import gzip
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+from unittest import mock
+
+from taca.utils.misc import hashfile
+
 import taca_ngi_pipeline.utils.filesystem as filesystem
 
 
@@ -15,6 +25,490 @@ class TestFilesystem(unittest.TestCase):
             self.assertEqual(dest, expected_dest_path)
             self.assertEqual(dig, expected_digest)
 
+    def test_gather_files_hash_workers(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for n in range(20):
+                with open(os.path.join(tmpdir, "file{}".format(n)), "w") as fh:
+                    fh.write("content of file {}".format(n))
+            files_to_deliver = [[os.path.join(tmpdir, "file*"), "stage"]]
+            sequential = list(
+                filesystem.gather_files(files_to_deliver, no_checksum=True)
+            )
+            parallel = list(
+                filesystem.gather_files(files_to_deliver, hash_workers=4, queue_size=2)
+            )
+            self.assertEqual([p[0:2] for p in parallel], [p[0:2] for p in sequential])
+            self.assertTrue(all(p[2] is not None for p in parallel))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_run_stage(self):
+        def _slow_square(x):
+            time.sleep(0.001 * (10 - x))
+            return x * x
+
+        got = list(filesystem.run_stage(range(10), _slow_square, workers=4))
+        self.assertEqual(got, [x * x for x in range(10)])
+
+        def _items():
+            yield 1
+            yield 2
+            raise filesystem.PatternNotMatchedException("no more items")
+
+        got = []
+        with self.assertRaises(filesystem.PatternNotMatchedException):
+            for x in filesystem.run_stage(_items(), lambda x: x, queue_size=1):
+                got.append(x)
+        self.assertEqual(got, [1, 2])
+
+    def test_directory_listing_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for sample in ["P1_101", "P1_102"]:
+                for folder in ["qc", "bam"]:
+                    os.makedirs(os.path.join(tmpdir, sample, folder))
+                    for ext in ["txt", "log", "bai"]:
+                        open(
+                            os.path.join(
+                                tmpdir, sample, folder, "{}_x.{}".format(sample, ext)
+                            ),
+                            "w",
+                        ).close()
+            open(os.path.join(tmpdir, ".hidden_file"), "w").close()
+            os.symlink("does-not-exist", os.path.join(tmpdir, "broken_link"))
+            patterns = [
+                "*",
+                ".*",
+                "*/*/*",
+                "P1_10?/qc/*_x.[tl]*",
+                "P1_101/*/P1_101_x.bai",
+                "*/bam/P1_102_x.*",
+                "broken_link",
+                "P1_101/",
+                "*/",
+                "no_such_folder/*",
+            ]
+            # make sure the listings will be considered old enough to cache
+            for d, _, _ in os.walk(tmpdir):
+                os.utime(d, (time.time() - 60, time.time() - 60))
+            cache = filesystem.DirectoryListingCache()
+            for pattern in patterns:
+                pattern = os.path.join(tmpdir, pattern)
+                self.assertEqual(
+                    sorted(cache.iglob(pattern)), sorted(glob.glob(pattern)), pattern
+                )
+            # the cached listings should be used for unmodified directories
+            with mock.patch.object(filesystem.os, "scandir") as scandir:
+                list(cache.iglob(os.path.join(tmpdir, "*", "*", "*")))
+                scandir.assert_not_called()
+            # but a modified directory should be listed again
+            open(os.path.join(tmpdir, "P1_101", "qc", "P1_101_x.html"), "w").close()
+            self.assertIn(
+                os.path.join(tmpdir, "P1_101", "qc", "P1_101_x.html"),
+                list(cache.iglob(os.path.join(tmpdir, "P1_101", "qc", "*.html"))),
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_compile_patterns(self):
+        compiled = filesystem.compile_patterns(
+            [
+                ["<ROOT>/*.txt", "<STAGE>"],
+                ["<ROOT>/report.html", "<STAGE>/reports", {"required": True}],
+            ]
+        )
+        self.assertEqual(
+            [(p.source, p.destination, p.required) for p in compiled],
+            [
+                ("<ROOT>/*.txt", "<STAGE>", False),
+                ("<ROOT>/report.html", "<STAGE>/reports", True),
+            ],
+        )
+        self.assertTrue(compiled[0].is_glob)
+        expanded = compiled[1].expand(
+            lambda p: p.replace("<ROOT>", "/root").replace("<STAGE>", "/stage")
+        )
+        self.assertEqual(expanded.source, "/root/report.html")
+        self.assertEqual(expanded.destination, "/stage/reports")
+        self.assertEqual(expanded.options(), compiled[1].options())
+        for invalid in [
+            ["only-source"],
+            ["source", "destination", "required"],
+            ["source", None],
+        ]:
+            with self.assertRaises(filesystem.InvalidPatternException):
+                filesystem.compile_patterns([invalid])
+        # unknown options are ignored with a warning
+        with self.assertLogs(filesystem.logger, "WARNING") as logs:
+            (pattern,) = filesystem.compile_patterns(
+                [["source", "destination", {"requried": True, "no_digest": True}]]
+            )
+        self.assertIn("requried", logs.output[0])
+        self.assertFalse(pattern.required)
+        self.assertTrue(pattern.no_digest)
+        # compiled patterns are passed through
+        self.assertIs(filesystem.compile_patterns([pattern])[0], pattern)
+
+    def test_gather_files_required_checked_first(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(tmpdir, "existing_file"), "w").close()
+            files_to_deliver = [
+                [os.path.join(tmpdir, "existing_file"), "stage"],
+                [os.path.join(tmpdir, "missing_file"), "stage", {"required": True}],
+            ]
+            with mock.patch.object(filesystem, "stream_digest") as hashmock:
+                with self.assertRaises(filesystem.PatternNotMatchedException):
+                    list(filesystem.gather_files(files_to_deliver))
+                hashmock.assert_not_called()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_gather_files_wait_for_reports(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(tmpdir, "existing_file"), "w").close()
+            report = os.path.join(tmpdir, "report.html")
+            files_to_deliver = [
+                [os.path.join(tmpdir, "existing_file"), "stage"],
+                [report, "stage", {"required": True, "report": True}],
+            ]
+
+            # the report is created while the files are being gathered
+            waiter = mock.Mock(side_effect=lambda: open(report, "w").close())
+            gathered = list(
+                filesystem.gather_files(files_to_deliver, wait_for_reports=waiter)
+            )
+            waiter.assert_called_once_with()
+            self.assertEqual(
+                [g[0] for g in gathered],
+                [os.path.join(tmpdir, "existing_file"), report],
+            )
+            # without waiting, the required report is checked up front
+            os.unlink(report)
+            with self.assertRaises(filesystem.PatternNotMatchedException):
+                list(filesystem.gather_files(files_to_deliver))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_verify_checksum(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmpdir, "FC1.tar")
+            with open(archive, "wb") as fh:
+                fh.write(b"run folder" * 1000)
+            with open(archive + ".md5", "w") as fh:
+                fh.write("{}  FC1.tar\n".format(hashfile(archive, hasher="md5")))
+            progress = mock.Mock()
+            self.assertTrue(
+                filesystem.verify_checksum(archive, archive + ".md5", progress=progress)
+            )
+            progress.assert_called_with(10000, 10000)
+            self.assertTrue(os.path.exists(archive + ".md5.verified"))
+            # an unchanged archive is not hashed again
+            with mock.patch.object(filesystem, "stream_digest") as digest:
+                self.assertTrue(filesystem.verify_checksum(archive, archive + ".md5"))
+                digest.assert_not_called()
+            # but a modified one is
+            with open(archive, "ab") as fh:
+                fh.write(b"corrupt")
+            self.assertFalse(filesystem.verify_checksum(archive, archive + ".md5"))
+            os.unlink(archive)
+            with self.assertRaises(filesystem.FileNotFoundException):
+                filesystem.verify_checksum(archive, archive + ".md5")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stream_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "sample.fastq.gz")
+            with open(fpath, "wb") as fh:
+                fh.write(os.urandom(10000))
+            expected = hashfile(fpath, hasher="sha1")
+            progress = mock.Mock()
+            with mock.patch.object(filesystem, "DROP_CACHE_BYTES", 4096):
+                with mock.patch.object(filesystem, "_fadvise") as fadvise:
+                    self.assertEqual(
+                        filesystem.stream_digest(
+                            fpath, "sha1", blocksize=1024, progress=progress
+                        ),
+                        expected,
+                    )
+            self.assertEqual(progress.call_count, 10)
+            progress.assert_called_with(10000, 10000)
+            # the hashed pages are dropped every 4 blocks and at the end
+            self.assertEqual(
+                [c[0][1:] for c in fadvise.call_args_list],
+                [
+                    (0, 0, "POSIX_FADV_SEQUENTIAL"),
+                    (0, 4096, "POSIX_FADV_DONTNEED"),
+                    (4096, 4096, "POSIX_FADV_DONTNEED"),
+                    (8192, 0, "POSIX_FADV_DONTNEED"),
+                ],
+            )
+            with mock.patch.object(filesystem, "_fadvise") as fadvise:
+                self.assertEqual(
+                    filesystem.stream_digest(fpath, "sha1", drop_cache=False),
+                    expected,
+                )
+            fadvise.assert_called_once_with(mock.ANY, 0, 0, "POSIX_FADV_SEQUENTIAL")
+            # the advice is only a hint
+            with mock.patch.object(
+                filesystem.os, "posix_fadvise", side_effect=OSError(22, "EINVAL")
+            ):
+                self.assertEqual(filesystem.stream_digest(fpath, "sha1"), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_copy_and_hash(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmpdir, "sample.fastq.gz")
+            with open(source, "wb") as fh:
+                fh.write(os.urandom(10000))
+            dest = os.path.join(tmpdir, "delivery", "sample.fastq.gz")
+            self.assertEqual(
+                filesystem.copy_and_hash(
+                    source, dest, "sha1", blocksize=1024, mode=0o640
+                ),
+                hashfile(source, hasher="sha1"),
+            )
+            with open(source, "rb") as sh, open(dest, "rb") as dh:
+                self.assertEqual(sh.read(), dh.read())
+            self.assertEqual(os.stat(dest).st_mode & 0o777, 0o640)
+            # a failed copy leaves no partial file behind
+            with mock.patch.object(
+                filesystem.os, "fsync", side_effect=OSError(5, "EIO")
+            ):
+                with self.assertRaises(OSError):
+                    filesystem.copy_and_hash(source, dest + ".2")
+            self.assertEqual(os.listdir(os.path.dirname(dest)), ["sample.fastq.gz"])
+            # nor does a copy that does not pass the verification
+            with self.assertRaises(filesystem.ChecksumMismatchException):
+                filesystem.copy_and_hash(source, dest + ".3", verify=lambda d: False)
+            self.assertEqual(os.listdir(os.path.dirname(dest)), ["sample.fastq.gz"])
+            # the modification time of the source can be kept
+            os.utime(source, ns=(0, 10**18))
+            filesystem.copy_and_hash(source, dest, preserve_mtime=True)
+            self.assertEqual(os.stat(dest).st_mtime_ns, 10**18)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_tree_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "sample.bam")
+            with open(fpath, "wb") as fh:
+                fh.write(os.urandom(10000))
+            hasher = filesystem.TreeHasher(blocksize=4096)
+            self.assertEqual(
+                filesystem.stream_digest(fpath, "md5", blocksize=1000, tree=hasher),
+                hashfile(fpath, hasher="md5"),
+            )
+            tree = hasher.tree()
+            self.assertEqual(len(tree["blocks"]), 3)
+            self.assertEqual(
+                filesystem.tree_digest(fpath, blocksize=4096, workers=3, readsize=1000),
+                tree,
+            )
+            self.assertEqual(filesystem.verify_tree_digest(fpath, tree), [])
+            # the block that was modified is found
+            with open(fpath, "r+b") as fh:
+                fh.seek(5000)
+                fh.write(b"modified")
+            self.assertEqual(filesystem.verify_tree_digest(fpath, tree), [1])
+            with open(fpath, "ab") as fh:
+                fh.write(os.urandom(4096))
+            self.assertEqual(filesystem.verify_tree_digest(fpath, tree), [1, 2, 3])
+            # an empty file has one block
+            open(fpath, "w").close()
+            self.assertEqual(
+                filesystem.tree_digest(fpath), filesystem.TreeHasher().tree()
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_integrity_hasher(self):
+        self.assertEqual(filesystem.integrity_hasher().digest_size, 32)
+        self.assertEqual(filesystem.integrity_hasher("sha256").name, "sha256")
+        with mock.patch.object(filesystem, "xxhash", None):
+            with self.assertRaises(ValueError):
+                filesystem.integrity_hasher("xxh3_128")
+        with self.assertRaises(ValueError):
+            filesystem.integrity_hasher("no-such-algorithm")
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "sample.bam")
+            with open(fpath, "wb") as fh:
+                fh.write(os.urandom(10000))
+            hasher = filesystem.TreeHasher(blocksize=4096, algorithm="sha256")
+            with open(fpath, "rb") as fh:
+                hasher.update(fh.read())
+            tree = hasher.tree()
+            self.assertEqual(
+                filesystem.tree_digest(fpath, blocksize=4096, algorithm="sha256"), tree
+            )
+            # the tree digest is verified with its own algorithm
+            self.assertEqual(filesystem.verify_tree_digest(fpath, tree), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_gather_files_tree_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "sample.bam")
+            with open(fpath, "wb") as fh:
+                fh.write(b"sample")
+            files_to_deliver = [[os.path.join(tmpdir, "*"), "stage"]]
+            gathered = list(filesystem.gather_files(files_to_deliver, tree_digest=True))
+            self.assertEqual(len(gathered), 1)
+            tree = filesystem.read_tree_digest(fpath)
+            self.assertEqual(tree["digest"], gathered[0][2])
+            self.assertEqual(tree["hash_algorithm"], "md5")
+            # the tree digest is not delivered and the cached checksum is used
+            with mock.patch.object(filesystem, "stream_digest") as digest:
+                self.assertEqual(
+                    list(filesystem.gather_files(files_to_deliver, tree_digest=True)),
+                    gathered,
+                )
+                digest.assert_not_called()
+            # but not once the file has changed
+            with open(fpath, "wb") as fh:
+                fh.write(b"modified sample")
+            self.assertEqual(
+                list(filesystem.gather_files(files_to_deliver, tree_digest=True))[0][2],
+                hashfile(fpath, hasher="md5"),
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_plan_files_cached_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "sample.bam")
+            with open(fpath, "wb") as fh:
+                fh.write(b"sample")
+            files_to_deliver = [[os.path.join(tmpdir, "*"), "stage"]]
+            planned = list(filesystem.plan_files(files_to_deliver, tree_digest=True))
+            self.assertEqual(planned[0][2:], (6, True))
+            list(filesystem.gather_files(files_to_deliver, tree_digest=True))
+            planned = list(filesystem.plan_files(files_to_deliver, tree_digest=True))
+            self.assertEqual(planned[0][2:], (6, False))
+            # a file modified since its checksum was cached needs a checksum,
+            # as it would get one from gather_files
+            with open(fpath, "wb") as fh:
+                fh.write(b"modified sample")
+            planned = list(filesystem.plan_files(files_to_deliver, tree_digest=True))
+            self.assertEqual(planned[0][2:], (15, True))
+            # without tree digests, a cached checksum is trusted as it is
+            # when the file is staged
+            planned = list(filesystem.plan_files(files_to_deliver))
+            self.assertEqual(planned[0][2:], (15, False))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_verify_checksum_tree_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmpdir, "FC1.tar")
+            with open(archive, "wb") as fh:
+                fh.write(b"run folder" * 1000)
+            with open(archive + ".md5", "w") as fh:
+                fh.write("{}  FC1.tar\n".format(hashfile(archive, hasher="md5")))
+            self.assertTrue(
+                filesystem.verify_checksum(archive, archive + ".md5", tree_workers=2)
+            )
+            self.assertIsNotNone(filesystem.read_tree_digest(archive))
+            # a touched archive is verified against the tree digest
+            os.utime(archive, (0, 0))
+            with mock.patch.object(filesystem, "stream_digest") as digest:
+                self.assertTrue(
+                    filesystem.verify_checksum(
+                        archive, archive + ".md5", tree_workers=2
+                    )
+                )
+                digest.assert_not_called()
+                with open(archive, "r+b") as fh:
+                    fh.write(b"corrupt")
+                self.assertFalse(
+                    filesystem.verify_checksum(
+                        archive, archive + ".md5", tree_workers=2
+                    )
+                )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_gzip_checker(self):
+        members = [gzip.compress(os.urandom(5000)), gzip.compress(b"\0" * 100000)]
+        data = b"".join(members)
+
+        def _check(data, chunk_size):
+            checker = filesystem.GzipChecker("sample.fastq.gz")
+            for n in range(0, len(data), chunk_size):
+                checker.update(data[n : n + chunk_size])
+            checker.finish()
+            return checker.members
+
+        with mock.patch.object(filesystem, "GZIP_CHECK_OUTPUT_SIZE", 1000):
+            for chunk_size in [1, 7, 100, len(data)]:
+                self.assertEqual(_check(data, chunk_size), 2)
+            # truncated within the second member
+            with self.assertRaises(filesystem.CorruptFileException):
+                _check(data[:-4], 100)
+            # the size in the trailer of the first member does not match
+            corrupt = bytearray(data)
+            corrupt[len(members[0]) - 1] ^= 1
+            with self.assertRaises(filesystem.CorruptFileException):
+                _check(bytes(corrupt), 100)
+            with self.assertRaises(filesystem.CorruptFileException):
+                _check(b"", 100)
+            # zeros padding the file after the last member are ignored
+            padded = data + b"\0" * 1000
+            for chunk_size in [1, 7, 100, len(padded)]:
+                self.assertEqual(_check(padded, chunk_size), 2)
+            with self.assertRaises(filesystem.CorruptFileException):
+                _check(padded + b"x", 100)
+            with self.assertRaises(filesystem.CorruptFileException):
+                _check(padded + members[0], 100)
+
+    def test_gather_files_check_gzip(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "sample.fastq.gz")
+            with open(fpath, "wb") as fh:
+                fh.write(gzip.compress(b"@read\nACGT\n+\nIIII\n"))
+            files_to_deliver = [[os.path.join(tmpdir, "*"), "stage"]]
+            self.assertEqual(
+                len(list(filesystem.gather_files(files_to_deliver, check_gzip=True))), 1
+            )
+            os.unlink(fpath + ".md5")
+            with open(fpath, "r+b") as fh:
+                fh.truncate(os.path.getsize(fpath) - 2)
+            with self.assertRaises(filesystem.CorruptFileException):
+                list(filesystem.gather_files(files_to_deliver, check_gzip=True))
+            self.assertFalse(os.path.exists(fpath + ".md5"))
+            # the truncated file is gathered unless checked
+            self.assertEqual(len(list(filesystem.gather_files(files_to_deliver))), 1)
+            # and is checked although its checksum is now cached
+            self.assertTrue(os.path.exists(fpath + ".md5"))
+            with self.assertRaises(filesystem.CorruptFileException):
+                list(filesystem.gather_files(files_to_deliver, check_gzip=True))
+            # unless it is checked while it is streamed
+            self.assertEqual(
+                len(
+                    list(
+                        filesystem.gather_files(
+                            files_to_deliver, check_gzip=True, defer_digest=True
+                        )
+                    )
+                ),
+                1,
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_parse_hash_file(self):
         hashfile = "tests/data/deliver_testset.tar.md5"
         got_dict = filesystem.parse_hash_file(
@@ -41,3 +535,18 @@ class TestFilesystem(unittest.TestCase):
             "C": "c1",
         }
         self.assertDictEqual(merged_dict, expected_dict)
+
+    def test_dict_merger(self):
+        mdict = {"A": {"a1": ["b", "a"]}, "B": "b1"}
+        merger = filesystem.DictMerger(mdict)
+        merger.merge({"A": {"a1": ["c", "a"]}, "B": "b1"})
+        merger.merge({"A": {"a1": ["b"]}, "C": {"c1": "c"}})
+        self.assertEqual(merger.changed, {"A", "C"})
+        self.assertIs(merger.materialise(), mdict)
+        self.assertDictEqual(
+            mdict, {"A": {"a1": ["a", "b", "c"]}, "B": "b1", "C": {"c1": "c"}}
+        )
+        # merging values already in the dict changes nothing
+        merger = filesystem.DictMerger(mdict)
+        merger.merge({"A": {"a1": ["a"]}, "C": {"c1": "c"}})
+        self.assertEqual(merger.changed, set())
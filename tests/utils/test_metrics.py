@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from taca_ngi_pipeline.utils import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.counter = self.registry.register(
+            metrics.Counter("test_total", "A counter", ["status"])
+        )
+        self.histogram = self.registry.register(
+            metrics.Histogram("test_seconds", "A histogram", buckets=(1, 5))
+        )
+
+    def test_render(self):
+        self.counter.inc(status="delivered")
+        self.counter.inc(2, status="delivered")
+        self.counter.inc(status='with "quotes"')
+        self.histogram.observe(0.5)
+        self.histogram.observe(3)
+        self.histogram.observe(10)
+        self.assertEqual(self.counter.value(status="delivered"), 3)
+        self.assertEqual(self.histogram.count(), 3)
+        self.assertEqual(
+            self.registry.render().splitlines(),
+            [
+                "# HELP test_total A counter",
+                "# TYPE test_total counter",
+                'test_total{status="delivered"} 3',
+                'test_total{status="with \\"quotes\\""} 1',
+                "# HELP test_seconds A histogram",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{le="1"} 1',
+                'test_seconds_bucket{le="5"} 2',
+                'test_seconds_bucket{le="+Inf"} 3',
+                "test_seconds_sum 13.5",
+                "test_seconds_count 3",
+            ],
+        )
+        self.registry.reset()
+        self.assertEqual(self.counter.value(status="delivered"), 0)
+
+    def test_merge(self):
+        self.counter.inc(status="delivered")
+        self.histogram.observe(3)
+        worker = metrics.MetricsRegistry()
+        worker.register(metrics.Counter("test_total", "A counter", ["status"]))
+        worker.register(
+            metrics.Histogram("test_seconds", "A histogram", buckets=(1, 5))
+        )
+        worker.metrics[0].inc(2, status="delivered")
+        worker.metrics[0].inc(status="failed")
+        worker.metrics[1].observe(0.5)
+        self.registry.merge(worker.snapshot())
+        self.assertEqual(self.counter.value(status="delivered"), 3)
+        self.assertEqual(self.counter.value(status="failed"), 1)
+        self.assertEqual(self.histogram.count(), 2)
+        self.assertIn("test_seconds_sum 3.5", self.registry.render())
+
+    def test_labels(self):
+        with self.assertRaises(ValueError):
+            self.counter.inc()
+        with self.assertRaises(ValueError):
+            self.counter.inc(status="delivered", method="rsync")
+        with self.assertRaises(ValueError):
+            self.counter.inc(-1, status="delivered")
+
+    def test_write_textfile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.counter.inc(status="failed")
+            self.histogram.observe(3)
+            path = self.registry.write_textfile(tmpdir)
+            self.assertEqual(path, os.path.join(tmpdir, metrics.TEXTFILE_NAME))
+            files = sorted(os.listdir(tmpdir))
+            self.assertEqual(
+                [f for f in files if f.endswith(".prom")], [metrics.TEXTFILE_NAME]
+            )
+            with open(path) as fh:
+                self.assertIn('test_total{status="failed"} 1\n', fh.read())
+            # the written metrics are reset
+            self.assertEqual(self.counter.value(status="failed"), 0)
+            # a failed write leaves the previous files and no temporary file
+            self.counter.inc(status="failed")
+            with mock.patch.object(
+                self.registry, "render", side_effect=RuntimeError("failed")
+            ):
+                with self.assertRaises(RuntimeError):
+                    self.registry.write_textfile(tmpdir)
+            self.assertEqual(sorted(os.listdir(tmpdir)), files)
+            # the metrics of another run are added to those written before
+            other = metrics.MetricsRegistry()
+            other.register(metrics.Counter("test_total", "A counter", ["status"])).inc(
+                2, status="delivered"
+            )
+            other.register(
+                metrics.Histogram("test_seconds", "A histogram", buckets=(1, 5))
+            ).observe(0.5)
+            other.write_textfile(tmpdir)
+            self.registry.write_textfile(tmpdir)
+            with open(path) as fh:
+                lines = fh.read().splitlines()
+            self.assertIn('test_total{status="failed"} 2', lines)
+            self.assertIn('test_total{status="delivered"} 2', lines)
+            self.assertIn('test_seconds_bucket{le="1"} 1', lines)
+            self.assertIn("test_seconds_count 2", lines)
+            self.assertIn("test_seconds_sum 3.5", lines)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_export(self):
+        self.assertIsNone(metrics.export(None))
+        with mock.patch.object(
+            metrics.REGISTRY, "write_textfile", side_effect=OSError("read-only")
+        ):
+            self.assertIsNone(metrics.export("/textfile/dir", success=False))
+        self.assertGreater(
+            metrics.LAST_RUN.value(status="failure"),
+            0,
+        )
+
+    def test_database_request(self):
+        before = metrics.DATABASE_REQUESTS.value(database="charon", outcome="error")
+        with self.assertRaises(KeyError):
+            with metrics.database_request("charon"):
+                raise KeyError("P12345")
+        self.assertEqual(
+            metrics.DATABASE_REQUESTS.value(database="charon", outcome="error"),
+            before + 1,
+        )
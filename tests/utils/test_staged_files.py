@@ -0,0 +1,121 @@
+import unittest
+
+from unittest import mock
+
+from taca_ngi_pipeline.utils import staged_files
+
+
+class ApiException(Exception):
+    def __init__(self, code):
+        super(ApiException, self).__init__("HTTP {}".format(code))
+        self.code = code
+
+
+class TestStagedFiles(unittest.TestCase):
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.docs = {}
+
+        def _get_document(db, doc_id):
+            if doc_id not in self.docs:
+                raise ApiException(404)
+            return mock.Mock(get_result=mock.Mock(return_value=dict(self.docs[doc_id])))
+
+        def _put_document(db, doc_id, document):
+            self.docs[doc_id] = document
+            return mock.Mock(get_result=mock.Mock(return_value={"rev": "1-a"}))
+
+        self.connection.get_document.side_effect = _get_document
+        self.connection.put_document.side_effect = _put_document
+
+    def test_update_staged_files(self):
+        inline = mock.Mock(return_value={"P12345_1001/a.fastq.gz": {"md5_sum": "a"}})
+        staged_files.update_staged_files(
+            self.connection,
+            "staged_files",
+            "P12345",
+            "P12345_1001",
+            {"P12345_1001/b.fastq.gz": {"md5_sum": "b"}},
+            inline=inline,
+        )
+        # the staged files in the project document are carried over once
+        staged_files.update_staged_files(
+            self.connection,
+            "staged_files",
+            "P12345",
+            "P12345_1001",
+            {"P12345_1001/a.fastq.gz": {"md5_sum": "c"}},
+            inline=inline,
+        )
+        inline.assert_called_once_with()
+        self.assertEqual(
+            self.docs["P12345_1001"],
+            {
+                "project_id": "P12345",
+                "sample_id": "P12345_1001",
+                "staged_files": {
+                    "P12345_1001/a.fastq.gz": {"md5_sum": "c"},
+                    "P12345_1001/b.fastq.gz": {"md5_sum": "b"},
+                },
+            },
+        )
+        # the document is not written again if the files are already in it
+        self.docs["P12345_1001"]["_rev"] = "2-b"
+        self.assertEqual(
+            staged_files.update_staged_files(
+                self.connection,
+                "staged_files",
+                "P12345",
+                "P12345_1001",
+                {"P12345_1001/a.fastq.gz": {"md5_sum": "c"}},
+            ),
+            "2-b",
+        )
+        self.assertEqual(self.connection.put_document.call_count, 2)
+
+    def test_update_staged_files_conflict(self):
+        put = self.connection.put_document.side_effect
+
+        def _put_conflict(**kwargs):
+            # another process updates the document first
+            if self.connection.put_document.call_count == 1:
+                raise ApiException(409)
+            return put(**kwargs)
+
+        self.connection.put_document.side_effect = _put_conflict
+        staged_files.update_staged_files(
+            self.connection, "staged_files", "P12345", "P12345_1001", {}
+        )
+        self.assertEqual(self.connection.put_document.call_count, 2)
+        self.connection.put_document.side_effect = ApiException(500)
+        with self.assertRaises(ApiException):
+            staged_files.update_staged_files(
+                self.connection, "staged_files", "P12345", "P12345_1001", {}
+            )
+        self.assertEqual(self.connection.put_document.call_count, 3)
+
+    def test_read_staged_files(self):
+        self.connection.post_all_docs.return_value.get_result.return_value = {
+            "rows": [
+                {
+                    "id": "P12345_1001",
+                    "doc": {
+                        "project_id": "P12345",
+                        "sample_id": "P12345_1001",
+                        "staged_files": {"a.fastq.gz": {}},
+                    },
+                }
+            ]
+        }
+        self.assertEqual(
+            staged_files.read_staged_files(
+                self.connection,
+                "staged_files",
+                "P12345",
+                inline={"P12345_1001": {"old.fastq.gz": {}}, "P12345_1002": {}},
+            ),
+            {"P12345_1001": {"a.fastq.gz": {}}, "P12345_1002": {}},
+        )
+        kwargs = self.connection.post_all_docs.call_args[1]
+        self.assertEqual(kwargs["start_key"], "P12345_")
+        self.assertTrue(kwargs["end_key"].startswith("P12345_"))